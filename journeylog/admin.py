@@ -1,21 +1,209 @@
+import time
+from collections import defaultdict
+
 from admirarchy.utils import HierarchicalModelAdmin, AdjacencyList
-from django.contrib import admin
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.exceptions import ValidationError, FieldDoesNotExist
+from django.db import connections, router
+from django.http import FileResponse, Http404
+from django.shortcuts import redirect, get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils import timezone
 from django.utils.html import format_html
-from import_export import resources
+from import_export import resources, fields, widgets
 from import_export.admin import ImportExportMixin
+from import_export.results import RowResult
 from nested_admin.nested import NestedTabularInline, NestedModelAdmin
 
+from . import clustering, caching
+from .duplicates import journey_duplicate_groups, DUPLICATE_MAX_DISTANCE
+from .importers import import_track, guess_track_format, TRACK_FORMATS
 from .models import *
+from .util.geo import geohash_encode
+
+
+def to_python_or_none(model_field, value):
+    if value is None or value == '':
+        return None
+
+    try:
+        return model_field.to_python(value)
+    except ValidationError:
+        return None
+
+
+class PrefetchedForeignKeyWidget(widgets.ForeignKeyWidget):
+    # Resolves related objects from a cache filled once per import instead of running a query for every row
+    cache = None
+
+    def get_target_field(self):
+        return self.model._meta.pk if self.field == 'pk' else self.model._meta.get_field(self.field)
+
+    def prefetch(self, values):
+        target = self.get_target_field()
+        values = {to_python_or_none(target, value) for value in values} - {None}
+
+        self.cache = {getattr(obj, self.field): obj
+                      for obj in self.get_queryset(None, None).filter(**{self.field + '__in': values})}
+
+    def clean(self, value, row=None, *args, **kwargs):
+        if self.cache is None:
+            return super().clean(value, row, *args, **kwargs)
 
+        value = to_python_or_none(self.get_target_field(), value)
+        if value is None:
+            return None
+
+        try:
+            return self.cache[value]
+        except KeyError:
+            raise self.model.DoesNotExist('{} matching query does not exist.'.format(self.model._meta.object_name))
+
+
+class BulkModelResource(resources.ModelResource):
+    # Looks up existing rows with one query per batch keyed on import_id_fields, skips rows whose values are the same as
+    # what is already stored and writes the rest with bulk_create()/bulk_update().
 
-class LocationResource(resources.ModelResource):
     class Meta:
+        use_bulk = True
+        batch_size = 1000
+        skip_diff = True
+
+    def get_key_fields(self):
+        model_fields = []
+
+        for name in self.get_import_id_fields():
+            field = self.fields[name]
+            model_field = self._meta.model._meta.get_field(field.attribute)
+            model_fields.append((field.column_name, model_field))
+
+        return model_fields
+
+    def get_row_key(self, row):
+        return tuple(to_python_or_none(model_field.target_field if model_field.is_relation else model_field,
+                                       row.get(column))
+                     for column, model_field in self.get_key_fields())
+
+    def get_instance_key(self, instance):
+        return tuple(getattr(instance, model_field.attname) for _, model_field in self.get_key_fields())
+
+    def get_row_values(self, instance):
+        values = []
+
+        for field in self.get_import_fields():
+            try:
+                model_field = self._meta.model._meta.get_field(field.attribute)
+            except (FieldDoesNotExist, TypeError):
+                continue
+
+            values.append(getattr(instance, model_field.attname))
+
+        return tuple(values)
+
+    def before_import(self, dataset, using_transactions, dry_run, **kwargs):
+        self.import_started = time.monotonic()
+        self.existing_instances = {}
+        self.existing_values = {}
+
+        rows = list(dataset.dict)
+
+        for field in self.get_import_fields():
+            if isinstance(field.widget, PrefetchedForeignKeyWidget):
+                field.widget.prefetch(row.get(field.column_name) for row in rows)
+
+        key_fields = self.get_key_fields()
+        if not key_fields or any(column not in dataset.headers for column, _ in key_fields):
+            return
+
+        keys = [key for key in map(self.get_row_key, rows) if None not in key]
+        batch_size = self._meta.batch_size
+
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            # A superset for composite keys, which the dictionary lookup in get_instance() narrows down
+            lookups = {
+                model_field.attname + '__in': {key[i] for key in batch}
+                for i, (_, model_field) in enumerate(key_fields)
+            }
+
+            for instance in self.get_queryset().filter(**lookups):
+                self.existing_instances[self.get_instance_key(instance)] = instance
+                self.existing_values[instance.pk] = self.get_row_values(instance)
+
+    def get_instance(self, instance_loader, row):
+        return self.existing_instances.get(self.get_row_key(row))
+
+    def skip_row(self, instance, original):
+        return instance.pk is not None and self.existing_values.get(instance.pk) == self.get_row_values(instance)
+
+    def before_save_instance(self, instance, using_transactions, dry_run):
+        # bulk_create() and bulk_update() skip save(), so anything it would normally fill in has to be done here
+        instance.modified_at = timezone.now()
+
+        if isinstance(instance, GeohashedModel):
+            instance.geohash = geohash_encode(instance.latitude, instance.longitude)
+
+    def bulk_create(self, using_transactions, dry_run, raise_errors, batch_size=None):
+        # Django 2.2 doesn't cap an explicit batch size to what the backend can take in a single query
+        if batch_size is not None and self.create_instances:
+            model = self._meta.model
+            ops = connections[router.db_for_write(model)].ops
+            batch_size = min(batch_size,
+                             ops.bulk_batch_size(model._meta.concrete_fields, self.create_instances) or batch_size)
+
+        super().bulk_create(using_transactions, dry_run, raise_errors, batch_size=batch_size)
+
+    def get_bulk_update_fields(self):
+        update_fields = super().get_bulk_update_fields() + ['modified_at']
+
+        if issubclass(self._meta.model, GeohashedModel):
+            update_fields.append('geohash')
+
+        return update_fields
+
+    def after_import(self, dataset, result, using_transactions, dry_run, **kwargs):
+        super().after_import(dataset, result, using_transactions, dry_run, **kwargs)
+
+        result.duration = time.monotonic() - self.import_started
+
+        if not dry_run:
+            # Locations and their names show up in a lot of responses, and bulk saves don't send signals
+            caching.log_purge({caching.GLOBAL_SURROGATE_KEY})
+
+
+class LocationResource(BulkModelResource):
+    def before_import(self, dataset, using_transactions, dry_run, **kwargs):
+        super().before_import(dataset, using_transactions, dry_run, **kwargs)
+
+        self.changed_geohashes = defaultdict(set)
+
+    def before_save_instance(self, instance, using_transactions, dry_run):
+        # Both the cells a location leaves and the ones it moves to need to be recomputed. New locations don't have an
+        # id before the bulk insert, but they aren't visited by any journey yet either.
+        previous = instance.geohash
+        super().before_save_instance(instance, using_transactions, dry_run)
+
+        self.changed_geohashes[instance.pk] |= {previous, instance.geohash}
+
+    def after_import(self, dataset, result, using_transactions, dry_run, **kwargs):
+        super().after_import(dataset, result, using_transactions, dry_run, **kwargs)
+
+        # Bulk saves don't send the signals that keep the clusters up to date
+        if not dry_run and self.changed_geohashes:
+            clustering.update_location_clusters(self.changed_geohashes)
+
+    class Meta(BulkModelResource.Meta):
         model = Location
         fields = ('id', 'name', 'type', 'latitude', 'longitude', 'color')
 
 
-class LocationNameResource(resources.ModelResource):
-    class Meta:
+class LocationNameResource(BulkModelResource):
+    location = fields.Field(attribute='location', column_name='location', widget=PrefetchedForeignKeyWidget(Location))
+
+    class Meta(BulkModelResource.Meta):
         model = LocationName
         fields = ('location', 'lang', 'name', 'sort_key')
         import_id_fields = ('location', 'lang')
@@ -23,7 +211,6 @@ class LocationNameResource(resources.ModelResource):
 
 class JourneyLocationVisitResource(resources.ModelResource):
     def get_instance(self, instance_loader, row):
-        print(instance_loader, row)
         return False
 
     class Meta:
@@ -96,7 +283,15 @@ class PrivateOrNotFilter(admin.SimpleListFilter):
             return queryset.filter(confidentiality__gt=0)
 
 
+class DuplicateSearchForm(forms.Form):
+    journey = forms.ModelChoiceField(queryset=Journey.objects.all())
+    distance = forms.IntegerField(min_value=0, max_value=64, initial=DUPLICATE_MAX_DISTANCE,
+                                  help_text='Largest number of differing hash bits between similar photos.')
+
+
 class PhotoAdmin(admin.ModelAdmin):
+    change_list_template = 'admin/journeylog/photo/change_list.html'
+
     class Media:
         css = {
             'all': ('journeylog-admin/css/photo_admin.css', )
@@ -125,13 +320,52 @@ class PhotoAdmin(admin.ModelAdmin):
     search_fields = ('name', 'filename')
     autocomplete_fields = ['journey']
 
+    def get_urls(self):
+        return [
+            path('duplicates/', self.admin_site.admin_view(self.duplicates_view),
+                 name='journeylog_photo_duplicates'),
+        ] + super().get_urls()
+
+    def duplicates_view(self, request):
+        if not self.has_view_permission(request):
+            return redirect('admin:index')
+
+        form = DuplicateSearchForm(request.GET or None)
+        groups = None
+
+        if form.is_valid():
+            groups = [[(photo, photo.get_url_of_kind(None, 'thumb', for_admin=True)) for photo in group]
+                      for group in journey_duplicate_groups(form.cleaned_data['journey'].id,
+                                                            form.cleaned_data['distance'])]
+
+        return TemplateResponse(request, 'admin/journeylog/photo/duplicates.html', {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Near-duplicate photos',
+            'form': form,
+            'groups': groups,
+        })
+
 
 class LocationNameInline(NestedTabularInline):
     model = LocationName
     extra = 1
 
 
-class LocationAdmin(ImportExportMixin, NestedModelAdmin):
+class BulkImportMixin(ImportExportMixin):
+    skip_admin_log = True
+
+    def add_success_message(self, result, request):
+        super().add_success_message(result, request)
+
+        duration = getattr(result, 'duration', None)
+        if duration is not None:
+            messages.info(request, 'Processed {} rows in {:.2f} s ({:.0f} rows/s), skipped {} unchanged rows.'.format(
+                result.total_rows, duration, result.total_rows / max(duration, 1e-6),
+                result.totals[RowResult.IMPORT_TYPE_SKIP]))
+
+
+class LocationAdmin(BulkImportMixin, NestedModelAdmin):
     inlines = [
         LocationNameInline
     ]
@@ -144,7 +378,7 @@ class LocationAdmin(ImportExportMixin, NestedModelAdmin):
     resource_class = LocationResource
 
 
-class LocationNameAdmin(ImportExportMixin, admin.ModelAdmin):
+class LocationNameAdmin(BulkImportMixin, admin.ModelAdmin):
     list_display = ('name', 'location', 'lang', 'sort_key')
     list_editable = ['sort_key']
 
@@ -173,7 +407,27 @@ class JourneyLocationVisitAdmin(ImportExportMixin, admin.ModelAdmin):
     resource_class = JourneyLocationVisitResource
 
 
+class TrackImportForm(forms.Form):
+    journey = forms.ModelChoiceField(queryset=Journey.objects.all())
+    file = forms.FileField(help_text='A GPX or KML file, or a CSV file with latitude, longitude and timestamp columns.')
+    format = forms.ChoiceField(required=False, choices=[('', 'Detect from the file extension')] +
+                                                      [(f, f.upper()) for f in TRACK_FORMATS])
+    replace = forms.BooleanField(required=False, help_text='Remove the existing map points of the journey first.')
+
+    def clean(self):
+        cleaned_data = super().clean()
+
+        if 'file' in cleaned_data and not cleaned_data.get('format'):
+            cleaned_data['format'] = guess_track_format(cleaned_data['file'].name)
+            if cleaned_data['format'] is None:
+                self.add_error('format', 'Could not tell the format of the file, please choose one.')
+
+        return cleaned_data
+
+
 class JourneyMapPointVisitAdmin(ImportExportMixin, admin.ModelAdmin):
+    change_list_template = 'admin/journeylog/journeymappointvisit/change_list.html'
+
     list_display = ('timestamp', 'latitude', 'longitude', 'journey')
     list_filter = ('journey', )
     list_select_related = ('journey', )
@@ -183,6 +437,81 @@ class JourneyMapPointVisitAdmin(ImportExportMixin, admin.ModelAdmin):
 
     resource_class = JourneyMapPointVisitResource
 
+    def get_urls(self):
+        return [
+            path('import-track/', self.admin_site.admin_view(self.import_track_view),
+                 name='journeylog_journeymappointvisit_import_track'),
+        ] + super().get_urls()
+
+    def import_track_view(self, request):
+        if not self.has_add_permission(request):
+            return redirect('admin:journeylog_journeymappointvisit_changelist')
+
+        form = TrackImportForm(request.POST or None, request.FILES or None)
+
+        if request.method == 'POST' and form.is_valid():
+            try:
+                result = import_track(form.cleaned_data['journey'], form.cleaned_data['file'],
+                                      form.cleaned_data['format'], replace=form.cleaned_data['replace'])
+            except ValueError as e:
+                form.add_error('file', str(e))
+            else:
+                for error in result.errors:
+                    messages.warning(request, error)
+
+                messages.success(request, 'Imported {} points ({} skipped) in {:.2f} s.'.format(
+                    result.imported, result.skipped, result.duration))
+                return redirect('admin:journeylog_journeymappointvisit_changelist')
+
+        return TemplateResponse(request, 'admin/journeylog/journeymappointvisit/import_track.html', {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import GPS track',
+            'form': form,
+        })
+
+
+class RequestProfileAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'method', 'path', 'status_code', 'duration', 'samples', 'user', 'downloads')
+    list_filter = ('method', 'status_code')
+    list_select_related = ('user', )
+    search_fields = ('path', )
+    date_hierarchy = 'created_at'
+
+    def duration(self, profile):
+        return '{:.1f} ms'.format(profile.duration_ms)
+    duration.admin_order_field = 'duration_ms'
+
+    def downloads(self, profile):
+        return format_html('<a href="{}">cProfile</a> | <a href="{}">Collapsed stacks</a>',
+                           reverse('admin:journeylog_requestprofile_download', args=(profile.id, 'prof')),
+                           reverse('admin:journeylog_requestprofile_download', args=(profile.id, 'collapsed')))
+    downloads.short_description = 'Files'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path('<int:profile_id>/download/<str:extension>/', self.admin_site.admin_view(self.download_view),
+                 name='journeylog_requestprofile_download'),
+        ] + super().get_urls()
+
+    def download_view(self, request, profile_id, extension):
+        profile = get_object_or_404(RequestProfile, id=profile_id)
+        if not self.has_view_permission(request, profile) or extension not in ('prof', 'collapsed') \
+                or not settings.JOURNEYLOG['PROFILE_DIR']:
+            raise Http404
+
+        try:
+            return FileResponse(open(profile.get_file_path(extension), 'rb'), as_attachment=True,
+                                filename='{}.{}'.format(profile.name, extension))
+        except IOError:
+            raise Http404
+
 
 admin.site.register(Journey, JourneyAdmin)
 admin.site.register(JournalPage, JournalPageAdmin)
@@ -192,6 +521,7 @@ admin.site.register(LocationName, LocationNameAdmin)
 admin.site.register(Tag, TagAdmin)
 admin.site.register(JourneyLocationVisit, JourneyLocationVisitAdmin)
 admin.site.register(JourneyMapPointVisit, JourneyMapPointVisitAdmin)
+admin.site.register(RequestProfile, RequestProfileAdmin)
 
 admin.site.site_header = 'JourneyLog administration'
 admin.site.site_title = 'JourneyLog administration'
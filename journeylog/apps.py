@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class JourneyLogConfig(AppConfig):
     name = 'journeylog'
     verbose_name = 'JourneyLog backend'
+
+    def ready(self):
+        from . import signals  # noqa: F401
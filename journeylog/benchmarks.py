@@ -0,0 +1,221 @@
+import hashlib
+import io
+import os
+import platform
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import django
+import pytz
+from PIL import Image
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from . import search, clustering, counters
+from .models import Journey, JournalPage, Location, LocationName, Photo, JourneyLocationVisit
+from .util.geo import geohash_encode
+from .util.time import wall_clock_time
+
+BENCHMARK_START = datetime(2018, 1, 1, tzinfo=pytz.utc)
+BENCHMARK_TIMEZONES = ('Asia/Tokyo', 'Asia/Seoul', 'Europe/Helsinki')
+BENCHMARK_WORDS = ('temple', 'station', 'river', 'castle', 'market', 'garden', 'bridge', 'tower', 'harbour',
+                   'mountain', 'shrine', 'museum', 'street', 'lake', 'forest', 'island')
+BENCHMARK_IMAGE_SIZE = (96, 72)
+
+
+def words(generator, count):
+    return ' '.join(generator.choice(BENCHMARK_WORDS) for _ in range(count))
+
+
+def coordinate(generator, center, spread):
+    return round(center + generator.uniform(-spread, spread), 6)
+
+
+def write_image(generator, path):
+    # A tiny but valid JPEG, so that thumbnails and file serving work on real files
+    image = Image.new('RGB', BENCHMARK_IMAGE_SIZE, tuple(generator.randrange(256) for _ in range(3)))
+    image.paste(tuple(generator.randrange(256) for _ in range(3)), (0, 0, BENCHMARK_IMAGE_SIZE[0] // 2,
+                                                                     generator.randrange(1, BENCHMARK_IMAGE_SIZE[1])))
+    content = io.BytesIO()
+    image.save(content, 'jpeg', quality=80)
+    content = content.getvalue()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    return content
+
+
+def generate_fixtures(journeys=2, photos=500, pages=20, locations=100, seed=0):
+    # Deterministic for a given seed, apart from ids and creation times. Photo files are written under the storage
+    # directory of BASE_DIR, so callers should point it somewhere disposable.
+    generator = random.Random(seed)
+
+    new_locations = []
+    for i in range(locations):
+        latitude = coordinate(generator, 35.68, 2)
+        longitude = coordinate(generator, 139.69, 2)
+        new_locations.append(Location(name='{} {}'.format(words(generator, 2).title(), i), latitude=latitude,
+                                      longitude=longitude, geohash=geohash_encode(latitude, longitude),
+                                      type=Location.BUILDING))
+
+    Location.objects.bulk_create(new_locations)
+    # Not every backend returns the ids from bulk_create()
+    location_ids = list(Location.objects.order_by('id').values_list('id', flat=True))
+
+    LocationName.objects.bulk_create([
+        LocationName(location_id=location_id, lang=lang, name='{} ({})'.format(words(generator, 2).title(), lang),
+                     sort_key=words(generator, 1))
+        for location_id in location_ids for lang in ('en', 'ja')
+    ])
+
+    span = timedelta(days=30)
+    for journey_number in range(journeys):
+        start = BENCHMARK_START + journey_number * span
+        journey = Journey.objects.create(slug='benchmark-{}'.format(journey_number),
+                                         name='Benchmark journey {}'.format(journey_number),
+                                         description='# {}\n\n{}'.format(words(generator, 3), words(generator, 60)),
+                                         date_start=start, date_end=start + span, languages='en,ja')
+
+        for page_number in range(pages):
+            page_start = start + span * page_number / pages
+            JournalPage.objects.create(journey=journey, slug='{}-day-{}'.format(journey.slug, page_number + 1),
+                                       name=words(generator, 3).title(), order_no=page_number,
+                                       text='\n\n'.join(words(generator, 40) for _ in range(5)),
+                                       date_start=page_start, date_end=page_start + span / pages,
+                                       timezone_start=generator.choice(BENCHMARK_TIMEZONES))
+
+        batch = []
+        for photo_number in range(photos):
+            timestamp = start + span * photo_number / photos
+            zone = generator.choice(BENCHMARK_TIMEZONES)
+            latitude = coordinate(generator, 35.68, 2)
+            longitude = coordinate(generator, 139.69, 2)
+            photo = Photo(journey=journey, name=words(generator, 3).title(), description=words(generator, 12),
+                          timestamp=timestamp, local_timestamp=wall_clock_time(timestamp, zone), timezone=zone,
+                          latitude=latitude, longitude=longitude, geohash=geohash_encode(latitude, longitude),
+                          filename='IMG_{:05d}.jpg'.format(photo_number), width=BENCHMARK_IMAGE_SIZE[0],
+                          height=BENCHMARK_IMAGE_SIZE[1], confidentiality=1 if photo_number % 10 == 0 else 0)
+            content = write_image(generator, photo.get_storage_file_path('photo'))
+            photo.filesize = len(content)
+            photo.hash = hashlib.sha1(content).hexdigest()
+            batch.append(photo)
+
+        Photo.objects.bulk_create(batch)
+
+        JourneyLocationVisit.objects.bulk_create([
+            JourneyLocationVisit(journey=journey, location_id=generator.choice(location_ids),
+                                 timestamp=start + span * generator.random())
+            for _ in range(locations)
+        ])
+
+    # Bulk inserts skip the signals that maintain the derived data
+    search.rebuild_index()
+    clustering.rebuild_clusters()
+    counters.recount_journeys()
+
+
+class BenchmarkRunner:
+    def __init__(self, repeat=5):
+        self.repeat = repeat
+        self.client = Client()
+        self.results = []
+
+    def measure(self, name, runs, query_budget=None, **extra):
+        # Each run is timed separately; the query count is the one of the last run, when caches are warm
+        timings = []
+        queries = 0
+
+        for run in runs:
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                run()
+                timings.append((time.perf_counter() - started) * 1000)
+            queries = len(context)
+
+        result = dict(name=name, runs=len(timings), min_ms=min(timings), median_ms=statistics.median(timings),
+                      mean_ms=statistics.mean(timings), max_ms=max(timings), queries=queries,
+                      query_budget=query_budget, within_budget=query_budget is None or queries <= query_budget,
+                      **extra)
+        self.results.append(result)
+
+        return result
+
+    def request(self, path, params=None):
+        def run():
+            response = self.client.get(path, params or {})
+            if response.status_code != 200:
+                raise ValueError('{} returned HTTP {}'.format(path, response.status_code))
+            if response.streaming:
+                b''.join(response.streaming_content)
+
+        return run
+
+    def measure_request(self, name, path, params=None, query_budget=None):
+        run = self.request(path, params)
+        # Untimed, so that process-wide caches such as the settings are warm
+        run()
+
+        return self.measure(name, [run] * self.repeat, query_budget, path=path, params=params or {})
+
+    def remove_thumbs(self, photos):
+        for photo in photos:
+            thumb_path = photo.get_storage_file_path('thumb')
+            if os.path.exists(thumb_path):
+                os.remove(thumb_path)
+
+    def run(self, journey):
+        base = '/journeys/{}/'.format(journey.slug)
+        page = JournalPage.objects.filter(journey=journey).first()
+        photos = list(Photo.objects.filter(journey=journey, confidentiality=0))
+        middle = photos[len(photos) // 2].timestamp
+
+        self.measure_request('journey-list', '/journeys/', query_budget=2)
+        self.measure_request('journey-detail', base, query_budget=2)
+        self.measure_request('journal-page-list', base + 'journal-pages/', query_budget=2)
+        self.measure_request('journal-page-detail', '{}journal-pages/{}/'.format(base, page.slug), query_budget=2)
+        self.measure_request('photo-list', '/photos/', query_budget=2)
+        self.measure_request('photo-list-journey', base + 'photos/', query_budget=2)
+        self.measure_request('photo-search', '/photos/', {'search': '{} {}'.format(*BENCHMARK_WORDS[:2])},
+                             query_budget=5)
+        self.measure_request('photo-filter', '/photos/', {
+            'journey': journey.slug, 'after': middle.isoformat(), 'bbox': '35,139,36.5,140.5', 'ordering': '-filesize'
+        }, query_budget=2)
+        self.measure_request('journey-bundle', base + 'bundle/', query_budget=6)
+
+        # Cold requests generate the thumbnail first, every run with a different photo
+        self.remove_thumbs(photos[:self.repeat])
+        self.measure('photo-file-cold', [
+            self.request('/image/public/thumb/{}/{}'.format(journey.id, photo.filename))
+            for photo in photos[:self.repeat]
+        ], query_budget=2)
+        self.measure_request('photo-file-warm', '/image/public/thumb/{}/{}'.format(journey.id, photos[0].filename),
+                             query_budget=1)
+
+        self.remove_thumbs(photos)
+        result = self.measure('thumbnail-backfill', [lambda: [photo.ensure_thumb() for photo in photos]],
+                              query_budget=len(photos), photos=len(photos))
+        result['photos_per_second'] = len(photos) / result['min_ms'] * 1000
+
+        return self.results
+
+
+def benchmark_environment():
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'machine': platform.machine(),
+    }
+
+
+def compare_results(results, previous):
+    # Median ratios against an earlier run; above 1 means slower
+    previous = {result['name']: result for result in previous}
+
+    return {result['name']: result['median_ms'] / previous[result['name']]['median_ms']
+            for result in results if result['name'] in previous and previous[result['name']]['median_ms']}
@@ -0,0 +1,30 @@
+from .models import JournalPage, Photo, Location, JourneyLocationVisit
+from .serializers import BundleJourneySerializer, BundleJournalPageSerializer, BundlePhotoSerializer, \
+    LocationSerializer, LocationVisitSerializer
+
+
+def journey_bundle(journey, context):
+    # A fixed number of queries regardless of the size of the journey: pages, photos, visits, and the locations
+    # referenced by the visits along with their names
+    pages = list(JournalPage.objects.filter(journey=journey))
+    photos = list(Photo.objects.filter(journey=journey).order_by('timestamp', 'name'))
+    visits = list(JourneyLocationVisit.objects.filter(journey=journey))
+
+    location_ids = {visit.location_id for visit in visits if visit.location_id is not None}
+    locations = list(Location.objects.filter(id__in=location_ids).prefetch_related('names')) if location_ids else []
+
+    # Serializers follow the journey relation for URLs and slugs
+    for instance in pages + photos:
+        instance.journey = journey
+
+    timestamps = [photo.timestamp for photo in photos]
+    photo_ids = [photo.id for photo in photos]
+    context = dict(context, page_photos={page.pk: page.select_photos(timestamps, photo_ids) for page in pages})
+
+    return {
+        'journey': BundleJourneySerializer(journey, context=context).data,
+        'journal_pages': BundleJournalPageSerializer(pages, many=True, context=context).data,
+        'photos': BundlePhotoSerializer(photos, many=True, context=context).data,
+        'locations': LocationSerializer(locations, many=True, context=context).data,
+        'location_visits': LocationVisitSerializer(visits, many=True, context=context).data,
+    }
@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.utils.cache import patch_cache_control, patch_vary_headers
+
+from .models import CachePurge
+
+GLOBAL_SURROGATE_KEY = 'journeylog'
+
+
+def public_read_enabled():
+    return settings.JOURNEYLOG['PUBLIC_READ_MODE']
+
+
+def is_public_request(request):
+    return (public_read_enabled() and request.method in ('GET', 'HEAD') and
+            settings.SESSION_COOKIE_NAME not in request.COOKIES and 'HTTP_AUTHORIZATION' not in request.META)
+
+
+def object_keys(instance):
+    model_name = instance._meta.model_name
+    keys = {'{}-{}'.format(model_name, instance.pk)}
+
+    journey_id = getattr(instance, 'journey_id', None)
+    if journey_id is not None:
+        keys.add('journey-{}'.format(journey_id))
+
+    location_id = getattr(instance, 'location_id', None)
+    if location_id is not None:
+        keys.add('location-{}'.format(location_id))
+
+    return keys
+
+
+def purge_keys(instance):
+    # Lists are tagged with the plural of the model name, since new objects show up in them
+    return object_keys(instance) | {instance._meta.model_name + 's'}
+
+
+def log_purge(keys):
+    if not public_read_enabled() or not keys:
+        return
+
+    CachePurge.objects.bulk_create([CachePurge(key=key) for key in sorted(keys)])
+
+
+def patch_public_response(response, keys):
+    options = settings.JOURNEYLOG
+
+    patch_cache_control(response, public=True, max_age=options['PUBLIC_CACHE_MAX_AGE'],
+                        s_maxage=options['PUBLIC_CACHE_S_MAXAGE'])
+    patch_vary_headers(response, ('Cookie', 'Authorization'))
+    response['Surrogate-Key'] = ' '.join(sorted(keys | {GLOBAL_SURROGATE_KEY}))
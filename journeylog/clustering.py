@@ -0,0 +1,234 @@
+from collections import defaultdict
+
+from django.db import transaction, connections, router
+from django.db.models import Count, Avg
+
+from .models import MapCluster, Photo, Location, JourneyLocationVisit
+from .util.geo import bbox_q
+
+CLUSTER_MAX_PRECISION = 8
+# Beyond this many changed cells, one rebuild runs fewer queries than recomputing the cells one at a time
+CLUSTER_UPDATE_MAX_CELLS = 2000
+
+REPRESENTATIVE_ORDERING = {
+    MapCluster.PHOTO: ('confidentiality', 'timestamp', 'id'),
+    MapCluster.LOCATION: ('name', 'id'),
+}
+
+
+def zoom_precision(zoom):
+    # Aims for cells of roughly a quarter of a 256px map tile at the given zoom level
+    return max(1, min(CLUSTER_MAX_PRECISION, round((zoom + 2) * 2 / 5)))
+
+
+def scoped_objects(kind, journey_id):
+    if kind == MapCluster.PHOTO:
+        objects = Photo.objects.exclude(geohash='')
+        if journey_id is not None:
+            objects = objects.filter(journey_id=journey_id)
+    else:
+        objects = Location.objects.exclude(geohash='')
+        if journey_id is not None:
+            objects = objects.filter(
+                id__in=JourneyLocationVisit.objects.filter(journey_id=journey_id).values('location_id'))
+
+    return objects
+
+
+def recompute_cell(kind, journey_id, precision, cell):
+    cluster_fields = {'kind': kind, 'scope': MapCluster.scope_of(journey_id)}
+    objects = scoped_objects(kind, journey_id).filter(geohash__gte=cell, geohash__lt=cell + '~')
+    stats = objects.aggregate(count=Count('id'), latitude=Avg('latitude'), longitude=Avg('longitude'))
+
+    if not stats['count']:
+        # Nothing left in this cell means nothing is left in any of its subcells either
+        MapCluster.objects.filter(precision__gte=precision, geohash__gte=cell, geohash__lt=cell + '~',
+                                  **cluster_fields).delete()
+        return False
+
+    representative = objects.order_by(*REPRESENTATIVE_ORDERING[kind]).values_list('id', flat=True).first()
+
+    MapCluster.objects.update_or_create(precision=precision, geohash=cell, defaults={
+        'journey_id': journey_id,
+        'count': stats['count'],
+        'latitude': float(stats['latitude']),
+        'longitude': float(stats['longitude']),
+        'photo_id': representative if kind == MapCluster.PHOTO else None,
+        'location_id': representative if kind == MapCluster.LOCATION else None,
+    }, **cluster_fields)
+
+    return True
+
+
+@transaction.atomic
+def recompute_cells(cells):
+    if len(cells) > CLUSTER_UPDATE_MAX_CELLS:
+        rebuild_clusters()
+        return
+
+    # Parents first, so that the subcells of a cell that turned out empty are already gone
+    emptied = set()
+    for kind, journey_id, precision, cell in sorted(cells, key=lambda cell: cell[2]):
+        if any((kind, journey_id, cell[:length]) in emptied for length in range(1, precision)):
+            continue
+
+        if not recompute_cell(kind, journey_id, precision, cell):
+            emptied.add((kind, journey_id, cell))
+
+
+class PendingCells:
+    # The cells changed in one transaction, recomputed once after it commits
+    def __init__(self):
+        self.cells = set()
+
+    def __call__(self):
+        recompute_cells(self.cells)
+
+
+def schedule_cells(kind, journey_id, geohash):
+    # Saves in the same transaction share one recomputation of every cell they touched, which also covers the cells
+    # that nearby objects have in common. Outside of a transaction, on_commit() runs it right away.
+    using = router.db_for_write(MapCluster)
+    pending = next((func for _, func in transaction.get_connection(using).run_on_commit
+                    if isinstance(func, PendingCells)), None)
+    cells = {(kind, journey_id, precision, geohash[:precision]) for precision in range(1, CLUSTER_MAX_PRECISION + 1)}
+
+    if pending is None:
+        pending = PendingCells()
+        pending.cells = cells
+        transaction.on_commit(pending, using=using)
+    else:
+        pending.cells |= cells
+
+
+def cluster_state(instance):
+    model = type(instance)
+
+    if model is Photo:
+        return model.objects.filter(pk=instance.pk).values_list('journey_id', 'geohash', 'confidentiality',
+                                                                'timestamp').first()
+    if model is Location:
+        state = model.objects.filter(pk=instance.pk).values_list('geohash', 'name').first()
+        if state is None:
+            return None
+
+        journeys = JourneyLocationVisit.objects.filter(location_id=instance.pk).values_list('journey_id', flat=True)
+        return state + (frozenset(journeys),)
+    if model is JourneyLocationVisit:
+        return model.objects.filter(pk=instance.pk).values_list('journey_id', 'location__geohash').first()
+
+    return None
+
+
+def update_clusters(model, old_state, new_state):
+    if old_state == new_state:
+        return
+
+    cells = set()
+
+    for state in (old_state, new_state):
+        if state is None:
+            continue
+
+        if model is Photo:
+            journey_id, geohash = state[0], state[1]
+            cells.update((MapCluster.PHOTO, scope, geohash) for scope in {None, journey_id})
+        elif model is Location:
+            geohash, journeys = state[0], state[2]
+            cells.update((MapCluster.LOCATION, scope, geohash) for scope in journeys | {None})
+        elif model is JourneyLocationVisit:
+            journey_id, geohash = state
+            cells.add((MapCluster.LOCATION, journey_id, geohash))
+
+    for kind, journey_id, geohash in cells:
+        if geohash:
+            schedule_cells(kind, journey_id, geohash)
+
+
+def update_location_clusters(geohashes):
+    # For saves that bypass the signals: geohashes maps the ids of changed locations, or None for new ones, to their
+    # old and new geohashes
+    journeys = defaultdict(set)
+    visits = (JourneyLocationVisit.objects.filter(location_id__in=set(geohashes) - {None}).order_by()
+              .values_list('location_id', 'journey_id').distinct())
+    for location_id, journey_id in visits:
+        journeys[location_id].add(journey_id)
+
+    for location_id, location_geohashes in geohashes.items():
+        for geohash in location_geohashes:
+            if geohash:
+                for journey_id in journeys[location_id] | {None}:
+                    schedule_cells(MapCluster.LOCATION, journey_id, geohash)
+
+
+def accumulate(clusters, kind, journey_id, geohash, latitude, longitude, rank, object_id):
+    for precision in range(1, CLUSTER_MAX_PRECISION + 1):
+        cluster = clusters[(kind, journey_id, precision, geohash[:precision])]
+        cluster['count'] += 1
+        cluster['latitude'] += float(latitude)
+        cluster['longitude'] += float(longitude)
+
+        if cluster['rank'] is None or rank < cluster['rank']:
+            cluster['rank'] = rank
+            cluster['id'] = object_id
+
+
+@transaction.atomic
+def rebuild_clusters(batch_size=1000):
+    clusters = defaultdict(lambda: {'count': 0, 'latitude': 0.0, 'longitude': 0.0, 'rank': None, 'id': None})
+
+    photos = Photo.objects.exclude(geohash='').values_list('id', 'journey_id', 'geohash', 'latitude', 'longitude',
+                                                          'confidentiality', 'timestamp')
+    for photo_id, journey_id, geohash, latitude, longitude, confidentiality, timestamp in photos.iterator():
+        for scope in {None, journey_id}:
+            accumulate(clusters, MapCluster.PHOTO, scope, geohash, latitude, longitude,
+                       (confidentiality, timestamp, photo_id), photo_id)
+
+    locations = {
+        location_id: (geohash, latitude, longitude, name)
+        for location_id, geohash, latitude, longitude, name
+        in Location.objects.exclude(geohash='').values_list('id', 'geohash', 'latitude', 'longitude', 'name')
+    }
+    for location_id, (geohash, latitude, longitude, name) in locations.items():
+        accumulate(clusters, MapCluster.LOCATION, None, geohash, latitude, longitude, (name, location_id), location_id)
+
+    visited = (JourneyLocationVisit.objects.exclude(location=None).order_by()
+               .values_list('journey_id', 'location_id').distinct())
+    for journey_id, location_id in visited:
+        if location_id in locations:
+            geohash, latitude, longitude, name = locations[location_id]
+            accumulate(clusters, MapCluster.LOCATION, journey_id, geohash, latitude, longitude, (name, location_id),
+                       location_id)
+
+    objects = [
+        MapCluster(
+            kind=kind, journey_id=journey_id, scope=MapCluster.scope_of(journey_id), precision=precision, geohash=cell,
+            count=cluster['count'], latitude=cluster['latitude'] / cluster['count'],
+            longitude=cluster['longitude'] / cluster['count'],
+            photo_id=cluster['id'] if kind == MapCluster.PHOTO else None,
+            location_id=cluster['id'] if kind == MapCluster.LOCATION else None
+        )
+        for (kind, journey_id, precision, cell), cluster in clusters.items()
+    ]
+
+    # Django 2.2 doesn't cap an explicit batch size to what the backend can take in a single query
+    ops = connections[router.db_for_write(MapCluster)].ops
+    batch_size = min(batch_size, ops.bulk_batch_size(MapCluster._meta.concrete_fields, objects) or batch_size)
+
+    MapCluster.objects.all().delete()
+    MapCluster.objects.bulk_create(objects, batch_size=batch_size)
+
+    return len(clusters)
+
+
+def clusters_for(kind, journey_id, zoom, bbox=None):
+    precision = zoom_precision(zoom)
+    clusters = MapCluster.objects.filter(kind=kind, scope=MapCluster.scope_of(journey_id), precision=precision)
+
+    if bbox is not None:
+        clusters = clusters.filter(bbox_q(*bbox, max_precision=precision))
+
+    if kind == MapCluster.PHOTO:
+        clusters = clusters.select_related('photo__journey')
+
+    return clusters.order_by('geohash')
@@ -0,0 +1,99 @@
+import threading
+import time
+import uuid
+
+from constance import settings as constance_settings
+from constance.backends.database import DatabaseBackend
+from django.conf import settings
+from django.db import OperationalError, ProgrammingError
+
+from . import metrics
+
+
+class CachedDatabaseBackend(DatabaseBackend):
+    # Keeps every constance value in process memory. Other processes learn about changes through a version row that
+    # is checked at most once per VERSION_CHECK_INTERVAL, and the values are reloaded at least once per TTL regardless.
+    version_key = '__version__'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._values = None
+        self._version = None
+        self._loaded_at = None
+        self._checked_at = None
+
+        super().__init__()
+
+    def get_version(self):
+        try:
+            return (self._model._default_manager.filter(key=self.add_prefix(self.version_key))
+                    .values_list('value', flat=True).first())
+        except (OperationalError, ProgrammingError):
+            return None
+
+    def bump_version(self):
+        version = uuid.uuid4().hex
+
+        try:
+            self._model._default_manager.update_or_create(key=self.add_prefix(self.version_key),
+                                                          defaults={'value': version})
+        except (OperationalError, ProgrammingError):
+            return None
+
+        return version
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+
+    def get_values(self):
+        options = settings.JOURNEYLOG
+        now = time.monotonic()
+
+        with self._lock:
+            if self._values is not None and now - self._loaded_at < options['CONSTANCE_CACHE_TTL']:
+                if now - self._checked_at < options['CONSTANCE_VERSION_CHECK_INTERVAL']:
+                    metrics.increment('journeylog_cache_requests_total', cache='settings', result='hit')
+                    return self._values
+
+                self._checked_at = now
+                version = self.get_version()
+                if version == self._version:
+                    metrics.increment('journeylog_cache_requests_total', cache='settings', result='hit')
+                    return self._values
+            else:
+                version = self.get_version()
+
+            metrics.increment('journeylog_cache_requests_total', cache='settings', result='miss')
+            self._values = dict(super().mget(constance_settings.CONFIG))
+            self._version = version
+            self._loaded_at = self._checked_at = now
+
+            return self._values
+
+    def mget(self, keys):
+        values = self.get_values()
+
+        for key in keys:
+            if key in values:
+                yield key, values[key]
+
+    def get(self, key):
+        return self.get_values().get(key)
+
+    def clear(self, sender, instance, created, **kwargs):
+        if instance.key == self.add_prefix(self.version_key):
+            return
+
+        super().clear(sender, instance, created, **kwargs)
+
+        previous_version = self.get_version()
+        version = self.bump_version()
+
+        with self._lock:
+            if self._values is not None and version is not None and previous_version == self._version:
+                # Nobody else changed anything since the last load, so this process can keep its copy
+                self._values[instance.key[len(self._prefix):]] = instance.value
+                self._version = version
+            else:
+                self._values = None
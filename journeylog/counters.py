@@ -0,0 +1,124 @@
+from django.db import transaction
+from django.db.models import F, Q, Count, Sum, Min, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import Journey, JournalPage, Photo, JourneyLocationVisit
+
+
+def counter_state(instance):
+    model = type(instance)
+
+    if model is Photo:
+        return model.objects.filter(pk=instance.pk).values_list('journey_id', 'filesize', 'timestamp').first()
+    if model is JournalPage:
+        return model.objects.filter(pk=instance.pk).values_list('journey_id').first()
+    if model is JourneyLocationVisit:
+        return model.objects.filter(pk=instance.pk).values_list('journey_id', 'location_id').first()
+
+    return None
+
+
+def current_state(instance):
+    model = type(instance)
+
+    if model is Photo:
+        return instance.journey_id, instance.filesize, instance.timestamp
+    if model is JournalPage:
+        return instance.journey_id,
+    if model is JourneyLocationVisit:
+        return instance.journey_id, instance.location_id
+
+    return None
+
+
+def refresh_photo_range(journey_id):
+    photos = Photo.objects.filter(journey_id=journey_id).order_by()
+
+    Journey.objects.filter(id=journey_id).update(
+        photos_date_start=photos.order_by('timestamp').values_list('timestamp', flat=True).first(),
+        photos_date_end=photos.order_by('-timestamp').values_list('timestamp', flat=True).first(),
+    )
+
+
+def is_visited(journey_id, location_id, exclude_pk=None):
+    return (JourneyLocationVisit.objects.filter(journey_id=journey_id, location_id=location_id)
+            .exclude(pk=exclude_pk).exists())
+
+
+def update_photo_counters(old_state, new_state):
+    if old_state is not None and old_state[0] is not None:
+        journey_id, filesize, timestamp = old_state
+        Journey.objects.filter(id=journey_id).update(photos_count=F('photos_count') - 1,
+                                                     photos_filesize_total=F('photos_filesize_total') - filesize)
+        # Taking a photo out might shrink the date range, which can't be worked out from the old bounds alone
+        refresh_photo_range(journey_id)
+
+    if new_state is not None and new_state[0] is not None:
+        journey_id, filesize, timestamp = new_state
+        journeys = Journey.objects.filter(id=journey_id)
+        journeys.update(photos_count=F('photos_count') + 1,
+                        photos_filesize_total=F('photos_filesize_total') + filesize)
+        journeys.filter(Q(photos_date_start=None) | Q(photos_date_start__gt=timestamp)).update(
+            photos_date_start=timestamp)
+        journeys.filter(Q(photos_date_end=None) | Q(photos_date_end__lt=timestamp)).update(photos_date_end=timestamp)
+
+
+def update_journal_page_counters(old_state, new_state):
+    for state, delta in ((old_state, -1), (new_state, 1)):
+        if state is not None:
+            Journey.objects.filter(id=state[0]).update(journal_pages_count=F('journal_pages_count') + delta)
+
+
+def update_visit_counters(pk, old_state, new_state):
+    if old_state is not None and old_state[1] is not None:
+        journey_id, location_id = old_state
+        if not is_visited(journey_id, location_id):
+            Journey.objects.filter(id=journey_id).update(visited_locations_count=F('visited_locations_count') - 1)
+
+    if new_state is not None and new_state[1] is not None:
+        journey_id, location_id = new_state
+        if not is_visited(journey_id, location_id, exclude_pk=pk):
+            Journey.objects.filter(id=journey_id).update(visited_locations_count=F('visited_locations_count') + 1)
+
+
+@transaction.atomic
+def update_counters(instance, old_state, new_state):
+    if old_state == new_state:
+        return
+
+    model = type(instance)
+
+    if model is Photo:
+        update_photo_counters(old_state, new_state)
+    elif model is JournalPage:
+        update_journal_page_counters(old_state, new_state)
+    elif model is JourneyLocationVisit:
+        update_visit_counters(instance.pk, old_state, new_state)
+
+
+def counter_expressions():
+    def aggregate(queryset, expression):
+        return Subquery(queryset.filter(journey_id=OuterRef('pk')).order_by().values('journey_id')
+                        .annotate(value=expression).values('value'))
+
+    photos = Photo.objects.all()
+
+    return {
+        'journal_pages_count': Coalesce(aggregate(JournalPage.objects.all(), Count('id')), Value(0)),
+        'photos_count': Coalesce(aggregate(photos, Count('id')), Value(0)),
+        'photos_filesize_total': Coalesce(aggregate(photos, Sum('filesize')), Value(0)),
+        'photos_date_start': aggregate(photos, Min('timestamp')),
+        'photos_date_end': aggregate(photos, Max('timestamp')),
+        'visited_locations_count': Coalesce(aggregate(JourneyLocationVisit.objects.all(),
+                                                      Count('location_id', distinct=True)), Value(0)),
+    }
+
+
+@transaction.atomic
+def recount_journeys(journey_ids=None):
+    # For repairs and after bulk operations, which don't send the signals that keep the counters up to date
+    journeys = Journey.objects.all()
+    if journey_ids is not None:
+        journeys = journeys.filter(id__in=journey_ids)
+
+    return journeys.update(**counter_expressions())
@@ -0,0 +1,83 @@
+from collections import defaultdict
+
+from .models import Photo
+
+DUPLICATE_MAX_DISTANCE = 6
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    # Nodes are (key, items, children by distance). By the triangle inequality, a search only has to descend into the
+    # children whose distance to their parent is within the radius of the distance between the query and the parent.
+    def __init__(self):
+        self.root = None
+
+    def add(self, key, item):
+        if self.root is None:
+            self.root = (key, [item], {})
+            return
+
+        node = self.root
+        while True:
+            distance = hamming_distance(key, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+
+            if distance not in node[2]:
+                node[2][distance] = (key, [item], {})
+                return
+
+            node = node[2][distance]
+
+    def search(self, key, radius):
+        results = []
+        nodes = [self.root] if self.root is not None else []
+
+        while nodes:
+            node_key, items, children = nodes.pop()
+            distance = hamming_distance(key, node_key)
+
+            if distance <= radius:
+                results.extend(items)
+
+            nodes.extend(child for edge, child in children.items() if distance - radius <= edge <= distance + radius)
+
+        return results
+
+
+def duplicate_groups(hashes, max_distance=DUPLICATE_MAX_DISTANCE):
+    # Items within max_distance of each other, directly or through a chain of others, end up in the same group
+    entries = [(item, int(value, 16)) for item, value in hashes]
+    tree = BKTree()
+    for item, key in entries:
+        tree.add(key, item)
+
+    parents = {item: item for item, key in entries}
+
+    def find(item):
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    for item, key in entries:
+        for other in tree.search(key, max_distance):
+            parents[find(other)] = find(item)
+
+    groups = defaultdict(list)
+    for item, key in entries:
+        groups[find(item)].append(item)
+
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def journey_duplicate_groups(journey_id, max_distance=DUPLICATE_MAX_DISTANCE):
+    photos = {photo.id: photo for photo in Photo.objects.filter(journey_id=journey_id).exclude(perceptual_hash='')
+              .select_related('journey')}
+    groups = duplicate_groups(((photo.id, photo.perceptual_hash) for photo in photos.values()), max_distance)
+
+    return [[photos[photo_id] for photo_id in group] for group in groups]
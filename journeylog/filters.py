@@ -1,9 +1,77 @@
-from django_filters.rest_framework import FilterSet, IsoDateTimeFilter, Filter
+import operator
+from functools import reduce
 
+from constance import config
+from django.db.models import Q
+from django_filters.rest_framework import FilterSet, IsoDateTimeFilter, Filter, NumberFilter, BaseCSVFilter
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import SearchFilter
+
+from . import search
 from .models import Photo, Location
+from .util.geo import bbox_q, radius_bbox, haversine_expression
+
+DEFAULT_NEAR_RADIUS = 1000
+
+
+class NumberCSVFilter(BaseCSVFilter, NumberFilter):
+    pass
+
+
+class IndexedSearchFilter(SearchFilter):
+    # Full words from the search index, the last one also as a prefix, or substrings of the view's search_fields, such
+    # as a part of a filename that the index splits differently
+    def filter_queryset(self, request, queryset, view):
+        terms = search.query_terms(request.query_params.get(self.search_param, ''))
+        substrings = self.get_search_terms(request)
+        search_fields = self.get_search_fields(view, request) or ()
+
+        if not terms and not (search_fields and substrings):
+            return queryset
+
+        matches = []
+        if terms:
+            documents = search.search_documents(terms, kinds=[view.search_document_kind], prefix=True)
+            matches.append(Q(id__in=documents.values('object_id')))
+        if search_fields and substrings:
+            matches.append(reduce(operator.and_, [
+                reduce(operator.or_, [Q(**{field + '__icontains': substring}) for field in search_fields])
+                for substring in substrings
+            ]))
+
+        return queryset.filter(reduce(operator.or_, matches))
+
+
+class GeoFilterMixin(FilterSet):
+    bbox = NumberCSVFilter(method='filter_bbox', help_text='south,west,north,east')
+    near = NumberCSVFilter(method='filter_near', help_text='latitude,longitude')
+    # Only read by filter_near
+    radius = NumberFilter(method='filter_radius', help_text='Radius around near in meters')
 
+    def filter_bbox(self, queryset, name, value):
+        if len(value) != 4:
+            raise ValidationError({name: 'Expected four comma-separated values: south,west,north,east.'})
 
-class PhotoFilter(FilterSet):
+        south, west, north, east = map(float, value)
+        return queryset.filter(bbox_q(south, west, north, east))
+
+    def filter_near(self, queryset, name, value):
+        if len(value) != 2:
+            raise ValidationError({name: 'Expected two comma-separated values: latitude,longitude.'})
+
+        latitude, longitude = map(float, value)
+        radius = float(self.form.cleaned_data.get('radius') or DEFAULT_NEAR_RADIUS)
+
+        return (queryset.filter(bbox_q(*radius_bbox(latitude, longitude, radius)))
+                .annotate(distance=haversine_expression(latitude, longitude))
+                .filter(distance__lte=radius)
+                .order_by('distance', 'id'))
+
+    def filter_radius(self, queryset, name, value):
+        return queryset
+
+
+class PhotoFilter(GeoFilterMixin, FilterSet):
     after = IsoDateTimeFilter(field_name='timestamp', lookup_expr='gte')
     before = IsoDateTimeFilter(field_name='timestamp', lookup_expr='lt')
     journey = Filter(field_name='journey__slug')
@@ -12,8 +80,20 @@ class PhotoFilter(FilterSet):
         model = Photo
         fields = []
 
+    def filter_bbox(self, queryset, name, value):
+        if not config.EXPOSE_GPS:
+            return queryset.none()
+
+        return super().filter_bbox(queryset, name, value)
+
+    def filter_near(self, queryset, name, value):
+        if not config.EXPOSE_GPS:
+            return queryset.none()
+
+        return super().filter_near(queryset, name, value)
+
 
-class LocationFilter(FilterSet):
+class LocationFilter(GeoFilterMixin, FilterSet):
     journey = Filter(field_name='visits__journey__slug')
 
     class Meta:
@@ -0,0 +1,205 @@
+import csv
+import io
+import os
+import time
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+
+from django.db import transaction, connections, router
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .caching import log_purge
+from .models import Journey, JourneyMapPointVisit
+from .util.geo import geohash_encode_many
+
+TRACK_FORMATS = ('gpx', 'kml', 'csv')
+TRACK_IMPORT_BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 20
+
+TrackImportResult = namedtuple('TrackImportResult', ('imported', 'skipped', 'errors', 'duration'))
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def iterparse_elements(file, names):
+    # Elements are detached from their parents as soon as they have been handled, so that memory use stays flat
+    # regardless of the size of the document.
+    parents = []
+
+    for event, element in ElementTree.iterparse(file, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+
+        parents.pop()
+
+        if local_name(element.tag) in names:
+            yield element
+
+            if parents:
+                parents[-1].remove(element)
+            element.clear()
+
+
+def iter_gpx_points(file):
+    # Waypoints are unordered points of interest rather than a part of the way, so they are never imported. Routes are
+    # planned instead of recorded, and only stand in for the track of files that have none.
+    has_track = False
+    route_points = []
+
+    for element in iterparse_elements(file, ('trkpt', 'rtept', 'wpt')):
+        tag = local_name(element.tag)
+        if tag == 'wpt' or (tag == 'rtept' and has_track):
+            continue
+
+        when = next((child.text for child in element if local_name(child.tag) == 'time'), None)
+        point = (element.get('lat'), element.get('lon'), when)
+
+        if tag == 'trkpt':
+            has_track = True
+            yield point
+        else:
+            route_points.append(point)
+
+    if not has_track:
+        yield from route_points
+
+
+def kml_coordinates(text, separator=None):
+    # KML lists the longitude first. Malformed coordinates are passed on as missing, so that the row validation counts
+    # the point as skipped instead of failing the import.
+    values = (text or '').strip().split(separator)
+    return (values[1], values[0]) if len(values) >= 2 else (None, None)
+
+
+def iter_kml_points(file):
+    for element in iterparse_elements(file, ('Track', 'Placemark')):
+        if local_name(element.tag) == 'Track':
+            # <gx:Track> lists all <when> elements and all <gx:coord> elements in the same order
+            whens = [child.text for child in element if local_name(child.tag) == 'when']
+            coords = [child.text for child in element if local_name(child.tag) == 'coord']
+
+            for when, coord in zip(whens, coords):
+                yield kml_coordinates(coord) + (when,)
+        else:
+            when = next((e.text for e in element.iter() if local_name(e.tag) == 'when'), None)
+            coordinates = next((e.text for e in element.iter() if local_name(e.tag) == 'coordinates'), None)
+
+            if when is not None and coordinates is not None:
+                yield kml_coordinates(coordinates, ',') + (when,)
+
+
+def iter_csv_points(file):
+    reader = csv.DictReader(io.TextIOWrapper(file, encoding='utf-8-sig', newline=''))
+
+    for row in reader:
+        yield row.get('latitude'), row.get('longitude'), row.get('timestamp')
+
+
+TRACK_PARSERS = {
+    'gpx': iter_gpx_points,
+    'kml': iter_kml_points,
+    'csv': iter_csv_points,
+}
+
+
+def guess_track_format(filename):
+    extension = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    return extension if extension in TRACK_FORMATS else None
+
+
+def convert_batch(rows, errors):
+    latitudes = []
+    longitudes = []
+    timestamps = []
+
+    for number, (latitude, longitude, when) in rows:
+        try:
+            point_latitude = float(latitude)
+            point_longitude = float(longitude)
+            timestamp = parse_datetime(when.strip())
+            valid = timestamp is not None and -90 <= point_latitude <= 90 and -180 <= point_longitude <= 180
+        except (AttributeError, TypeError, ValueError):
+            valid = False
+
+        if not valid:
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append('Point {}: invalid coordinates or timestamp ({}, {}, {})'.format(
+                    number, latitude, longitude, when))
+            continue
+
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp, timezone.utc)
+
+        latitudes.append(round(point_latitude, 6))
+        longitudes.append(round(point_longitude, 6))
+        timestamps.append(timestamp)
+
+    return latitudes, longitudes, timestamps, geohash_encode_many(latitudes, longitudes)
+
+
+def insert_points(journey, latitudes, longitudes, timestamps, geohashes):
+    # Geohashes are already filled in, and bulk_create() sets the auto_now timestamps
+    points = [
+        JourneyMapPointVisit(journey=journey, latitude=latitude, longitude=longitude, timestamp=timestamp,
+                             geohash=geohash)
+        for latitude, longitude, timestamp, geohash in zip(latitudes, longitudes, timestamps, geohashes)
+    ]
+
+    # Django 2.2 doesn't cap an explicit batch size to what the backend can take in a single query
+    ops = connections[router.db_for_write(JourneyMapPointVisit)].ops
+    batch_size = ops.bulk_batch_size(JourneyMapPointVisit._meta.concrete_fields, points) or None
+
+    JourneyMapPointVisit.objects.bulk_create(points, batch_size=batch_size)
+
+
+def delete_points(journey):
+    # A single DELETE without signals; delete() would fetch every point to send post_delete for it, and each of those
+    # signals bumps the track version that the import bumps once at the end anyway. Nothing refers to map points, so
+    # there are no cascades to skip.
+    points = JourneyMapPointVisit.objects.filter(journey=journey)
+    points._raw_delete(points.db)
+
+
+@transaction.atomic
+def import_track(journey, file, track_format, replace=False, batch_size=TRACK_IMPORT_BATCH_SIZE):
+    started = time.monotonic()
+
+    if replace:
+        delete_points(journey)
+
+    imported = 0
+    skipped = 0
+    errors = []
+    rows = []
+
+    def flush():
+        nonlocal imported, skipped
+
+        points = convert_batch(rows, errors)
+        insert_points(journey, *points)
+
+        imported += len(points[0])
+        skipped += len(rows) - len(points[0])
+        rows.clear()
+
+    try:
+        for number, row in enumerate(TRACK_PARSERS[track_format](file), start=1):
+            rows.append((number, row))
+
+            if len(rows) >= batch_size:
+                flush()
+
+        flush()
+    except (ElementTree.ParseError, csv.Error, UnicodeDecodeError) as e:
+        raise ValueError('Could not parse the {} file: {}'.format(track_format.upper(), e))
+
+    # Bulk inserts don't send signals, so cached tracks have to be invalidated by hand
+    Journey.objects.filter(id=journey.id).update(map_points_version=F('map_points_version') + 1)
+    log_purge({'journey-{}'.format(journey.id)})
+
+    return TrackImportResult(imported, skipped, errors, time.monotonic() - started)
@@ -0,0 +1,140 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+
+class RequestTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.durations = {}
+
+    def add(self, name, duration):
+        self.durations[name] = self.durations.get(name, 0.0) + duration
+
+    def execute_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.add('db', time.perf_counter() - started)
+
+
+def current_timings():
+    return getattr(_state, 'timings', None)
+
+
+def record(name, duration):
+    timings = current_timings()
+    if timings is not None:
+        timings.add(name, duration)
+
+
+@contextmanager
+def timed(name):
+    # Free outside instrumented requests, so it can wrap code that also runs in commands
+    if current_timings() is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def route_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else None
+
+
+def request_budget(route):
+    budgets = settings.JOURNEYLOG['REQUEST_BUDGETS']
+    return budgets.get(route, budgets.get('*', (None, None)))
+
+
+def server_timing_header(timings, total):
+    entries = ['{};dur={:.1f}'.format(name, duration * 1000) for name, duration in sorted(timings.durations.items())]
+    entries.append('total;dur={:.1f}'.format(total * 1000))
+    entries.append('queries;desc="{}"'.format(timings.queries))
+
+    return ', '.join(entries)
+
+
+class RequestInstrumentationMiddleware:
+    # Measures database, rendering and thumbnail time per request, reports them in a Server-Timing header and a JSON
+    # log line, and warns about requests that go over the query or time budget of their route. Also feeds the request
+    # metrics when those are enabled.
+    def __init__(self, get_response):
+        self.report = settings.JOURNEYLOG['REQUEST_INSTRUMENTATION']
+        self.metrics = metrics.metrics_enabled()
+        if not self.report and not self.metrics:
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        _state.timings = timings
+
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings.execute_query))
+
+                response = self.get_response(request)
+        finally:
+            _state.timings = None
+
+        total = time.perf_counter() - timings.started
+        route = route_name(request)
+
+        if self.metrics:
+            metrics.observe('journeylog_request_duration_seconds', total, route=route or '', method=request.method)
+            metrics.increment('journeylog_db_queries_total', timings.queries, route=route or '')
+
+        if not self.report:
+            return response
+
+        query_budget, time_budget = request_budget(route)
+        over_budget = [name for name, value, budget in (('queries', timings.queries, query_budget),
+                                                        ('time', total * 1000, time_budget))
+                       if budget is not None and value > budget]
+
+        response['Server-Timing'] = server_timing_header(timings, total)
+
+        logger.log(logging.WARNING if over_budget else logging.INFO, json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+            'queries': timings.queries,
+            'durations_ms': {name: round(duration * 1000, 1) for name, duration in timings.durations.items()},
+            'over_budget': over_budget,
+        }, sort_keys=True))
+
+        return response
+
+    def process_template_response(self, request, response):
+        # Called right before the response is rendered, which for API views is the JSON serialization
+        timings = current_timings()
+        if timings is not None:
+            started = time.perf_counter()
+            response.add_post_render_callback(lambda rendered: timings.add('render', time.perf_counter() - started))
+
+        return response
@@ -0,0 +1,73 @@
+import json
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment, override_settings
+from django.utils import timezone
+
+from journeylog.benchmarks import BenchmarkRunner, generate_fixtures, benchmark_environment, compare_results
+from journeylog.models import Journey
+
+
+class Command(BaseCommand):
+    help = 'Times the main API endpoints, image serving and thumbnail generation on generated data, and checks their ' \
+           'query counts against fixed budgets. Runs against a temporary test database and storage directory.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--journeys', type=int, default=2)
+        parser.add_argument('--photos', type=int, default=500, help='Photos per journey')
+        parser.add_argument('--pages', type=int, default=20, help='Journal pages per journey')
+        parser.add_argument('--locations', type=int, default=100, help='Locations, and visits per journey')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--compare', help='JSON results of an earlier run to compare the medians with')
+
+    def handle(self, *args, **options):
+        if min(options['journeys'], options['photos'], options['pages'], options['locations'], options['repeat']) < 1:
+            raise CommandError('All counts must be at least 1.')
+
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)['results']
+
+        parameters = {name: options[name] for name in ('journeys', 'photos', 'pages', 'locations', 'seed', 'repeat')}
+
+        setup_test_environment()
+        database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+        try:
+            with tempfile.TemporaryDirectory() as directory, override_settings(BASE_DIR=directory):
+                generate_fixtures(options['journeys'], options['photos'], options['pages'], options['locations'],
+                                  options['seed'])
+                results = BenchmarkRunner(options['repeat']).run(Journey.objects.order_by('id').first())
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'parameters': parameters,
+            'environment': benchmark_environment(),
+            'results': results,
+        }
+        ratios = compare_results(results, previous) if previous is not None else {}
+        if previous is not None:
+            report['compared_to'] = options['compare']
+
+        for result in results:
+            self.stdout.write('{:<22} median {:9.2f} ms  min {:9.2f} ms  {:>4} queries{}{}'.format(
+                result['name'], result['median_ms'], result['min_ms'], result['queries'],
+                '' if result['within_budget'] else ' (budget {})'.format(result['query_budget']),
+                '  x{:.2f}'.format(ratios[result['name']]) if result['name'] in ratios else ''))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+        over_budget = [result['name'] for result in results if not result['within_budget']]
+        if over_budget:
+            raise CommandError('Over the query budget: {}'.format(', '.join(over_budget)))
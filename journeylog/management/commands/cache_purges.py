@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from journeylog.models import CachePurge
+
+
+class Command(BaseCommand):
+    help = 'Prints the surrogate keys of cached public API responses that became stale, one "<id> <key>" per line, ' \
+           'for a script that purges them from a reverse proxy.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=int, default=0, help='Only print entries after this id')
+        parser.add_argument('--prune-days', type=int, help='Delete entries older than this many days instead')
+
+    def handle(self, *args, **options):
+        if options['prune_days'] is not None:
+            cutoff = timezone.now() - timedelta(days=options['prune_days'])
+            count, _ = CachePurge.objects.filter(created_at__lt=cutoff).delete()
+            self.stdout.write(self.style.SUCCESS('Deleted {} entries.'.format(count)))
+            return
+
+        entries = CachePurge.objects.filter(id__gt=options['since']).values_list('id', 'key')
+        for entry_id, key in entries.iterator():
+            self.stdout.write('{} {}'.format(entry_id, key))
@@ -0,0 +1,39 @@
+import os
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+
+from journeylog.models import Photo
+from journeylog.util.storage import content_addressed_enabled, ADOPTED, DEDUPLICATED, LINKED, CONFLICT, MISSING
+
+
+class Command(BaseCommand):
+    help = 'Moves photos and thumbnails into the content-addressed store under storage/objects, replacing duplicate ' \
+           'files in the journey directories with hard links to a single copy. Safe to run repeatedly.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not content_addressed_enabled():
+            self.stderr.write('CONTENT_ADDRESSED_STORAGE is off; files will be linked, but new thumbnails will still be '
+                              'generated per journey.')
+
+        results = Counter()
+        saved = 0
+
+        for photo in Photo.objects.exclude(hash='').only('id', 'journey_id', 'filename', 'confidentiality', 'hash') \
+                .order_by('id').iterator(chunk_size=options['batch_size']):
+            for kind, result in photo.store_content_addressed().items():
+                results[result] += 1
+
+                if result == DEDUPLICATED:
+                    saved += os.path.getsize(photo.get_shared_file_path(kind))
+                elif result == CONFLICT:
+                    self.stderr.write('Photo {} shares its hash with a file of another size, left as is: {}'.format(
+                        photo.id, photo.get_storage_file_path(kind)))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Adopted {adopted} files, deduplicated {deduplicated}, already linked {linked}, {conflict} conflicts, '
+            '{missing} missing. Saved {saved} bytes.'.format(saved=saved, **{
+                key: results[key] for key in (ADOPTED, DEDUPLICATED, LINKED, CONFLICT, MISSING)})))
@@ -0,0 +1,41 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from journeylog.models import Journey
+from journeylog.static_export import StaticExporter
+
+
+class Command(BaseCommand):
+    help = 'Exports the public API responses and public images of a journey as static files that a web server can ' \
+           'serve directly. See doc/example-apache-static.conf.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('journey', help='Slug of the journey')
+        parser.add_argument('output_dir')
+        parser.add_argument('--base-url', help='Scheme and host that links in the exported documents should use. '
+                                               'Defaults to the first of ALLOWED_HOSTS over HTTPS.')
+        parser.add_argument('--copy', action='store_true', help='Copy images instead of hard-linking them')
+
+    def handle(self, *args, **options):
+        try:
+            journey = Journey.objects.get(slug=options['journey'])
+        except Journey.DoesNotExist:
+            raise CommandError('Journey "{}" does not exist.'.format(options['journey']))
+
+        base_url = options['base_url']
+        if base_url is None:
+            if not settings.ALLOWED_HOSTS:
+                raise CommandError('Specify --base-url.')
+            base_url = 'https://{}'.format(settings.ALLOWED_HOSTS[0])
+
+        exporter = StaticExporter(os.path.abspath(options['output_dir']), base_url, link=not options['copy'])
+
+        try:
+            result = exporter.export_journey(journey)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS('Exported {} documents and {} images.'.format(
+            result.documents, result.images)))
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from journeylog.duplicates import journey_duplicate_groups, DUPLICATE_MAX_DISTANCE
+from journeylog.models import Journey, Photo
+
+
+class Command(BaseCommand):
+    help = 'Lists groups of visually similar photos in each journey, based on the perceptual hashes of their ' \
+           'thumbnails.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('journeys', nargs='*', help='Slugs of the journeys to check; all journeys by default')
+        parser.add_argument('--distance', type=int, default=DUPLICATE_MAX_DISTANCE,
+                            help='Largest number of differing hash bits between similar photos')
+        parser.add_argument('--compute', action='store_true',
+                            help='Generate missing thumbnails and hashes first')
+
+    def handle(self, *args, **options):
+        journeys = Journey.objects.order_by('slug')
+        if options['journeys']:
+            journeys = journeys.filter(slug__in=options['journeys'])
+            missing = set(options['journeys']) - set(journeys.values_list('slug', flat=True))
+            if missing:
+                raise CommandError('Unknown journeys: {}'.format(', '.join(sorted(missing))))
+
+        if options['compute']:
+            failed = 0
+            for photo in Photo.objects.filter(journey__in=journeys, perceptual_hash='').iterator():
+                try:
+                    photo.ensure_thumb()
+                except IOError:
+                    failed += 1
+
+            if failed:
+                self.stderr.write('Could not read the files of {} photos.'.format(failed))
+
+        for journey in journeys:
+            groups = journey_duplicate_groups(journey.id, options['distance'])
+            self.stdout.write('{}: {} groups'.format(journey.slug, len(groups)))
+
+            for group in groups:
+                self.stdout.write('  ' + ', '.join('{} ({})'.format(photo.filename, photo.id) for photo in group))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from journeylog.importers import import_track, guess_track_format, TRACK_FORMATS, TRACK_IMPORT_BATCH_SIZE
+from journeylog.models import Journey
+
+
+class Command(BaseCommand):
+    help = 'Imports the map points of a journey from a GPX, KML or CSV file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('journey', help='Slug of the journey')
+        parser.add_argument('file')
+        parser.add_argument('--format', choices=TRACK_FORMATS, help='Defaults to the file extension')
+        parser.add_argument('--replace', action='store_true', help='Remove existing map points of the journey first')
+        parser.add_argument('--batch-size', type=int, default=TRACK_IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            journey = Journey.objects.get(slug=options['journey'])
+        except Journey.DoesNotExist:
+            raise CommandError('Journey "{}" does not exist.'.format(options['journey']))
+
+        track_format = options['format'] or guess_track_format(options['file'])
+        if track_format is None:
+            raise CommandError('Could not tell the format of the file, please specify it with --format.')
+
+        try:
+            with open(options['file'], 'rb') as f:
+                result = import_track(journey, f, track_format, replace=options['replace'],
+                                      batch_size=options['batch_size'])
+        except (IOError, ValueError) as e:
+            raise CommandError(e)
+
+        for error in result.errors:
+            self.stderr.write(error)
+
+        self.stdout.write(self.style.SUCCESS('Imported {} points ({} skipped) in {:.2f} s, {:.0f} points/s.'.format(
+            result.imported, result.skipped, result.duration, result.imported / max(result.duration, 1e-6))))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from journeylog import clustering
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the precomputed map marker clusters of photos and locations from scratch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = clustering.rebuild_clusters(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Built {} clusters.'.format(count)))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from journeylog import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index of photos and journal pages from scratch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        count = search.rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS('Indexed {} objects.'.format(count)))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from journeylog import counters
+from journeylog.models import Journey
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the denormalised photo, journal page and visited location counters of journeys.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*', help='Only recount these journeys.')
+
+    def handle(self, *args, **options):
+        journey_ids = None
+
+        if options['slugs']:
+            journeys = dict(Journey.objects.filter(slug__in=options['slugs']).values_list('slug', 'id'))
+            missing = set(options['slugs']) - set(journeys)
+            if missing:
+                raise CommandError('Unknown journeys: {}'.format(', '.join(sorted(missing))))
+
+            journey_ids = list(journeys.values())
+
+        count = counters.recount_journeys(journey_ids)
+        self.stdout.write(self.style.SUCCESS('Recounted {} journeys.'.format(count)))
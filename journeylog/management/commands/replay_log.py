@@ -0,0 +1,57 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from journeylog.replay import parse_access_log, replay, summarize
+
+
+class Command(BaseCommand):
+    help = 'Replays the GET and HEAD requests of an Apache combined access log against the application in-process ' \
+           'and reports throughput and latency percentiles per route. Uses the configured database and storage.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('log', help='Access log in the Apache combined format')
+        parser.add_argument('--threads', type=int, default=4, help='Concurrent requests per process')
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--speed', type=float, default=0.0,
+                            help='Replay at this multiple of the original pace; 0 sends the requests back to back')
+        parser.add_argument('--host', help='Host header of the requests, by default the first of ALLOWED_HOSTS')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        if min(options['threads'], options['processes']) < 1 or options['speed'] < 0:
+            raise CommandError('Threads and processes must be at least 1 and the speed can\'t be negative.')
+
+        with open(options['log'], errors='replace') as f:
+            requests = parse_access_log(f)
+        if not requests:
+            raise CommandError('No requests to replay in {}.'.format(options['log']))
+
+        host = options['host'] or next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'),
+                                       'localhost')
+
+        started = time.perf_counter()
+        results = replay(requests, options['threads'], options['processes'], options['speed'], host)
+        duration = time.perf_counter() - started
+        summary = summarize(results, duration)
+
+        width = max(map(len, summary))
+        self.stdout.write('{:<{}} {:>7} {:>6} {:>8} {:>9} {:>9} {:>9}'.format(
+            'route', width, 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for route, result in summary.items():
+            self.stdout.write('{:<{}} {:>7} {:>6} {:>8.1f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                route, width, result['requests'], result['errors'], result['throughput'], result['p50_ms'],
+                result['p95_ms'], result['p99_ms']))
+        self.stdout.write('{} requests in {:.2f} s, {:.1f} req/s'.format(len(results), duration,
+                                                                         len(results) / duration))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'parameters': {name: options[name] for name in ('log', 'threads', 'processes', 'speed')},
+                    'requests': len(results),
+                    'duration_s': duration,
+                    'routes': summary,
+                }, f, indent=2, sort_keys=True)
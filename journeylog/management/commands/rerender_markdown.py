@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from journeylog.models import Journey, JournalPage
+from journeylog.util.markup import refresh_rendered_markdown
+
+
+class Command(BaseCommand):
+    help = 'Re-renders the stored HTML of journey descriptions and journal page texts whose Markdown or ' \
+           'MARKDOWN_EXTENSIONS changed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Re-render everything, even if it looks up to date')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        count = 0
+
+        for model in (Journey, JournalPage):
+            for source_field, html_field, hash_field in model.MARKDOWN_FIELDS:
+                changed = []
+                objects = model.objects.only('id', source_field, hash_field)
+
+                for obj in objects.iterator(chunk_size=options['batch_size']):
+                    if refresh_rendered_markdown(obj, source_field, html_field, hash_field, force=options['force']):
+                        changed.append(obj)
+                        count += 1
+
+                    if len(changed) >= options['batch_size']:
+                        model.objects.bulk_update(changed, [html_field, hash_field])
+                        changed.clear()
+
+                model.objects.bulk_update(changed, [html_field, hash_field])
+
+        self.stdout.write(self.style.SUCCESS('Re-rendered {} texts.'.format(count)))
@@ -0,0 +1,26 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from journeylog.storage_check import StorageVerifier, VERIFY_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Checks the photo files under storage/ against the hash, size and dimensions recorded in the database, ' \
+           'and lists files that belong to no photo. Problems are printed as one JSON object per line.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Also check files that are unchanged since their last successful check')
+        parser.add_argument('--jobs', type=int, help='Number of worker processes; defaults to the number of CPUs')
+        parser.add_argument('--batch-size', type=int, default=VERIFY_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        verifier = StorageVerifier(full=options['full'], jobs=options['jobs'], batch_size=options['batch_size'])
+
+        for problem in verifier.run():
+            self.stdout.write(json.dumps(problem, sort_keys=True))
+
+        # The summary goes to stderr so that stdout stays machine-readable
+        self.stderr.write('Checked {} files, skipped {} unchanged files, found {} problems.'.format(
+            verifier.checked, verifier.skipped, verifier.problems))
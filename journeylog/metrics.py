@@ -0,0 +1,266 @@
+import atexit
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks, and with an os.kill() that doesn't just probe, processes can't share the directory. Each one
+    # then only reports its own values.
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_FILENAME = 'archived.json'
+ARCHIVE_LOCK_FILENAME = 'archive.lock'
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS = {
+    'journeylog_request_duration_seconds': ('histogram', 'Time spent on requests, by view name.'),
+    'journeylog_db_queries_total': ('counter', 'Database queries run by requests, by view name.'),
+    'journeylog_thumbnail_generation_seconds': ('histogram', 'Time spent generating thumbnails.'),
+    'journeylog_image_bytes_served_total': ('counter', 'Bytes of image files served by the application.'),
+    'journeylog_cache_requests_total': ('counter', 'Lookups in the track and settings caches, by result.'),
+}
+
+
+def metrics_enabled():
+    return bool(settings.JOURNEYLOG['METRICS_DIR'])
+
+
+class ProcessMetrics:
+    # Values of the current process, written to <METRICS_DIR>/<pid>.json now and then. Every metric is a sum, so the
+    # endpoint adds up the files of all processes. Those of processes that are gone are folded into archived.json, so
+    # that totals survive worker restarts.
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.flushed_at = 0.0
+        self.directory = None
+
+    def increment(self, name, labels, value):
+        with self.lock:
+            self.counters[name, labels] += value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            histogram = self.histograms.setdefault((name, labels), [0] * (len(METRIC_BUCKETS) + 1) + [0.0])
+            histogram[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, values] for (name, labels), values in self.histograms.items()],
+            }
+
+    def flush(self, force=False):
+        if fcntl is None:
+            return
+
+        # Threads share the temporary file, so only one of them may write it at a time
+        with self.flush_lock:
+            now = time.monotonic()
+            if not force and now - self.flushed_at < settings.JOURNEYLOG['METRICS_FLUSH_INTERVAL']:
+                return
+
+            self.flushed_at = now
+            directory = settings.JOURNEYLOG['METRICS_DIR']
+            os.makedirs(directory, exist_ok=True)
+
+            path = os.path.join(directory, '{}.json'.format(self.pid))
+            if directory != self.directory:
+                # A file under our pid that we didn't write is left by an earlier process that had the same pid
+                if os.path.exists(path):
+                    archive_metrics(directory, [self.pid])
+                self.directory = directory
+
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+
+    def flush_quietly(self, force=False):
+        # Losing a flush only delays the numbers, which is no reason to fail the request that recorded them
+        try:
+            self.flush(force)
+        except OSError:
+            logger.warning('Could not write the metrics of process %s', self.pid, exc_info=True)
+
+
+_process_metrics = None
+_process_metrics_lock = threading.Lock()
+
+
+def process_metrics():
+    global _process_metrics
+
+    # A forked worker starts over instead of writing the values of its parent under its own pid
+    if _process_metrics is None or _process_metrics.pid != os.getpid():
+        with _process_metrics_lock:
+            if _process_metrics is None or _process_metrics.pid != os.getpid():
+                _process_metrics = ProcessMetrics()
+
+    return _process_metrics
+
+
+@atexit.register
+def flush_at_exit():
+    # Values recorded since the last flush would otherwise be lost with the process. Forked processes inherit the
+    # handler along with the values of their parent, which aren't theirs to write.
+    if _process_metrics is not None and _process_metrics.pid == os.getpid() and metrics_enabled():
+        _process_metrics.flush_quietly(force=True)
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def increment(name, value=1, **labels):
+    if metrics_enabled():
+        metrics = process_metrics()
+        metrics.increment(name, label_key(labels), value)
+        metrics.flush_quietly()
+
+
+def observe(name, value, **labels):
+    if metrics_enabled():
+        metrics = process_metrics()
+        metrics.observe(name, label_key(labels), value)
+        metrics.flush_quietly()
+
+
+def read_metrics(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def add_metrics(counters, histograms, data):
+    for name, labels, value in data['counters']:
+        counters[name, tuple(map(tuple, labels))] += value
+    for name, labels, values in data['histograms']:
+        total = histograms.setdefault((name, tuple(map(tuple, labels))), [0] * len(values))
+        for i, value in enumerate(values):
+            total[i] += value
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def archive_metrics(directory, pids):
+    # Adds the files of the given processes to archived.json and removes them. The lock file keeps processes that
+    # archive at the same time from losing each other's updates.
+    with open(os.path.join(directory, ARCHIVE_LOCK_FILENAME), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        counters = defaultdict(float)
+        histograms = {}
+        archive_path = os.path.join(directory, ARCHIVE_FILENAME)
+        paths = [os.path.join(directory, '{}.json'.format(pid)) for pid in pids]
+
+        for path in [archive_path] + paths:
+            data = read_metrics(path)
+            if data is not None:
+                add_metrics(counters, histograms, data)
+
+        with open(archive_path + '.tmp', 'w') as f:
+            json.dump({
+                'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                'histograms': [[name, labels, values] for (name, labels), values in histograms.items()],
+            }, f)
+        os.replace(archive_path + '.tmp', archive_path)
+
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def collect():
+    if fcntl is None:
+        counters = defaultdict(float)
+        histograms = {}
+        add_metrics(counters, histograms, process_metrics().snapshot())
+        return counters, histograms
+
+    process_metrics().flush(force=True)
+
+    directory = settings.JOURNEYLOG['METRICS_DIR']
+    pids = [int(filename[:-len('.json')]) for filename in os.listdir(directory)
+            if filename.endswith('.json') and filename[:-len('.json')].isdigit()]
+    gone = [pid for pid in pids if pid != os.getpid() and not process_alive(pid)]
+    if gone:
+        archive_metrics(directory, gone)
+
+    counters = defaultdict(float)
+    histograms = {}
+
+    for filename in os.listdir(directory):
+        if filename.endswith('.json'):
+            data = read_metrics(os.path.join(directory, filename))
+            if data is not None:
+                add_metrics(counters, histograms, data)
+
+    return counters, histograms
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                    for name, value in labels))
+
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def exposition():
+    # Prometheus text exposition format, version 0.0.4
+    counters, histograms = collect()
+    lines = []
+
+    for name, (kind, description) in METRICS.items():
+        lines += ['# HELP {} {}'.format(name, description), '# TYPE {} {}'.format(name, kind)]
+
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), format_number(value)))
+            continue
+
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+
+            cumulative = 0
+            for bound, count in zip(METRIC_BUCKETS + ('+Inf',), values[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, le=bound), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_number(values[-1])))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), cumulative))
+
+    return '\n'.join(lines) + '\n'
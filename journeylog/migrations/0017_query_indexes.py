@@ -0,0 +1,45 @@
+# Generated by Django 2.2.24 on 2026-10-19 14:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journeylog', '0016_searchdocument_searchterm'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='journalpage',
+            index=models.Index(fields=['journey', 'order_no', 'date_start'], name='journalpage_journey_order_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='journey',
+            index=models.Index(fields=['date_start', 'name'], name='journey_date_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='journeylocationvisit',
+            index=models.Index(fields=['journey', 'timestamp'], name='locationvisit_journey_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='journeymappointvisit',
+            index=models.Index(fields=['journey', 'timestamp'], name='mappointvisit_journey_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['name'], name='location_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='locationname',
+            index=models.Index(fields=['sort_key', 'location', 'name'], name='locationname_sort_key_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['timestamp', 'name'], name='photo_timestamp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['journey', 'timestamp', 'name'], name='photo_journey_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.24 on 2026-10-19 14:23
+
+from django.db import migrations, models
+
+from journeylog.util.geo import geohash_encode
+
+
+def populate_geohashes(apps, schema_editor):
+    for model_name in ('Location', 'Photo', 'JourneyMapPointVisit'):
+        model = apps.get_model('journeylog', model_name)
+        objects = []
+
+        for obj in model.objects.exclude(latitude=None).exclude(longitude=None).only('id', 'latitude', 'longitude'):
+            obj.geohash = geohash_encode(obj.latitude, obj.longitude)
+            objects.append(obj)
+
+        model.objects.bulk_update(objects, ['geohash'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journeylog', '0017_query_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='journeymappointvisit',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=12),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=12),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='geohash',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=12),
+        ),
+        migrations.RunPython(populate_geohashes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.24 on 2026-10-19 14:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journeylog', '0018_geohash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapCluster',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('PHOTO', 'Photo'), ('LOCATION', 'Location')], max_length=20)),
+                ('precision', models.PositiveSmallIntegerField()),
+                ('geohash', models.CharField(max_length=12)),
+                ('count', models.PositiveIntegerField()),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('scope', models.PositiveIntegerField(editable=False)),
+                ('journey', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='map_clusters', to='journeylog.Journey')),
+                ('location', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='journeylog.Location')),
+                ('photo', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='journeylog.Photo')),
+            ],
+            options={
+                'unique_together': {('kind', 'scope', 'precision', 'geohash')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.24 on 2026-10-19 14:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journeylog', '0019_mapcluster'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='journey',
+            name='map_points_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.24 on 2026-10-19 14:37
+
+from django.db import migrations, models
+
+from journeylog.util.time import wall_clock_time
+
+
+def populate_local_timestamps(apps, schema_editor):
+    Photo = apps.get_model('journeylog', 'Photo')
+    photos = []
+
+    for photo in Photo.objects.only('id', 'timestamp', 'timezone'):
+        photo.local_timestamp = wall_clock_time(photo.timestamp, photo.timezone)
+        photos.append(photo)
+
+    Photo.objects.bulk_update(photos, ['local_timestamp'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journeylog', '0020_journey_map_points_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='local_timestamp',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='photo',
+            index=models.Index(fields=['journey', 'local_timestamp'], name='photo_journey_local_ts_idx'),
+        ),
+        migrations.RunPython(populate_local_timestamps, migrations.RunPython.noop),
+    ]
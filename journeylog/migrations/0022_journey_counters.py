@@ -0,0 +1,67 @@
+# Generated by Django 2.2.24 on 2026-10-19 14:39
+
+from django.db import migrations, models
+from django.db.models import Count, Sum, Min, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def populate_counters(apps, schema_editor):
+    Journey = apps.get_model('journeylog', 'Journey')
+    JournalPage = apps.get_model('journeylog', 'JournalPage')
+    Photo = apps.get_model('journeylog', 'Photo')
+    JourneyLocationVisit = apps.get_model('journeylog', 'JourneyLocationVisit')
+
+    def aggregate(model, expression):
+        return Subquery(model.objects.filter(journey_id=OuterRef('pk')).order_by().values('journey_id')
+                        .annotate(value=expression).values('value'))
+
+    Journey.objects.update(
+        journal_pages_count=Coalesce(aggregate(JournalPage, Count('id')), Value(0)),
+        photos_count=Coalesce(aggregate(Photo, Count('id')), Value(0)),
+        photos_filesize_total=Coalesce(aggregate(Photo, Sum('filesize')), Value(0)),
+        photos_date_start=aggregate(Photo, Min('timestamp')),
+        photos_date_end=aggregate(Photo, Max('timestamp')),
+        visited_locations_count=Coalesce(aggregate(JourneyLocationVisit, Count('location_id', distinct=True)),
+                                         Value(0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journeylog', '0021_photo_local_timestamp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='journey',
+            name='journal_pages_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='journey',
+            name='photos_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='journey',
+            name='photos_date_end',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='journey',
+            name='photos_date_start',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='journey',
+            name='photos_filesize_total',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='journey',
+            name='visited_locations_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 2.2.24 on 2026-10-19 14:43
+
+from django.db import migrations, models
+
+from journeylog.util.markup import refresh_rendered_markdown
+
+
+def render_markdown_fields(apps, schema_editor):
+    for model_name, fields in (('Journey', ('description', 'description_html', 'description_hash')),
+                               ('JournalPage', ('text', 'text_html', 'text_hash'))):
+        model = apps.get_model('journeylog', model_name)
+        objects = list(model.objects.only('id', fields[0]))
+
+        for obj in objects:
+            refresh_rendered_markdown(obj, *fields, force=True)
+
+        model.objects.bulk_update(objects, fields[1:], batch_size=100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journeylog', '0022_journey_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='journalpage',
+            name='text_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='journalpage',
+            name='text_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='journey',
+            name='description_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='journey',
+            name='description_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(render_markdown_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.24 on 2026-10-19 14:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journeylog', '0024_cachepurge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageVerification',
+            fields=[
+                ('photo', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='verification', serialize=False, to='journeylog.Photo')),
+                ('path', models.CharField(max_length=500)),
+                ('hash', models.CharField(max_length=40)),
+                ('mtime_ns', models.BigIntegerField()),
+                ('verified_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
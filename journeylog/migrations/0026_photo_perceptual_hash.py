@@ -0,0 +1,18 @@
+# Generated by Django 2.2.24 on 2026-10-19 14:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('journeylog', '0025_storageverification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='perceptual_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=16),
+        ),
+    ]
@@ -1,14 +1,26 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 from datetime import timedelta
 import humanize
 import logging
 import os
+import time
 
 from PIL import Image
 from django.conf import settings
 from django.db import models
+from django.db.models import Count, Case, When, Value, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 
+from . import metrics
+from .instrumentation import timed
+from .util.geo import geohash_encode
 from .util.model import FixedSeparatedValuesField
-from .util.image import exif_rotate
+from .util.image import exif_rotate, difference_hash
+from .util.markup import refresh_rendered_markdown
+from .util.signing import sign_image_path
+from .util.storage import content_addressed_enabled, shared_file_path, store_shared_file, link_file
+from .util.time import wall_clock_time
 from .validators import validate_language_code_list, validate_language_code
 
 logger = logging.getLogger(__name__)
@@ -16,6 +28,11 @@ logger = logging.getLogger(__name__)
 THUMBNAIL_EXTENSION = '.th.jpg'
 
 
+def photo_storage_path(visibility, kind, journey_id, filename):
+    return os.path.join(settings.BASE_DIR, 'storage', visibility, kind, str(journey_id),
+                        filename + (THUMBNAIL_EXTENSION if kind == 'thumb' else ''))
+
+
 class TemporalAwareModel(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     modified_at = models.DateTimeField(auto_now=True)
@@ -24,6 +41,18 @@ class TemporalAwareModel(models.Model):
         abstract = True
 
 
+class GeohashedModel(models.Model):
+    geohash = models.CharField(max_length=12, blank=True, editable=False, db_index=True)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        self.geohash = geohash_encode(self.latitude, self.longitude)
+
+        super().save(*args, **kwargs)
+
+
 def journey_background_image_path(journey, filename):
     return 'public/cover/{}_{}'.format(journey.id, filename)
 
@@ -32,6 +61,8 @@ class Journey(TemporalAwareModel):
     slug = models.SlugField(unique=True, max_length=100)
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True)
+    description_html = models.TextField(blank=True, editable=False)
+    description_hash = models.CharField(max_length=40, blank=True, editable=False)
     background = models.ImageField(upload_to=journey_background_image_path, blank=True, max_length=240)
     languages = models.CharField(max_length=200, validators=[validate_language_code_list], blank=True,
                                  help_text="A comma-separated list of locale codes like en_GB. Use proper casing.")
@@ -39,19 +70,49 @@ class Journey(TemporalAwareModel):
     date_start = models.DateTimeField(blank=True, null=True)
     date_end = models.DateTimeField(blank=True, null=True)
 
+    # Bumped whenever the map points of the journey change, so that cached tracks can be keyed on it
+    map_points_version = models.PositiveIntegerField(default=0, editable=False)
+
+    # Kept up to date from signals by counters.py, see also the recount_journeys command
+    journal_pages_count = models.PositiveIntegerField(default=0, editable=False)
+    photos_count = models.PositiveIntegerField(default=0, editable=False)
+    photos_filesize_total = models.BigIntegerField(default=0, editable=False)
+    photos_date_start = models.DateTimeField(blank=True, null=True, editable=False)
+    photos_date_end = models.DateTimeField(blank=True, null=True, editable=False)
+    visited_locations_count = models.PositiveIntegerField(default=0, editable=False)
+
+    MARKDOWN_FIELDS = (('description', 'description_html', 'description_hash'),)
+
+    DERIVED_FIELDS = ('map_points_version', 'journal_pages_count', 'photos_count', 'photos_filesize_total',
+                      'photos_date_start', 'photos_date_end', 'visited_locations_count')
+
     class Meta:
         ordering = ['date_start', 'name']
+        indexes = [
+            models.Index(fields=['date_start', 'name'], name='journey_date_start_idx'),
+        ]
 
     def save(self, *args, **kwargs):
-        try:
-            this = Journey.objects.get(id=self.id)
-            if this.background != self.background:
+        # New journeys, and ones whose row is gone, have no old cover image to remove
+        this = Journey.objects.filter(id=self.id).only('background').first() if self.id is not None else None
+        if this is not None and this.background != self.background:
+            try:
                 this.background.delete(save=False)
-        except:
-            logger.warning(r"Couldn't remove the old cover image of a journey.", exc_info=1)
+            except:
+                logger.warning(r"Couldn't remove the old cover image of a journey.", exc_info=1)
+
+        for fields in self.MARKDOWN_FIELDS:
+            refresh_rendered_markdown(self, *fields)
 
         super(Journey, self).save(*args, **kwargs)
 
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        if update_fields is None:
+            # The derived fields are updated in place in the database, so the copy in this instance may be stale. A
+            # row that doesn't exist yet still gets them from the INSERT that follows.
+            values = [value for value in values if value[0].name not in self.DERIVED_FIELDS]
+        return super(Journey, self)._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
     def __str__(self):
         return self.name
 
@@ -62,6 +123,26 @@ class JournalPageModules:
     MAP = 3
 
 
+class JournalPageQuerySet(models.QuerySet):
+    def with_photos_count(self):
+        # The selection of JournalPage.photo_queryset(), counted for all pages in the same query
+        def count(**filters):
+            photos = (Photo.objects.filter(journey_id=OuterRef('journey_id'), **filters).order_by().values('journey_id')
+                      .annotate(count=Count('id')).values('count'))
+            return Coalesce(Subquery(photos, output_field=models.IntegerField()), Value(0))
+
+        date_end = Coalesce(OuterRef('date_end'), models.ExpressionWrapper(
+            OuterRef('date_start') + timedelta(days=1, seconds=-1), output_field=models.DateTimeField()))
+
+        return self.annotate(annotated_photos_count=Case(
+            When(date_start=None, date_end=None, type=JournalPage.REGULAR, then=count()),
+            When(date_start=None, date_end=None, then=Value(0)),
+            When(date_start=None, then=count(timestamp__lte=OuterRef('date_end'))),
+            default=count(timestamp__gte=OuterRef('date_start'), timestamp__lte=date_end),
+            output_field=models.IntegerField(),
+        ))
+
+
 class JournalPage(TemporalAwareModel):
     REGULAR = 'REGULAR'
     SPECIAL = 'SPECIAL'
@@ -81,8 +162,12 @@ class JournalPage(TemporalAwareModel):
     name = models.CharField(max_length=100, blank=True)
     order_no = models.SmallIntegerField(default=0)
     text = models.TextField(blank=True)
+    text_html = models.TextField(blank=True, editable=False)
+    text_hash = models.CharField(max_length=40, blank=True, editable=False)
     type = models.CharField(max_length=100, choices=PageTypes, default=REGULAR)
 
+    MARKDOWN_FIELDS = (('text', 'text_html', 'text_hash'),)
+
     date_start = models.DateTimeField(blank=True, null=True)
     date_end = models.DateTimeField(blank=True, null=True)
     timezone_start = models.CharField(max_length=50, blank=True, null=True)
@@ -107,28 +192,57 @@ class JournalPage(TemporalAwareModel):
 
     disabled_modules = FixedSeparatedValuesField(max_length=255, token=',', cast=int, choices=PageModules, blank=True)
 
-    def photos(self):
+    objects = JournalPageQuerySet.as_manager()
+
+    def photo_queryset(self):
+        photos = Photo.objects.filter(journey_id=self.journey_id)
+
         if self.date_start is None and self.date_end is None:
             if self.type == JournalPage.REGULAR:
-                return list(self.journey.photos.all())
+                return photos
             else:
-                return []
+                return photos.none()
 
         if self.date_start is not None:
-            timestamp_gte = self.date_start
-            timestamp_lte = self.effective_date_end()
-        else:
-            timestamp_gte = float('-inf')
-            timestamp_lte = self.date_end
+            photos = photos.filter(timestamp__gte=self.date_start)
+
+        return photos.filter(timestamp__lte=self.effective_date_end())
 
-        return [photo for photo in self.journey.photos.all()
-                if timestamp_gte <= photo.timestamp <= timestamp_lte]
+    def select_photos(self, timestamps, photos):
+        # Same selection as photo_queryset(), from photos of the journey sorted by timestamp
+        if self.date_start is None and self.date_end is None:
+            return list(photos) if self.type == JournalPage.REGULAR else []
+
+        start = bisect_left(timestamps, self.date_start) if self.date_start is not None else 0
+        end = bisect_right(timestamps, self.effective_date_end())
+
+        return photos[start:end]
+
+    def photos(self):
+        if hasattr(self, 'prefetched_photos'):
+            return self.prefetched_photos
+
+        return list(self.photo_queryset().select_related('journey'))
 
     def photos_count(self):
-        return len(self.photos())
+        if hasattr(self, 'annotated_photos_count'):
+            return self.annotated_photos_count
+        if hasattr(self, 'prefetched_photos'):
+            return len(self.prefetched_photos)
+
+        return self.photo_queryset().count()
+
+    def save(self, *args, **kwargs):
+        for fields in self.MARKDOWN_FIELDS:
+            refresh_rendered_markdown(self, *fields)
+
+        super().save(*args, **kwargs)
 
     class Meta:
         ordering = ['journey', 'order_no', 'date_start']
+        indexes = [
+            models.Index(fields=['journey', 'order_no', 'date_start'], name='journalpage_journey_order_idx'),
+        ]
 
     def __str__(self):
         return "{} - {} to {}: {}".format(
@@ -139,7 +253,19 @@ class JournalPage(TemporalAwareModel):
         )
 
 
-class Location(TemporalAwareModel):
+def prefetch_page_photos(pages):
+    # One query for the photos of all the pages, which JournalPage.photos() and photos_count() then use
+    photos = defaultdict(list)
+    journey_photos = Photo.objects.filter(journey_id__in={page.journey_id for page in pages}).select_related('journey')
+    for photo in journey_photos.order_by('timestamp', 'name'):
+        photos[photo.journey_id].append(photo)
+
+    timestamps = {journey_id: [photo.timestamp for photo in photo_list] for journey_id, photo_list in photos.items()}
+    for page in pages:
+        page.prefetched_photos = page.select_photos(timestamps.get(page.journey_id, []), photos[page.journey_id])
+
+
+class Location(TemporalAwareModel, GeohashedModel):
     AIRPORT = 'AIRPORT'
     AMUSEMENT_PARK = 'AMUSEMENT_PARK'
     ARCADE = 'ARCADE'
@@ -243,6 +369,9 @@ class Location(TemporalAwareModel):
 
     class Meta:
         ordering = ['name']
+        indexes = [
+            models.Index(fields=['name'], name='location_name_idx'),
+        ]
 
     def __str__(self):
         return "{} ({})".format(self.name, self.get_type_display())
@@ -260,12 +389,15 @@ class LocationName(TemporalAwareModel):
             ('location', 'lang')
         )
         ordering = ['sort_key', 'location', 'name']
+        indexes = [
+            models.Index(fields=['sort_key', 'location', 'name'], name='locationname_sort_key_idx'),
+        ]
 
     def __str__(self):
         return "{} ({} in {})".format(self.name, self.location.name, self.lang)
 
 
-class Photo(TemporalAwareModel):
+class Photo(TemporalAwareModel, GeohashedModel):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.__old_confidentiality = self.confidentiality
@@ -281,12 +413,15 @@ class Photo(TemporalAwareModel):
     # TODO: is this combinable in a smart way?
     timezone = models.CharField(max_length=50)
     timestamp = models.DateTimeField()
+    local_timestamp = models.DateTimeField(blank=True, null=True, editable=False)
 
     filename = models.CharField(max_length=180, editable=False)
     filesize = models.BigIntegerField(editable=False)
     height = models.PositiveIntegerField(editable=False)
     width = models.PositiveIntegerField(editable=False)
     hash = models.CharField(max_length=40, editable=False)
+    # dHash of the thumbnail, for finding near-duplicates
+    perceptual_hash = models.CharField(max_length=16, blank=True, default='', editable=False)
 
     camera_make = models.CharField(blank=True, null=True, max_length=100)
     camera_model = models.CharField(blank=True, null=True, max_length=100)
@@ -308,16 +443,14 @@ class Photo(TemporalAwareModel):
         return humanize.naturalsize(self.filesize, binary=True)
 
     def get_url_of_kind(self, user, kind, for_admin=False):
+        refresh = int(self.modified_at.timestamp())
+
         if self.confidentiality > 0 or for_admin:
-            if user or for_admin:
-                return '/image/private/{}/{}/{}?hash={}&refresh={}'.format(
-                    kind,
-                    self.journey_id,
-                    self.filename,
-                    # thumbnail extension is added by the backend endpoint
-                    self.hash,
-                    int(self.modified_at.timestamp())
-                )
+            if for_admin or (user is not None and user.is_authenticated):
+                # The signature alone grants access, so the image view doesn't need to look up the photo or the user
+                path = '{}/{}/{}/{}'.format('private' if self.confidentiality > 0 else 'public', kind,
+                                            self.journey_id, self.filename)
+                return '/image/{}?{}'.format(path, sign_image_path(path, refresh))
             else:
                 return None
 
@@ -327,7 +460,7 @@ class Photo(TemporalAwareModel):
             self.journey_id,
             self.filename,
             THUMBNAIL_EXTENSION if kind == 'thumb' else '',
-            int(self.modified_at.timestamp())
+            refresh
         )
 
     def access_url(self, user=None):
@@ -342,31 +475,82 @@ class Photo(TemporalAwareModel):
 
         visibility = 'private' if confidentiality > 0 else 'public'
 
-        return os.path.join(settings.BASE_DIR, 'storage', visibility, kind, str(self.journey_id),
-                            self.filename + (THUMBNAIL_EXTENSION if kind == 'thumb' else ''))
+        return photo_storage_path(visibility, kind, self.journey_id, self.filename)
+
+    def get_shared_file_path(self, kind):
+        return shared_file_path(self.hash + (THUMBNAIL_EXTENSION if kind == 'thumb' else ''))
+
+    def render_thumb(self, photo_path, thumb_path):
+        started = time.perf_counter()
+        thumb_path_dir = os.path.dirname(thumb_path)
+        os.makedirs(thumb_path_dir, exist_ok=True)
+
+        thumb_size = settings.JOURNEYLOG['PHOTO_THUMBNAIL_SIZE'] or 200
+        ratio = max(thumb_size / self.width, thumb_size / self.height)
+
+        im = Image.open(photo_path)
+        im = exif_rotate(im)
+        im.thumbnail(
+            (self.width * ratio, self.height * ratio), Image.LANCZOS
+        )
+        im.save(thumb_path, 'jpeg', optimize=True, quality=85)
+
+        metrics.observe('journeylog_thumbnail_generation_seconds', time.perf_counter() - started)
 
     def ensure_thumb(self):
+        with timed('thumb'):
+            result = self.ensure_thumb_file()
+
+            if not self.perceptual_hash:
+                self.update_perceptual_hash()
+
+        return result
+
+    def update_perceptual_hash(self):
+        with Image.open(self.get_storage_file_path('thumb')) as im:
+            self.perceptual_hash = difference_hash(im)
+
+        # Derived from the file, not an edit of the photo, so no save() and no signals
+        Photo.objects.filter(pk=self.pk).update(perceptual_hash=self.perceptual_hash)
+
+    def thumb_outdated(self, thumb_path):
+        return not os.path.exists(thumb_path) or os.stat(thumb_path).st_mtime < self.modified_at.timestamp()
+
+    def ensure_thumb_file(self):
         photo_path = self.get_storage_file_path('photo')
         thumb_path = self.get_storage_file_path('thumb')
 
-        if not os.path.exists(thumb_path) or os.stat(thumb_path).st_mtime < self.modified_at.timestamp():
-            thumb_path_dir = os.path.dirname(thumb_path)
-            os.makedirs(thumb_path_dir, exist_ok=True)
+        if content_addressed_enabled():
+            # Thumbnails only depend on the content, so photos with the same hash share a single one
+            shared_path = self.get_shared_file_path('thumb')
+
+            if self.thumb_outdated(shared_path):
+                if not os.path.exists(shared_path) and not self.thumb_outdated(thumb_path):
+                    store_shared_file(thumb_path, shared_path)
+                else:
+                    # Rendered next to the shared copy and moved over it, as the other photos' links would otherwise
+                    # see a partly written file
+                    temporary_path = '{}.{}.tmp'.format(shared_path, os.getpid())
+                    self.render_thumb(photo_path, temporary_path)
+                    os.replace(temporary_path, shared_path)
+
+            if not os.path.exists(thumb_path) or not os.path.samefile(thumb_path, shared_path):
+                link_file(shared_path, thumb_path)
+                return thumb_path
 
-            thumb_size = settings.JOURNEYLOG['PHOTO_THUMBNAIL_SIZE'] or 200
-            ratio = max(thumb_size / self.width, thumb_size / self.height)
+            return True
 
-            im = Image.open(photo_path)
-            im = exif_rotate(im)
-            im.thumbnail(
-                (self.width * ratio, self.height * ratio), Image.LANCZOS
-            )
-            im.save(thumb_path, 'jpeg', optimize=True, quality=85)
+        if self.thumb_outdated(thumb_path):
+            self.render_thumb(photo_path, thumb_path)
 
             return thumb_path
 
         return True
 
+    def store_content_addressed(self):
+        return {kind: store_shared_file(self.get_storage_file_path(kind), self.get_shared_file_path(kind))
+                for kind in ('photo', 'thumb')}
+
     def move_storage_file(self, kind):
         # TODO: figure out details regarding import later (the old path is not either private or public)
         old_path = self.get_storage_file_path(kind, confidentiality=self.__old_confidentiality)
@@ -388,6 +572,8 @@ class Photo(TemporalAwareModel):
             except IOError:
                 return
 
+        self.local_timestamp = wall_clock_time(self.timestamp, self.timezone)
+
         super().save(*args, **kwargs)
 
     filesize_natural.admin_order_field = 'filesize'
@@ -398,6 +584,11 @@ class Photo(TemporalAwareModel):
         unique_together = (
             ('journey', 'filename')
         )
+        indexes = [
+            models.Index(fields=['timestamp', 'name'], name='photo_timestamp_idx'),
+            models.Index(fields=['journey', 'timestamp', 'name'], name='photo_journey_timestamp_idx'),
+            models.Index(fields=['journey', 'local_timestamp'], name='photo_journey_local_ts_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -421,12 +612,15 @@ class JourneyLocationVisit(TemporalAwareModel):
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['journey', 'timestamp'], name='locationvisit_journey_ts_idx'),
+        ]
 
     def __str__(self):
         return "{} visit on {}".format(self.location, self.timestamp)
 
 
-class JourneyMapPointVisit(TemporalAwareModel):
+class JourneyMapPointVisit(TemporalAwareModel, GeohashedModel):
     journey = models.ForeignKey(Journey, on_delete=models.CASCADE, related_name='map_point_visits')
 
     # TODO: convert to GeoDjango later
@@ -437,11 +631,145 @@ class JourneyMapPointVisit(TemporalAwareModel):
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['journey', 'timestamp'], name='mappointvisit_journey_ts_idx'),
+        ]
 
     def __str__(self):
         return "({}, {}) visit on {}".format(self.latitude, self.longitude, self.timestamp)
 
 
+class SearchDocument(models.Model):
+    PHOTO = 'PHOTO'
+    JOURNAL_PAGE = 'JOURNAL_PAGE'
+
+    DocumentKinds = (
+        (PHOTO, 'Photo'),
+        (JOURNAL_PAGE, 'Journal page'),
+    )
+
+    kind = models.CharField(max_length=20, choices=DocumentKinds)
+    object_id = models.PositiveIntegerField()
+    journey = models.ForeignKey(Journey, blank=True, null=True, on_delete=models.SET_NULL,
+                                related_name='search_documents')
+
+    title = models.CharField(max_length=200, blank=True)
+    body = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = (
+            ('kind', 'object_id')
+        )
+
+    def __str__(self):
+        return "{} #{}: {}".format(self.get_kind_display(), self.object_id, self.title)
+
+
+class SearchTerm(models.Model):
+    document = models.ForeignKey(SearchDocument, on_delete=models.CASCADE, related_name='terms')
+    term = models.CharField(max_length=64)
+    weight = models.FloatField()
+
+    class Meta:
+        index_together = (
+            ('term', 'document')
+        )
+
+    def __str__(self):
+        return "{} in {}".format(self.term, self.document_id)
+
+
+class MapCluster(models.Model):
+    PHOTO = 'PHOTO'
+    LOCATION = 'LOCATION'
+
+    ClusterKinds = (
+        (PHOTO, 'Photo'),
+        (LOCATION, 'Location'),
+    )
+
+    # Scope of the clusters without a journey
+    GLOBAL_SCOPE = 0
+
+    kind = models.CharField(max_length=20, choices=ClusterKinds)
+    # Clusters without a journey cover everything
+    journey = models.ForeignKey(Journey, blank=True, null=True, on_delete=models.CASCADE, related_name='map_clusters')
+    # The journey id, or GLOBAL_SCOPE. NULLs never collide in a unique index and MySQL has no partial ones, so the
+    # journey itself can't keep the global clusters unique.
+    scope = models.PositiveIntegerField(editable=False)
+    precision = models.PositiveSmallIntegerField()
+    geohash = models.CharField(max_length=12)
+
+    count = models.PositiveIntegerField()
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+
+    photo = models.ForeignKey(Photo, blank=True, null=True, on_delete=models.SET_NULL, related_name='+')
+    location = models.ForeignKey(Location, blank=True, null=True, on_delete=models.SET_NULL, related_name='+')
+
+    class Meta:
+        unique_together = (
+            ('kind', 'scope', 'precision', 'geohash')
+        )
+
+    @classmethod
+    def scope_of(cls, journey_id):
+        return cls.GLOBAL_SCOPE if journey_id is None else journey_id
+
+    def save(self, *args, **kwargs):
+        self.scope = self.scope_of(self.journey_id)
+
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return "{} cluster {} ({})".format(self.get_kind_display(), self.geohash, self.count)
+
+
+class CachePurge(models.Model):
+    # Surrogate keys of cached public API responses that became stale, for a reverse proxy to purge
+    key = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return self.key
+
+
+class StorageVerification(models.Model):
+    # The last successful check of a photo file against its database record, see the verify_storage command
+    photo = models.OneToOneField(Photo, on_delete=models.CASCADE, primary_key=True, related_name='verification')
+    path = models.CharField(max_length=500)
+    hash = models.CharField(max_length=40)
+    mtime_ns = models.BigIntegerField()
+    verified_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.path
+
+
+class RequestProfile(models.Model):
+    # A request profiled on demand by a staff user; the files are under PROFILE_DIR
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    status_code = models.PositiveSmallIntegerField()
+    duration_ms = models.FloatField()
+    samples = models.PositiveIntegerField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.SET_NULL)
+    name = models.CharField(max_length=100)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def get_file_path(self, extension):
+        return os.path.join(settings.JOURNEYLOG['PROFILE_DIR'], '{}.{}'.format(self.name, extension))
+
+    def __str__(self):
+        return '{} {}'.format(self.method, self.path)
+
+
 """
 class TransportationLine(models.Model):
     pass
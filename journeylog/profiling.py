@@ -0,0 +1,95 @@
+import cProfile
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+
+from .models import RequestProfile
+
+
+class StackSampler(threading.Thread):
+    # Samples the stack of another thread at a fixed interval and counts identical stacks, which is the input format of
+    # flamegraph.pl and speedscope
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
+
+
+def profile_requested(request):
+    return (request.GET.get('profile') == '1' or request.META.get('HTTP_X_PROFILE') == '1') and \
+        request.user.is_staff
+
+
+def prune_profiles(keep):
+    for profile in RequestProfile.objects.all()[keep:]:
+        profile.delete()
+
+
+class RequestProfilerMiddleware:
+    def __init__(self, get_response):
+        if not settings.JOURNEYLOG['PROFILE_DIR']:
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not profile_requested(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        sampler = StackSampler(threading.get_ident(), settings.JOURNEYLOG['PROFILE_SAMPLE_INTERVAL'])
+
+        started = time.perf_counter()
+        sampler.start()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+            sampler.stop()
+        duration = time.perf_counter() - started
+
+        profile = RequestProfile(method=request.method, path=request.get_full_path()[:500],
+                                 status_code=response.status_code, duration_ms=duration * 1000,
+                                 samples=sum(sampler.stacks.values()), user=request.user,
+                                 name='{:%Y%m%d-%H%M%S}-{}'.format(timezone.now(), uuid.uuid4().hex[:8]))
+
+        os.makedirs(settings.JOURNEYLOG['PROFILE_DIR'], exist_ok=True)
+        profiler.dump_stats(profile.get_file_path('prof'))
+        sampler.write_collapsed(profile.get_file_path('collapsed'))
+        profile.save()
+        prune_profiles(settings.JOURNEYLOG['PROFILE_KEEP'])
+
+        response['X-Profile-Id'] = str(profile.id)
+        return response
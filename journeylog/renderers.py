@@ -0,0 +1,123 @@
+import json
+import struct
+
+import numpy as np
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from .tracks import TrackColumns
+
+POLYLINE_PRECISION = 5
+
+TRACK_BINARY_MAGIC = b'JLTR'
+TRACK_BINARY_VERSION = 1
+TRACK_BINARY_HAS_LOCATIONS = 0x1
+TRACK_BINARY_HEADER = struct.Struct('<4sHHIq')
+
+
+def fill_missing(values):
+    # Points without coordinates (visits without a location) repeat the previous coordinate
+    values = np.asarray(values, dtype=np.float64)
+    present = ~np.isnan(values)
+
+    if present.all():
+        return values
+
+    indices = np.maximum.accumulate(np.where(present, np.arange(len(values)), 0))
+    return np.where(present[indices], values[indices], 0.0)
+
+
+def encode_polyline(latitudes, longitudes, precision=POLYLINE_PRECISION):
+    factor = 10 ** precision
+    coordinates = np.column_stack((
+        np.round(fill_missing(latitudes) * factor),
+        np.round(fill_missing(longitudes) * factor),
+    )).astype(np.int64)
+
+    deltas = np.diff(coordinates, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    # Zigzag encode, so that small negative numbers stay small
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1).tolist()
+
+    chars = []
+    for value in values:
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+
+    return ''.join(chars)
+
+
+def start_and_offsets(timestamps):
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    start = int(timestamps[0]) if len(timestamps) else 0
+
+    return start, timestamps - start
+
+
+class TrackRendererMixin:
+    fallback_renderer = JSONRenderer()
+
+    def render_fallback(self, data, accepted_media_type=None, renderer_context=None):
+        # Errors and anything else that isn't a track still go out as plain JSON
+        response = (renderer_context or {}).get('response')
+        if response is not None:
+            response['Content-Type'] = 'application/json'
+
+        return self.fallback_renderer.render(data, 'application/json', renderer_context)
+
+
+class PolylineRenderer(TrackRendererMixin, BaseRenderer):
+    media_type = 'application/vnd.journeylog.polyline+json'
+    format = 'polyline'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, TrackColumns):
+            return self.render_fallback(data, accepted_media_type, renderer_context)
+
+        start, offsets = start_and_offsets(data.timestamps)
+        payload = {
+            'count': len(data.timestamps),
+            'precision': POLYLINE_PRECISION,
+            'polyline': encode_polyline(data.latitudes, data.longitudes),
+            'startTime': start,
+            'timeDeltas': np.diff(offsets, prepend=0).tolist(),
+        }
+
+        if data.location_ids is not None:
+            payload['locationIds'] = [None if i < 0 else i for i in np.asarray(data.location_ids).tolist()]
+
+        return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+
+class TrackBinaryRenderer(TrackRendererMixin, BaseRenderer):
+    # Little-endian header (magic, version, flags, uint32 count, int64 start epoch seconds) followed by the columns
+    # float32 latitudes, float32 longitudes, int32 second offsets from the start and, if flagged, int32 location ids
+    # with -1 for none.
+    media_type = 'application/vnd.journeylog.track'
+    format = 'bin'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, TrackColumns):
+            return self.render_fallback(data, accepted_media_type, renderer_context)
+
+        start, offsets = start_and_offsets(data.timestamps)
+        flags = TRACK_BINARY_HAS_LOCATIONS if data.location_ids is not None else 0
+
+        parts = [
+            TRACK_BINARY_HEADER.pack(TRACK_BINARY_MAGIC, TRACK_BINARY_VERSION, flags, len(offsets), start),
+            np.asarray(data.latitudes, dtype='<f4').tobytes(),
+            np.asarray(data.longitudes, dtype='<f4').tobytes(),
+            offsets.astype('<i4').tobytes(),
+        ]
+
+        if flags & TRACK_BINARY_HAS_LOCATIONS:
+            parts.append(np.asarray(data.location_ids, dtype='<i4').tobytes())
+
+        return b''.join(parts)
+
+
+TRACK_RENDERERS = (PolylineRenderer, TrackBinaryRenderer)
+TRACK_FORMATS = tuple(renderer.format for renderer in TRACK_RENDERERS)
@@ -0,0 +1,147 @@
+import re
+import threading
+import time
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+from io import StringIO
+from urllib.parse import urlsplit, unquote
+from wsgiref.util import setup_testing_defaults
+
+import numpy as np
+from django.db import connections
+from django.urls import resolve, Resolver404
+
+# Apache combined log format: host ident user [time] "request" status size "referer" "user agent"
+ACCESS_LOG_LINE = re.compile(r'^\S+ \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<method>[A-Z]+) (?P<target>\S+)[^"]*" '
+                             r'(?P<status>\d{3}) \S+')
+ACCESS_LOG_TIME_FORMAT = '%d/%b/%Y:%H:%M:%S %z'
+REPLAYED_METHODS = ('GET', 'HEAD')
+SKIPPED_PREFIXES = ('/admin/', '/api-auth/', '/nested_admin/', '/maintenance/', '/metrics', '/static/', '/__debug__/')
+
+ReplayRequest = namedtuple('ReplayRequest', ('offset', 'method', 'path', 'query', 'route'))
+ReplayResult = namedtuple('ReplayResult', ('route', 'status', 'latency'))
+
+
+def parse_access_log(lines):
+    # Only reads are replayed, and only for paths that this application serves
+    requests = []
+    started = None
+
+    for line in lines:
+        match = ACCESS_LOG_LINE.match(line)
+        if match is None or match.group('method') not in REPLAYED_METHODS:
+            continue
+
+        target = urlsplit(match.group('target'))
+        # PATH_INFO carries the raw bytes of the path as Latin-1, as a WSGI server would pass it; Django decodes it
+        path = unquote(target.path, encoding='latin-1')
+        if path.startswith(SKIPPED_PREFIXES):
+            continue
+
+        try:
+            route = resolve(unquote(target.path)).view_name
+        except Resolver404:
+            continue
+
+        timestamp = datetime.strptime(match.group('time'), ACCESS_LOG_TIME_FORMAT).timestamp()
+        started = timestamp if started is None else started
+        requests.append(ReplayRequest(timestamp - started, match.group('method'), path, target.query, route))
+
+    return requests
+
+
+def wsgi_environ(request, host):
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'PATH_INFO': request.path,
+        'QUERY_STRING': request.query,
+        'HTTP_HOST': host,
+        'HTTP_ACCEPT': 'application/json',
+        'wsgi.errors': StringIO(),
+    }
+    setup_testing_defaults(environ)
+
+    return environ
+
+
+def replay_request(application, request, host):
+    status = []
+    started = time.perf_counter()
+
+    result = application(wsgi_environ(request, host), lambda response_status, headers, exc_info=None:
+                         status.append(int(response_status.split()[0])))
+    try:
+        # File responses are only read while being iterated, which is part of serving them
+        for _ in result:
+            pass
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+
+    return ReplayResult(request.route, status[0], time.perf_counter() - started)
+
+
+def replay_requests(requests, threads, speed, host):
+    # Requests are started at their original offsets divided by speed, or back to back with a speed of 0
+    from journeylog.wsgi import application
+
+    started = time.perf_counter()
+    lock = threading.Lock()
+    results = []
+
+    def run(request):
+        if speed:
+            delay = started + request.offset / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        try:
+            result = replay_request(application, request, host)
+        finally:
+            connections.close_all()
+
+        with lock:
+            results.append(result)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(run, requests))
+
+    return results
+
+
+def replay(requests, threads=4, processes=1, speed=0.0, host='localhost'):
+    if processes == 1:
+        return replay_requests(requests, threads, speed, host)
+
+    # Forked workers must not share the database connections of the parent
+    connections.close_all()
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        parts = executor.map(replay_requests, [requests[i::processes] for i in range(processes)],
+                             [threads] * processes, [speed] * processes, [host] * processes)
+        return [result for part in parts for result in part]
+
+
+def summarize(results, duration):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+
+    for result in results:
+        latencies[result.route].append(result.latency)
+        if result.status >= 500:
+            errors[result.route] += 1
+
+    summary = {}
+    for route, values in sorted(latencies.items()):
+        p50, p95, p99 = np.percentile(np.array(values) * 1000, (50, 95, 99)).tolist()
+        summary[route] = {
+            'requests': len(values),
+            'errors': errors[route],
+            'throughput': len(values) / duration if duration else None,
+            'p50_ms': p50,
+            'p95_ms': p95,
+            'p99_ms': p99,
+        }
+
+    return summary
@@ -1,16 +1,24 @@
 from rest_framework_nested import routers
 
 from .views import JourneyPhotoViewSet, UserViewSet, JourneyViewSet, PhotoViewSet, \
-    LocationViewSet, ServerInformationViewSet, JourneyJournalPageViewSet, JourneyLocationVisitViewSet
+    LocationViewSet, ServerInformationViewSet, JourneyJournalPageViewSet, JourneyLocationVisitViewSet, SearchViewSet, \
+    MapClusterViewSet, JourneyMapClusterViewSet, JourneyTrackViewSet, JourneyTimelineViewSet, \
+    JourneyBundleViewSet
 
 root_router = routers.DefaultRouter()
 # root_router.register(r'users', UserViewSet)
 root_router.register(r'journeys', JourneyViewSet)
 root_router.register(r'photos', PhotoViewSet)
 root_router.register(r'locations', LocationViewSet)
+root_router.register(r'search', SearchViewSet, basename='search')
+root_router.register(r'map-clusters', MapClusterViewSet, basename='map-clusters')
 root_router.register(r'status', ServerInformationViewSet, basename='status')
 
 journey_router = routers.NestedSimpleRouter(root_router, r'journeys', lookup='journey')
 journey_router.register(r'photos', JourneyPhotoViewSet, basename='journey-photos')
 journey_router.register(r'journal-pages', JourneyJournalPageViewSet, basename='journey-journal-pages')
 journey_router.register(r'location-visits', JourneyLocationVisitViewSet, basename='journey-location-visits')
+journey_router.register(r'map-clusters', JourneyMapClusterViewSet, basename='journey-map-clusters')
+journey_router.register(r'track', JourneyTrackViewSet, basename='journey-track')
+journey_router.register(r'timeline', JourneyTimelineViewSet, basename='journey-timeline')
+journey_router.register(r'bundle', JourneyBundleViewSet, basename='journey-bundle')
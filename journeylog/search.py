@@ -0,0 +1,218 @@
+import math
+import re
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Case, When, Value, F, Q, Sum, Count, FloatField
+from django.utils.html import escape
+
+from .models import SearchDocument, SearchTerm, Photo, JournalPage
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+MAX_PREFIX_TERMS = 50
+
+TITLE_BOOST = 3.0
+BODY_BOOST = 1.0
+
+# BM25-style term frequency saturation, so a word repeated all over a long diary entry doesn't drown out everything
+TF_SATURATION = 1.2
+
+SNIPPET_LENGTH = 160
+
+
+def tokenize(text):
+    return [token[:MAX_TERM_LENGTH] for token in TOKEN_PATTERN.findall((text or '').lower())
+            if len(token) >= MIN_TERM_LENGTH]
+
+
+def query_terms(query):
+    terms = []
+    for term in tokenize(query):
+        if term not in terms:
+            terms.append(term)
+
+    return terms[:MAX_QUERY_TERMS]
+
+
+def term_weights(title, body):
+    weights = Counter()
+
+    for boost, text in ((TITLE_BOOST, title), (BODY_BOOST, body)):
+        for term, tf in Counter(tokenize(text)).items():
+            weights[term] += boost * tf * (TF_SATURATION + 1) / (tf + TF_SATURATION)
+
+    return weights
+
+
+def document_source(obj):
+    if isinstance(obj, Photo):
+        return SearchDocument.PHOTO, obj.name, '\n'.join(filter(None, (obj.description, obj.filename)))
+    if isinstance(obj, JournalPage):
+        return SearchDocument.JOURNAL_PAGE, obj.name, obj.text
+
+    raise TypeError("Objects of type {} are not searchable".format(type(obj).__name__))
+
+
+@transaction.atomic
+def index_object(obj):
+    kind, title, body = document_source(obj)
+
+    document, created = SearchDocument.objects.update_or_create(kind=kind, object_id=obj.pk, defaults={
+        'journey_id': obj.journey_id,
+        'title': title[:200],
+        'body': body,
+    })
+
+    if not created:
+        document.terms.all().delete()
+
+    SearchTerm.objects.bulk_create([
+        SearchTerm(document=document, term=term, weight=weight)
+        for term, weight in term_weights(title, body).items()
+    ], batch_size=500)
+
+    return document
+
+
+def remove_object(obj):
+    kind, _, _ = document_source(obj)
+    SearchDocument.objects.filter(kind=kind, object_id=obj.pk).delete()
+
+
+def rebuild_index(batch_size=500):
+    SearchDocument.objects.all().delete()
+
+    count = 0
+    for queryset in (Photo.objects.all(), JournalPage.objects.all()):
+        for obj in queryset.iterator(chunk_size=batch_size):
+            index_object(obj)
+            count = count + 1
+
+    return count
+
+
+def search_documents(terms, kinds=None, journey_slug=None, prefix=False):
+    documents = SearchDocument.objects.all()
+
+    if kinds:
+        documents = documents.filter(kind__in=kinds)
+    if journey_slug:
+        documents = documents.filter(journey__slug=journey_slug)
+
+    if not terms:
+        return documents.none()
+
+    # With prefix, the last term also matches the indexed terms that start with it, for queries that are still being
+    # typed. Any one of those is enough.
+    exact_terms = terms[:-1] if prefix else terms
+    prefix_terms = []
+    if prefix:
+        # A range rather than startswith, which SQLite can't answer from the index
+        prefix_terms = list(SearchTerm.objects.filter(term__gte=terms[-1], term__lt=terms[-1] + '\uffff')
+                            .order_by('term').values_list('term', flat=True).distinct()[:MAX_PREFIX_TERMS])
+        if not prefix_terms:
+            return documents.none()
+
+    total = SearchDocument.objects.count() or 1
+    frequencies = dict(SearchTerm.objects.filter(term__in=exact_terms + prefix_terms).values_list('term')
+                       .annotate(c=Count('id')))
+
+    if any(term not in frequencies for term in exact_terms):
+        return documents.none()
+
+    # Weights are multiplied by the inverse document frequency of each term at query time, so the index itself never
+    # needs a rebuild when the corpus grows.
+    score = Sum(Case(
+        *[When(terms__term=term, then=F('terms__weight') * Value(math.log(1 + total / df)))
+          for term, df in frequencies.items()],
+        output_field=FloatField()
+    ))
+
+    documents = (documents.filter(terms__term__in=list(frequencies))
+                 .annotate(matched_terms=Count('terms__term', filter=Q(terms__term__in=exact_terms), distinct=True),
+                           score=score)
+                 .filter(matched_terms=len(exact_terms)))
+    if prefix_terms:
+        documents = documents.filter(id__in=SearchTerm.objects.filter(term__in=prefix_terms).values('document_id'))
+
+    return documents.order_by('-score', 'id')
+
+
+def highlight(text, terms, length=SNIPPET_LENGTH, prefix=False):
+    if not text:
+        return ''
+
+    words = [re.escape(term) + r'\b' for term in terms]
+    if prefix and words:
+        # Like in search_documents(), the last term may be the start of a word
+        words[-1] = re.escape(terms[-1]) + r'\w*'
+    pattern = re.compile(r'\b({})'.format('|'.join(words)), re.IGNORECASE | re.UNICODE)
+    match = pattern.search(text) if terms else None
+
+    start = 0
+    if match is not None and len(text) > length:
+        start = max(0, min(match.start() - length // 4, len(text) - length))
+
+    snippet = text[start:start + length]
+    parts = []
+    position = 0
+
+    for m in pattern.finditer(snippet) if terms else []:
+        parts.append(escape(snippet[position:m.start()]))
+        parts.append('<mark>{}</mark>'.format(escape(m.group(0))))
+        position = m.end()
+
+    parts.append(escape(snippet[position:]))
+
+    return '{}{}{}'.format(
+        '…' if start > 0 else '',
+        ''.join(parts),
+        '…' if start + length < len(text) else ''
+    )
+
+
+def resolve_results(documents, terms, user, prefix=False):
+    photo_ids = [d.object_id for d in documents if d.kind == SearchDocument.PHOTO]
+    page_ids = [d.object_id for d in documents if d.kind == SearchDocument.JOURNAL_PAGE]
+
+    photos = Photo.objects.select_related('journey').in_bulk(photo_ids) if photo_ids else {}
+    pages = JournalPage.objects.select_related('journey').in_bulk(page_ids) if page_ids else {}
+
+    results = []
+    for document in documents:
+        result = {
+            'kind': document.kind,
+            'id': document.object_id,
+            'score': document.score,
+            'title': highlight(document.title, terms, length=200, prefix=prefix),
+            'snippet': highlight(document.body, terms, prefix=prefix),
+        }
+
+        if document.kind == SearchDocument.PHOTO:
+            photo = photos.get(document.object_id)
+            if photo is None:
+                continue
+
+            result.update({
+                'journey_slug': photo.journey.slug if photo.journey else None,
+                'filename': photo.filename,
+                'timestamp': photo.timestamp,
+                'thumb_url': photo.thumb_url(user),
+            })
+        else:
+            page = pages.get(document.object_id)
+            if page is None:
+                continue
+
+            result.update({
+                'journey_slug': page.journey.slug,
+                'slug': page.slug,
+                'date_start': page.date_start,
+            })
+
+        results.append(result)
+
+    return results
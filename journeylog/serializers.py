@@ -1,11 +1,13 @@
+from collections import OrderedDict
+
 from django.contrib.auth.models import User
 
-from rest_framework.fields import IntegerField, Field, SerializerMethodField, FloatField
+from rest_framework.fields import IntegerField, Field, SerializerMethodField, FloatField, CharField
 from rest_framework.relations import HyperlinkedIdentityField, PrimaryKeyRelatedField
-from rest_framework.serializers import HyperlinkedModelSerializer, ModelSerializer
+from rest_framework.serializers import HyperlinkedModelSerializer, ModelSerializer, ListSerializer
 from rest_framework_nested.serializers import NestedHyperlinkedModelSerializer
 
-from .models import JournalPage, Photo, Journey, Location, JourneyLocationVisit
+from .models import JournalPage, Photo, Journey, Location, JourneyLocationVisit, MapCluster, prefetch_page_photos
 
 
 # https://github.com/alanjds/drf-nested-routers/issues/119
@@ -18,6 +20,23 @@ class FixedNestedHyperlinkedModelSerializer(NestedHyperlinkedModelSerializer):
         return field_class, field_kwargs
 
 
+class RenderedMarkdownMixin:
+    # With ?markup=html, Markdown fields are replaced by their pre-rendered HTML
+    markdown_fields = {}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+
+        if request is None or request.query_params.get('markup') != 'html':
+            return fields
+
+        return OrderedDict(
+            (self.markdown_fields[name], CharField(read_only=True)) if name in self.markdown_fields else (name, field)
+            for name, field in fields.items()
+        )
+
+
 class UserSerializer(HyperlinkedModelSerializer):
     class Meta:
         model = User
@@ -119,7 +138,17 @@ class LocationVisitSerializer(ModelSerializer):
         fields = ('id', 'location', 'timestamp')
 
 
-class JournalPageSerializer(HyperlinkedModelSerializer):
+class JournalPageListSerializer(ListSerializer):
+    def to_representation(self, data):
+        pages = list(data)
+        prefetch_page_photos(pages)
+
+        return super().to_representation(pages)
+
+
+class JournalPageSerializer(RenderedMarkdownMixin, HyperlinkedModelSerializer):
+    markdown_fields = {'text': 'text_html'}
+
     photos = PhotoLiteSerializer(many=True)
     photos_count = IntegerField()
     disabled_modules = SerializerMethodField()
@@ -143,6 +172,7 @@ class JournalPageSerializer(HyperlinkedModelSerializer):
         model = JournalPage
         fields = ('slug', 'name', 'order_no', 'type', 'text', 'date_start', 'date_end', 'timezone_start',
                   'timezone_end', 'photos', 'photos_count', 'disabled_modules')
+        list_serializer_class = JournalPageListSerializer
 
 
 class JourneyJournalPageSerializer(FixedNestedHyperlinkedModelSerializer):
@@ -172,7 +202,30 @@ class JourneyJournalPageSerializer(FixedNestedHyperlinkedModelSerializer):
         }
 
 
-class JourneySerializer(HyperlinkedModelSerializer):
+class BundlePhotoSerializer(PhotoSerializer):
+    class Meta(PhotoSerializer.Meta):
+        fields = ('id', 'name', 'latitude', 'longitude', 'timestamp', 'timezone', 'filename', 'height', 'width',
+                  'confidentiality', 'access_url', 'thumb_url')
+
+
+class BundleJournalPageSerializer(JourneyJournalPageSerializer):
+    # Photos are listed once per bundle; pages only refer to them by id
+    photos = SerializerMethodField()
+    photos_count = SerializerMethodField()
+
+    def get_photos(self, obj):
+        return self.context['page_photos'][obj.pk]
+
+    def get_photos_count(self, obj):
+        return len(self.context['page_photos'][obj.pk])
+
+    class Meta(JourneyJournalPageSerializer.Meta):
+        fields = JourneyJournalPageSerializer.Meta.fields + ('photos',)
+
+
+class JourneySerializer(RenderedMarkdownMixin, HyperlinkedModelSerializer):
+    markdown_fields = {'description': 'description_html'}
+
     journal_pages = JourneyJournalPageSerializer(many=True, read_only=True)
 
     photos = HyperlinkedIdentityField(
@@ -187,10 +240,6 @@ class JourneySerializer(HyperlinkedModelSerializer):
         lookup_field='slug'
     )
 
-    journal_pages_count = IntegerField()
-    photos_count = IntegerField()
-    visited_locations_count = IntegerField()
-
     languages = SerializerMethodField()
 
     def get_languages(self, obj):
@@ -199,10 +248,33 @@ class JourneySerializer(HyperlinkedModelSerializer):
     class Meta:
         model = Journey
         fields = ('url', 'id', 'name', 'slug', 'date_start', 'date_end', 'description', 'background', 'languages',
-                  'journal_pages', 'journal_pages_count', 'photos', 'photos_count', 'location_visits',
-                  'visited_locations_count')
+                  'journal_pages', 'journal_pages_count', 'photos', 'photos_count', 'photos_filesize_total',
+                  'photos_date_start', 'photos_date_end', 'location_visits', 'visited_locations_count')
         lookup_field = 'slug'
         extra_kwargs = {
             'url': {'lookup_field': 'slug'}
         }
 
+
+class BundleJourneySerializer(JourneySerializer):
+    class Meta(JourneySerializer.Meta):
+        fields = tuple(name for name in JourneySerializer.Meta.fields if name != 'journal_pages')
+
+
+class MapClusterSerializer(ModelSerializer):
+    photo = SerializerMethodField()
+    location = PrimaryKeyRelatedField(read_only=True)
+
+    def get_photo(self, obj):
+        if obj.photo is None:
+            return None
+
+        return {
+            'filename': obj.photo.filename,
+            'journey_slug': obj.photo.journey.slug if obj.photo.journey else None,
+            'thumb_url': obj.photo.thumb_url(self.context['request'].user),
+        }
+
+    class Meta:
+        model = MapCluster
+        fields = ('geohash', 'count', 'latitude', 'longitude', 'photo', 'location')
@@ -58,6 +58,7 @@ if DEBUG:
     ]
 
 MIDDLEWARE = [
+    'journeylog.instrumentation.RequestInstrumentationMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -66,6 +67,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'journeylog.profiling.RequestProfilerMiddleware',
 ]
 
 if DEBUG:
@@ -153,6 +155,27 @@ MEDIA_URL = config('EXTERNAL_PUBLIC_IMAGE_HOST_URL', default=None)
 
 DEFAULT_FILE_STORAGE = 'journeylog.storage.JourneyLogDefaultStorage'
 
+# Logging
+# https://docs.djangoproject.com/en/2.1/topics/logging/
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        # Without a handler, only warnings would be written, by the last resort handler of the logging module. The
+        # per-request lines of REQUEST_INSTRUMENTATION are logged at info level.
+        'journeylog': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions,
     # or allow read-only access for unauthenticated users.
@@ -180,11 +203,51 @@ JOURNEYLOG = {
     # specified location yourself.
     'EXTERNAL_PUBLIC_IMAGE_HOST_URL': config('EXTERNAL_PUBLIC_IMAGE_HOST_URL', default=None),
     'PHOTO_THUMBNAIL_SIZE': 200,
+    # Seconds to keep simplified GPS tracks in the cache. Tracks are keyed on their contents, so this only bounds memory.
+    'TRACK_CACHE_TIMEOUT': 60 * 60 * 24,
+    # Extensions used when pre-rendering journal page texts and journey descriptions. Run rerender_markdown after
+    # changing them.
+    'MARKDOWN_EXTENSIONS': ['extra', 'sane_lists'],
+    # Seconds that constance settings are kept in process memory, and how often other processes are checked for changes
+    'CONSTANCE_CACHE_TTL': 60,
+    'CONSTANCE_VERSION_CHECK_INTERVAL': 5,
+    # Anonymous GET requests to the read-only API skip authentication and are marked as cacheable by shared caches,
+    # tagged with Surrogate-Key headers. Changed objects are recorded in the purge log, see the cache_purges command.
+    'PUBLIC_READ_MODE': config('PUBLIC_READ_MODE', default=False, cast=bool),
+    'PUBLIC_CACHE_MAX_AGE': 60,
+    'PUBLIC_CACHE_S_MAXAGE': 60 * 60,
+    # Seconds that signed private image URLs stay valid. Expiry times are rounded up to whole steps, so that the same
+    # URL is handed out for a while.
+    'SIGNED_IMAGE_URL_TTL': 60 * 60 * 24,
+    'SIGNED_IMAGE_URL_STEP': 60 * 60,
+    # Keep a single copy of each photo and thumbnail under storage/objects, keyed by Photo.hash, and hard link the
+    # per-journey files to it. Run convert_storage after enabling it or adding photos.
+    'CONTENT_ADDRESSED_STORAGE': config('CONTENT_ADDRESSED_STORAGE', default=False, cast=bool),
+    # Adds Server-Timing headers and logs a JSON line per request to the journeylog.instrumentation logger, at warning
+    # level for requests over the (queries, milliseconds) budget of their view name, or the '*' budget otherwise.
+    'REQUEST_INSTRUMENTATION': config('REQUEST_INSTRUMENTATION', default=False, cast=bool),
+    'REQUEST_BUDGETS': {
+        '*': (50, 1000),
+        'journey-detail': (10, 1000),
+        'journey-list': (10, 2000),
+    },
+    # Staff can profile a request with ?profile=1 or an X-Profile: 1 header when this is set. The cProfile output and
+    # a collapsed stack file for flame graphs are kept in this directory, along with the last PROFILE_KEEP profiles.
+    'PROFILE_DIR': config('PROFILE_DIR', default=None),
+    'PROFILE_KEEP': 50,
+    'PROFILE_SAMPLE_INTERVAL': 0.001,
+    # Request, thumbnail, image and cache metrics for Prometheus at /metrics. Each process writes its values to a file
+    # in this directory at most once per METRICS_FLUSH_INTERVAL seconds, and the endpoint adds up all files. Files of
+    # processes that are gone are folded into archived.json, so totals only reset when the directory is cleared. Needs
+    # fcntl; elsewhere, each process only reports its own values.
+    'METRICS_DIR': config('METRICS_DIR', default=None),
+    'METRICS_FLUSH_INTERVAL': 1,
+    'METRICS_ALLOWED_IPS': ['127.0.0.1', '::1'],
 }
 
 CORS_ORIGIN_WHITELIST = config('CORS_ORIGIN', default=[], cast=lambda l: [item.strip() for item in l.split(',')])
 
-CONSTANCE_BACKEND = 'constance.backends.database.DatabaseBackend'
+CONSTANCE_BACKEND = 'journeylog.constance_backends.CachedDatabaseBackend'
 
 CONSTANCE_CONFIG = {
     'HOME_TIMEZONE': ("Etc/UTC", 'The timezone that home times should be shown in in the UI.', str),
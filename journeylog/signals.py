@@ -0,0 +1,182 @@
+import os
+import threading
+
+from constance.signals import config_updated
+from django.conf import settings
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete
+from django.dispatch import receiver
+
+from . import search, clustering, counters, caching
+from .models import Photo, JournalPage, Location, LocationName, JourneyLocationVisit, Journey, JourneyMapPointVisit, \
+    RequestProfile
+
+# Journeys being deleted in this thread. Their cascaded pages, visits and map points go along with them, so keeping the
+# journey's counters, track version and clusters up to date on the way out is wasted work.
+deleting_journeys = threading.local()
+
+
+def journeys_being_deleted():
+    if not hasattr(deleting_journeys, 'ids'):
+        deleting_journeys.ids = set()
+    return deleting_journeys.ids
+
+
+@receiver(pre_delete, sender=Journey)
+def remember_deleted_journey(sender, instance, **kwargs):
+    # All pre_delete signals of a delete, those of the cascaded objects too, are sent before the first post_delete one
+    journeys_being_deleted().add(instance.pk)
+
+
+@receiver(post_delete, sender=Journey)
+def forget_deleted_journey(sender, instance, **kwargs):
+    journeys_being_deleted().discard(instance.pk)
+
+
+@receiver(post_save, sender=Photo)
+@receiver(post_save, sender=JournalPage)
+def update_search_index(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    search.index_object(instance)
+
+
+@receiver(post_delete, sender=Photo)
+@receiver(post_delete, sender=JournalPage)
+def remove_from_search_index(sender, instance, **kwargs):
+    search.remove_object(instance)
+
+
+@receiver(pre_save, sender=Photo)
+@receiver(pre_save, sender=Location)
+@receiver(pre_save, sender=JourneyLocationVisit)
+@receiver(pre_delete, sender=Photo)
+@receiver(pre_delete, sender=Location)
+@receiver(pre_delete, sender=JourneyLocationVisit)
+def remember_cluster_state(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    instance._cluster_state = clustering.cluster_state(instance) if instance.pk else None
+
+
+@receiver(post_save, sender=Photo)
+@receiver(post_save, sender=Location)
+@receiver(post_save, sender=JourneyLocationVisit)
+def update_map_clusters(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    clustering.update_clusters(sender, getattr(instance, '_cluster_state', None), clustering.cluster_state(instance))
+
+
+@receiver(post_delete, sender=Photo)
+@receiver(post_delete, sender=Location)
+@receiver(post_delete, sender=JourneyLocationVisit)
+def remove_from_map_clusters(sender, instance, **kwargs):
+    if sender is JourneyLocationVisit and instance.journey_id in journeys_being_deleted():
+        return
+
+    clustering.update_clusters(sender, getattr(instance, '_cluster_state', None), None)
+
+
+@receiver(post_save, sender=JourneyMapPointVisit)
+@receiver(post_delete, sender=JourneyMapPointVisit)
+def bump_map_points_version(sender, instance, raw=False, **kwargs):
+    if raw or instance.journey_id in journeys_being_deleted():
+        return
+
+    Journey.objects.filter(id=instance.journey_id).update(map_points_version=F('map_points_version') + 1)
+
+
+@receiver(pre_save, sender=Photo)
+@receiver(pre_save, sender=JournalPage)
+@receiver(pre_save, sender=JourneyLocationVisit)
+@receiver(pre_delete, sender=Photo)
+@receiver(pre_delete, sender=JournalPage)
+@receiver(pre_delete, sender=JourneyLocationVisit)
+def remember_counter_state(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    instance._counter_state = counters.counter_state(instance) if instance.pk else None
+
+
+@receiver(post_save, sender=Photo)
+@receiver(post_save, sender=JournalPage)
+@receiver(post_save, sender=JourneyLocationVisit)
+def update_journey_counters(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    counters.update_counters(instance, getattr(instance, '_counter_state', None), counters.current_state(instance))
+
+
+@receiver(post_delete, sender=Photo)
+@receiver(post_delete, sender=JournalPage)
+@receiver(post_delete, sender=JourneyLocationVisit)
+def remove_from_journey_counters(sender, instance, **kwargs):
+    if instance.journey_id in journeys_being_deleted():
+        return
+
+    counters.update_counters(instance, getattr(instance, '_counter_state', None), None)
+
+
+@receiver(pre_delete, sender=Location)
+def remember_visiting_journeys(sender, instance, **kwargs):
+    # Visits of a deleted location are set to NULL with a plain UPDATE, which sends no signals of its own
+    instance._visiting_journeys = list(instance.visits.order_by().values_list('journey_id', flat=True).distinct())
+
+
+@receiver(post_delete, sender=Location)
+def recount_visiting_journeys(sender, instance, **kwargs):
+    journey_ids = getattr(instance, '_visiting_journeys', None)
+    if journey_ids:
+        counters.recount_journeys(journey_ids)
+
+
+@receiver(post_save, sender=Journey)
+@receiver(post_save, sender=JournalPage)
+@receiver(post_save, sender=Photo)
+@receiver(post_save, sender=Location)
+@receiver(post_save, sender=LocationName)
+@receiver(post_save, sender=JourneyLocationVisit)
+@receiver(post_save, sender=JourneyMapPointVisit)
+@receiver(post_delete, sender=Journey)
+@receiver(post_delete, sender=JournalPage)
+@receiver(post_delete, sender=Photo)
+@receiver(post_delete, sender=Location)
+@receiver(post_delete, sender=LocationName)
+@receiver(post_delete, sender=JourneyLocationVisit)
+@receiver(post_delete, sender=JourneyMapPointVisit)
+def log_cache_purge(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+
+    keys = caching.purge_keys(instance)
+
+    # Objects that moved to another journey also change how the old one looks
+    old_state = getattr(instance, '_counter_state', None)
+    if old_state and old_state[0] is not None:
+        keys.add('journey-{}'.format(old_state[0]))
+
+    caching.log_purge(keys)
+
+
+@receiver(config_updated)
+def log_config_cache_purge(sender, **kwargs):
+    # Settings such as EXPOSE_GPS affect most responses
+    caching.log_purge({caching.GLOBAL_SURROGATE_KEY})
+
+
+@receiver(post_delete, sender=RequestProfile)
+def remove_profile_files(sender, instance, **kwargs):
+    if not settings.JOURNEYLOG['PROFILE_DIR']:
+        return
+
+    for extension in ('prof', 'collapsed'):
+        try:
+            os.remove(instance.get_file_path(extension))
+        except OSError:
+            pass
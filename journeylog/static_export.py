@@ -0,0 +1,128 @@
+import gzip
+import os
+import shutil
+from collections import namedtuple
+from urllib.parse import urlsplit, quote
+
+from django.test import RequestFactory
+from django.urls import resolve
+
+from .models import Photo, Location, JourneyLocationVisit
+
+StaticExportResult = namedtuple('StaticExportResult', ('documents', 'images'))
+
+
+class StaticExporter:
+    # Renders the public API of a journey as an anonymous visitor would see it and writes every response to
+    # <path>/index.json, plus <path>/page-<n>.json for paginated lists, each with a pre-compressed .gz sibling.
+    def __init__(self, output_dir, base_url, link=True):
+        url = urlsplit(base_url)
+
+        self.output_dir = output_dir
+        self.link = link
+        self.secure = url.scheme != 'http'
+        self.factory = RequestFactory(HTTP_HOST=url.netloc, HTTP_ACCEPT='application/json')
+        self.documents = 0
+        self.images = 0
+
+    def fetch(self, path, params=None):
+        match = resolve(path)
+        response = match.func(self.factory.get(quote(path), params or {}, secure=self.secure), *match.args, **match.kwargs)
+        response.render()
+
+        if response.status_code != 200:
+            raise ValueError('{} returned HTTP {}'.format(path, response.status_code))
+
+        return response
+
+    def write_document(self, path, content, name='index.json'):
+        directory = os.path.join(self.output_dir, *[part for part in path.split('/') if part])
+        os.makedirs(directory, exist_ok=True)
+
+        file_path = os.path.join(directory, name)
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        with open(file_path + '.gz', 'wb') as f:
+            # A fixed mtime keeps repeated exports byte for byte identical
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9, mtime=0) as gz:
+                gz.write(content)
+
+        self.documents += 1
+
+    def export(self, path, params=None):
+        response = self.fetch(path, params)
+        self.write_document(path, response.content)
+
+        return response.data
+
+    def export_filtered(self, path, name, value):
+        # The list filtered with ?<name>=<value> goes to <path>/<name>-<value>.json, see doc/example-apache-static.conf
+        response = self.fetch(path, {name: value})
+        self.write_document(path, response.content, '{}-{}.json'.format(name, value))
+
+    def export_pages(self, path):
+        page = 1
+
+        while True:
+            response = self.fetch(path, {'page': page} if page > 1 else None)
+            self.write_document(path, response.content, 'page-{}.json'.format(page))
+            if page == 1:
+                self.write_document(path, response.content)
+
+            if not response.data.get('links', {}).get('next'):
+                return
+
+            page += 1
+
+    def copy_file(self, source, relative_path):
+        target = os.path.join(self.output_dir, relative_path)
+        if not os.path.exists(source):
+            return
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            os.remove(target)
+
+        if self.link:
+            try:
+                os.link(source, target)
+                self.images += 1
+                return
+            except OSError:
+                # Most likely on another file system
+                pass
+
+        shutil.copy2(source, target)
+        self.images += 1
+
+    def export_journey(self, journey):
+        base = '/journeys/{}/'.format(journey.slug)
+
+        self.export(base)
+        self.export(base + 'track/')
+        self.export(base + 'timeline/')
+        self.export(base + 'location-visits/')
+
+        for page in self.export(base + 'journal-pages/'):
+            self.export('{}journal-pages/{}/'.format(base, page['slug']))
+
+        self.export_pages(base + 'photos/')
+
+        for photo in Photo.objects.filter(journey=journey):
+            self.export('{}photos/{}/'.format(base, photo.filename))
+
+            if photo.confidentiality == 0 and os.path.exists(photo.get_storage_file_path('photo')):
+                photo.ensure_thumb()
+
+                for kind in ('photo', 'thumb'):
+                    source = photo.get_storage_file_path(kind)
+                    self.copy_file(source, os.path.join('image', 'public', kind, str(journey.id),
+                                                        os.path.basename(source)))
+
+        self.export_filtered('/locations/', 'journey', journey.slug)
+
+        location_ids = JourneyLocationVisit.objects.filter(journey=journey).exclude(location=None).values('location_id')
+        for location_id in Location.objects.filter(id__in=location_ids).values_list('id', flat=True):
+            self.export('/locations/{}/'.format(location_id))
+
+        return StaticExportResult(self.documents, self.images)
@@ -0,0 +1,165 @@
+import hashlib
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
+
+from PIL import Image
+from django.conf import settings
+
+from .models import Photo, StorageVerification, THUMBNAIL_EXTENSION, photo_storage_path
+
+HASH_CHUNK_SIZE = 1024 * 1024
+VERIFY_BATCH_SIZE = 500
+
+FileCheck = namedtuple('FileCheck', ('photo_id', 'path', 'hash', 'filesize', 'width', 'height'))
+
+
+def storage_problem(kind, path, photo_id=None, **details):
+    return dict(type=kind, photo=photo_id, path=path, **details)
+
+
+def inspect_file(check):
+    # Runs in the worker processes, so it must not touch the database
+    try:
+        stat = os.stat(check.path)
+        digest = hashlib.sha1()
+        buffer = bytearray(HASH_CHUNK_SIZE)
+        view = memoryview(buffer)
+
+        with open(check.path, 'rb') as f:
+            while True:
+                length = f.readinto(buffer)
+                if not length:
+                    break
+                digest.update(view[:length])
+
+        # Only the header is parsed; the pixel data is never decoded
+        with Image.open(check.path) as image:
+            size = image.size
+    except FileNotFoundError:
+        return check.photo_id, None, [storage_problem('missing', check.path, check.photo_id)]
+    except OSError as e:
+        return check.photo_id, None, [storage_problem('unreadable', check.path, check.photo_id, error=str(e))]
+
+    problems = []
+    for field, expected, actual in (('filesize', check.filesize, stat.st_size),
+                                    ('hash', check.hash, digest.hexdigest())):
+        if expected != actual:
+            problems.append(storage_problem('mismatch', check.path, check.photo_id, field=field, expected=expected,
+                                            actual=actual))
+
+    # EXIF rotated photos may have been recorded with their displayed dimensions
+    if (check.width, check.height) not in (size, size[::-1]):
+        problems.append(storage_problem('mismatch', check.path, check.photo_id, field='dimensions',
+                                        expected=[check.width, check.height], actual=list(size)))
+
+    return check.photo_id, stat.st_mtime_ns, problems
+
+
+class StorageVerifier:
+    # Compares the original of every photo with its database record, and lists files under storage/ that don't belong
+    # to any photo. Files that are unchanged since their last successful check are skipped unless full is set.
+    def __init__(self, full=False, jobs=None, batch_size=VERIFY_BATCH_SIZE):
+        self.full = full
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.checked = 0
+        self.skipped = 0
+        self.problems = 0
+
+    def iter_rows(self):
+        # Fetched in separate batches rather than with iterator(), as verifications are written in between
+        rows = Photo.objects.order_by('id').values_list(
+            'id', 'journey_id', 'filename', 'confidentiality', 'hash', 'filesize', 'width', 'height',
+            'verification__path', 'verification__hash', 'verification__mtime_ns'
+        )
+        last_id = 0
+
+        while True:
+            batch = list(rows.filter(id__gt=last_id)[:self.batch_size])
+            if not batch:
+                return
+
+            yield from batch
+            last_id = batch[-1][0]
+
+    def iter_checks(self, known_files):
+        for (photo_id, journey_id, filename, confidentiality, photo_hash, filesize, width, height,
+             verified_path, verified_hash, verified_mtime_ns) in self.iter_rows():
+            visibility = 'private' if confidentiality > 0 else 'public'
+            path = photo_storage_path(visibility, 'photo', journey_id, filename)
+            known_files.add((visibility, str(journey_id), filename))
+
+            if not self.full and verified_path == path and verified_hash == photo_hash:
+                try:
+                    if os.stat(path).st_mtime_ns == verified_mtime_ns:
+                        self.skipped += 1
+                        continue
+                except OSError:
+                    pass
+
+            yield FileCheck(photo_id, path, photo_hash, filesize, width, height)
+
+    def record(self, batch, results):
+        checks = {check.photo_id: check for check in batch}
+
+        StorageVerification.objects.filter(photo_id__in=checks).delete()
+        StorageVerification.objects.bulk_create([
+            StorageVerification(photo_id=photo_id, path=checks[photo_id].path, hash=checks[photo_id].hash,
+                                mtime_ns=mtime_ns)
+            for photo_id, mtime_ns, problems in results if not problems
+        ])
+
+    def verify_files(self, known_files, map_function):
+        batch = []
+
+        for check in chain(self.iter_checks(known_files), [None]):
+            if check is not None:
+                batch.append(check)
+                if len(batch) < self.batch_size:
+                    continue
+
+            results = list(map_function(inspect_file, batch))
+            self.record(batch, results)
+            self.checked += len(batch)
+            batch = []
+
+            for photo_id, mtime_ns, problems in results:
+                yield from problems
+
+    def iter_orphans(self, known_files):
+        root = os.path.join(settings.BASE_DIR, 'storage')
+
+        for visibility in ('public', 'private'):
+            for kind in ('photo', 'thumb'):
+                directory = os.path.join(root, visibility, kind)
+
+                for path, _, filenames in os.walk(directory):
+                    journey_id = os.path.relpath(path, directory).split(os.sep)[0]
+
+                    for filename in filenames:
+                        name = filename
+                        if kind == 'thumb' and name.endswith(THUMBNAIL_EXTENSION):
+                            name = name[:-len(THUMBNAIL_EXTENSION)]
+
+                        if (visibility, journey_id, name) not in known_files:
+                            yield storage_problem('orphan', os.path.join(path, filename))
+
+    def iter_problems(self):
+        known_files = set()
+
+        if self.jobs == 1:
+            yield from self.verify_files(known_files, map)
+        else:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                yield from self.verify_files(known_files, partial(executor.map, chunksize=8))
+
+        # Only meaningful once every photo has been listed
+        yield from self.iter_orphans(known_files)
+
+    def run(self):
+        for problem in self.iter_problems():
+            self.problems += 1
+            yield problem
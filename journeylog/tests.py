@@ -1,3 +1,1209 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
 
-# Create your tests here.
+import numpy as np
+import pytz
+import tablib
+from PIL import Image
+from constance import config
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management import call_command
+from django.db import connection, IntegrityError, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from import_export.results import RowResult
+
+from . import counters, clustering, metrics
+from .admin import LocationResource
+from .benchmarks import BenchmarkRunner, generate_fixtures
+from .duplicates import BKTree, hamming_distance, journey_duplicate_groups
+from .renderers import TRACK_BINARY_HEADER, TRACK_BINARY_MAGIC, TRACK_BINARY_VERSION, PolylineRenderer, \
+    TrackBinaryRenderer, encode_polyline
+from .replay import parse_access_log
+from .storage_check import StorageVerifier
+from .filters import PhotoFilter
+from .importers import import_track
+from .metrics import ProcessMetrics, process_metrics, increment, collect
+from .models import Journey, JournalPage, Location, LocationName, Photo, JourneyLocationVisit, CachePurge, \
+    RequestProfile, MapCluster, JourneyMapPointVisit, prefetch_page_photos, THUMBNAIL_EXTENSION
+from .util.geo import GEOHASH_MAX_QUERY_PRECISION, geohash_cells, geohash_encode
+from .views import JourneyViewSet, PhotoViewSet, JourneyPhotoViewSet, JourneyJournalPageViewSet, LocationViewSet, \
+    JourneyLocationVisitViewSet
+
+SQLITE_FULL_SCAN = re.compile(r'\bSCAN (TABLE )?(?P<table>\w+)\b(?! USING (COVERING )?INDEX)')
+SQLITE_SORT = re.compile(r'USE TEMP B-TREE FOR (RIGHT PART OF )?(ORDER BY|GROUP BY|DISTINCT)')
+POSTGRESQL_FULL_SCAN = re.compile(r'\bSeq Scan on (?P<table>\w+)')
+POSTGRESQL_SORT = re.compile(r'(^|->)\s*(Incremental )?Sort\b', re.MULTILINE)
+
+
+class PhotoSearchTests(TestCase):
+    def test_partial_queries_match(self):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        for i, name in enumerate(('Temple gate', 'Temples of Kyoto', 'Harbour')):
+            Photo.objects.create(journey=journey, name=name, timezone='UTC', timestamp=datetime(2018, 10, 1 + i),
+                                 filename='IMG_{:04d}.jpg'.format(i + 1), filesize=1024, width=400, height=300,
+                                 hash='{:040d}'.format(i))
+
+        def search_photos(query):
+            response = self.client.get('/photos/', {'search': query})
+            return sorted(photo['name'] for photo in response.json()['results'])
+
+        self.assertEqual(search_photos('0001'), ['Temple gate'])
+        self.assertEqual(search_photos('img_000'), ['Harbour', 'Temple gate', 'Temples of Kyoto'])
+        self.assertEqual(search_photos('templ'), ['Temple gate', 'Temples of Kyoto'])
+        self.assertEqual(search_photos('gate templ'), ['Temple gate'])
+        self.assertEqual(search_photos('kyoto'), ['Temples of Kyoto'])
+        self.assertEqual(search_photos('castle'), [])
+
+
+class SearchEndpointTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.journey = Journey.objects.create(slug='japan', name='Japan')
+        for i, (name, confidentiality) in enumerate((('Temple gate', 0), ('Temple garden', 1))):
+            Photo.objects.create(journey=cls.journey, name=name, description='Evening at the temple', timezone='UTC',
+                                 timestamp=datetime(2018, 10, 1 + i, tzinfo=pytz.utc),
+                                 filename='IMG_{:04d}.jpg'.format(i), filesize=1024, width=400, height=300,
+                                 hash='{:040d}'.format(i), confidentiality=confidentiality)
+        JournalPage.objects.create(journey=cls.journey, slug='kyoto', name='Kyoto',
+                                   text='We walked up to the temples above Kyoto & ate <b>mochi</b>.')
+
+    def search(self, **params):
+        response = self.client.get('/search/', params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_the_last_term_matches_word_prefixes(self):
+        results = self.search(q='templ', kind='photo,journal_page').json()['results']
+        self.assertEqual(sorted(result['title'] for result in results),
+                         ['<mark>Temple</mark> garden', '<mark>Temple</mark> gate', 'Kyoto'])
+        self.assertEqual([result['title'] for result in self.search(q='gate templ').json()['results']],
+                         ['<mark>Temple</mark> <mark>gate</mark>'])
+        self.assertEqual(self.search(q='temp gate').json()['results'], [])
+
+    def test_snippets_highlight_the_matches(self):
+        result = self.search(q='mochi').json()['results'][0]
+        self.assertEqual(result['snippet'],
+                         'We walked up to the temples above Kyoto &amp; ate &lt;b&gt;<mark>mochi</mark>&lt;/b&gt;.')
+
+    def test_confidential_photos_link_images_only_for_users(self):
+        def thumb_urls():
+            return {result['title']: result['thumbUrl'] for result in self.search(q='evening').json()['results']}
+
+        self.assertIsNone(thumb_urls()['Temple garden'])
+        self.assertTrue(thumb_urls()['Temple gate'].startswith('/image/public/'))
+
+        self.client.force_login(User.objects.create_user('user'))
+        self.assertTrue(thumb_urls()['Temple garden'].startswith('/image/private/'))
+
+
+class QueryPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        start = datetime(2018, 10, 1, tzinfo=pytz.utc)
+
+        for j in range(3):
+            journey = Journey.objects.create(slug='journey-{}'.format(j), name='Journey {}'.format(j),
+                                             date_start=start, date_end=start + timedelta(days=30))
+
+            Photo.objects.bulk_create([
+                Photo(journey=journey, name='Photo {}'.format(i), timezone='Asia/Tokyo',
+                      timestamp=start + timedelta(hours=i), filename='IMG_{:04d}.jpg'.format(i),
+                      filesize=1024, width=400, height=300, hash='{:040d}'.format(i))
+                for i in range(200)
+            ])
+
+            for d in range(5):
+                JournalPage.objects.create(journey=journey, slug='journey-{}-day-{}'.format(j, d),
+                                           name='Day {}'.format(d), order_no=d, date_start=start + timedelta(days=d))
+
+            for i in range(20):
+                location = Location.objects.create(name='Location {}-{}'.format(j, i), latitude=35, longitude=139)
+                LocationName.objects.create(location=location, lang='ja_JP', name='Location {}'.format(i),
+                                            sort_key='location {}'.format(i))
+                JourneyLocationVisit.objects.create(journey=journey, location=location,
+                                                    timestamp=start + timedelta(hours=i))
+
+    def get_view(self, view_class, **kwargs):
+        view = view_class()
+        view.kwargs = kwargs
+        return view
+
+    def assertIndexedPlan(self, queryset):
+        vendor = connection.vendor
+
+        if vendor == 'sqlite':
+            plan = queryset.explain()
+            full_scan, sort = SQLITE_FULL_SCAN, SQLITE_SORT
+        elif vendor == 'postgresql':
+            # The seeded tables are tiny, so the planner has to be told to prefer indexes for the plan to be meaningful.
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('SET LOCAL enable_sort = off')
+            plan = queryset.explain()
+            full_scan, sort = POSTGRESQL_FULL_SCAN, POSTGRESQL_SORT
+        else:
+            self.skipTest('Query plan checks are not implemented for {}'.format(vendor))
+            return
+
+        self.assertIsNone(full_scan.search(plan), 'Query falls back to a full table scan:\n{}\n\n{}'.format(
+            queryset.query, plan))
+        self.assertIsNone(sort.search(plan), 'Query falls back to a sort:\n{}\n\n{}'.format(queryset.query, plan))
+
+    def test_photo_list(self):
+        self.assertIndexedPlan(PhotoViewSet.queryset.all())
+
+    def test_photo_filter(self):
+        queryset = PhotoFilter({
+            'journey': 'journey-1',
+            'after': '2018-10-02T00:00:00Z',
+            'before': '2018-10-03T00:00:00Z',
+        }, queryset=PhotoViewSet.queryset.all()).qs
+
+        self.assertIndexedPlan(queryset)
+
+    def test_journey_photo_list(self):
+        self.assertIndexedPlan(self.get_view(JourneyPhotoViewSet, journey_slug='journey-1').get_queryset())
+
+    def test_journal_page_photos(self):
+        page = JournalPage.objects.get(slug='journey-1-day-2')
+        self.assertIndexedPlan(page.photo_queryset())
+
+    def test_journey_journal_page_list(self):
+        self.assertIndexedPlan(self.get_view(JourneyJournalPageViewSet, journey_slug='journey-1').get_queryset())
+
+    def test_journey_location_visit_list(self):
+        self.assertIndexedPlan(self.get_view(JourneyLocationVisitViewSet, journey_slug='journey-1').get_queryset())
+
+    def test_location_list(self):
+        self.assertIndexedPlan(LocationViewSet.queryset.all())
+
+    def test_journey_list(self):
+        self.assertIndexedPlan(JourneyViewSet.queryset.all())
+
+
+class DefaultOrderingTests(TestCase):
+    def test_related_models_are_ordered_by_their_own_ordering(self):
+        later = Journey.objects.create(slug='korea', name='Korea', date_start=datetime(2019, 5, 1, tzinfo=pytz.utc))
+        earlier = Journey.objects.create(slug='japan', name='Japan', date_start=datetime(2018, 10, 1, tzinfo=pytz.utc))
+        for journey in (later, earlier):
+            for order_no in (1, 0):
+                JournalPage.objects.create(journey=journey, slug='{}-{}'.format(journey.slug, order_no),
+                                           order_no=order_no)
+
+        self.assertEqual([page.slug for page in JournalPage.objects.all()],
+                         ['japan-0', 'japan-1', 'korea-0', 'korea-1'])
+
+        for name in ('Tokyo', 'Kyoto'):
+            location = Location.objects.create(name=name, latitude=35, longitude=139)
+            LocationName.objects.create(location=location, lang='en_US', name=name, sort_key='same')
+
+        self.assertEqual([name.name for name in LocationName.objects.all()], ['Kyoto', 'Tokyo'])
+
+
+class GeoFilterTests(TestCase):
+    def setUp(self):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        places = (('Tokyo', 35.6895, 139.6917), ('Next door', 35.68951, 139.69171), ('Yokohama', 35.4437, 139.638),
+                  ('Osaka', 34.6937, 135.5023), ('Antipode', -12.345678, -180))
+        for i, (name, latitude, longitude) in enumerate(places):
+            Photo.objects.create(journey=journey, name=name, timezone='UTC', timestamp=datetime(2018, 10, 1 + i),
+                                 filename='IMG_{:04d}.jpg'.format(i), filesize=1024, width=400, height=300,
+                                 hash='{:040d}'.format(i), latitude=latitude, longitude=longitude)
+
+    def photo_names(self, **params):
+        response = self.client.get('/photos/', params)
+        self.assertEqual(response.status_code, 200)
+        return [photo['name'] for photo in response.json()['results']]
+
+    def test_bbox_keeps_the_photos_inside(self):
+        self.assertEqual(sorted(self.photo_names(bbox='35,139,36,140')), ['Next door', 'Tokyo', 'Yokohama'])
+        self.assertEqual(sorted(self.photo_names(bbox='34,-170,40,170')), ['Next door', 'Osaka', 'Tokyo', 'Yokohama'])
+        self.assertEqual(self.photo_names(bbox='-13,179,-12,-179'), ['Antipode'])
+
+    def test_cells_below_the_query_precision_are_refined_by_coordinates(self):
+        bbox = (35.68949, 139.69169, 35.689505, 139.691705)
+        self.assertEqual(geohash_cells(*bbox), [geohash_encode(35.68951, 139.69171, GEOHASH_MAX_QUERY_PRECISION)])
+        self.assertEqual(self.photo_names(bbox=','.join(map(str, bbox))), ['Tokyo'])
+
+    def test_near_is_ordered_by_distance(self):
+        self.assertEqual(self.photo_names(near='35.4437,139.638', radius=40000), ['Yokohama', 'Tokyo', 'Next door'])
+        self.assertEqual(self.photo_names(near='35.68951,139.69171'), ['Next door', 'Tokyo'])
+        self.assertEqual(self.photo_names(near='35.4437,139.638', radius=40000, ordering='-timestamp'),
+                         ['Yokohama', 'Next door', 'Tokyo'])
+
+    def test_near_reaches_the_antipode(self):
+        self.assertEqual(self.photo_names(near='12.345678,0', radius=30000000)[-1], 'Antipode')
+
+    def test_coordinates_are_hidden_without_gps(self):
+        config.EXPOSE_GPS = False
+        self.addCleanup(setattr, config, 'EXPOSE_GPS', True)
+        self.assertEqual(self.photo_names(bbox='35,139,36,140'), [])
+        self.assertEqual(self.photo_names(near='35.6895,139.6917'), [])
+
+
+class MapClusterTests(TransactionTestCase):
+    def test_global_clusters_are_unique(self):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        fields = dict(kind=MapCluster.PHOTO, precision=3, geohash='xn7', count=1, latitude=35.6, longitude=139.7)
+
+        MapCluster.objects.create(journey=journey, **fields)
+        MapCluster.objects.create(journey=None, **fields)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            MapCluster.objects.create(journey=None, **fields)
+
+    def test_saves_in_a_transaction_share_a_recomputation(self):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+
+        def cluster_queries(count, latitude):
+            with CaptureQueriesContext(connection) as queries, transaction.atomic():
+                for i in range(count):
+                    Photo.objects.create(journey=journey, name='Photo', timezone='UTC', latitude=latitude,
+                                         longitude=139.69, timestamp=datetime(2018, 10, 1, tzinfo=pytz.utc),
+                                         filename='IMG_{}_{}.jpg'.format(latitude, i), filesize=1024, width=400,
+                                         height=300, hash='{:040d}'.format(i))
+                self.assertFalse(MapCluster.objects.filter(precision=8, geohash=geohash_encode(latitude, 139.69)[:8])
+                                 .exists())
+
+            return len([query for query in queries if 'journeylog_mapcluster' in query['sql']])
+
+        self.assertEqual(cluster_queries(1, 35.68), cluster_queries(10, -33.86))
+
+        def cluster_values():
+            return set(MapCluster.objects.values_list('kind', 'scope', 'precision', 'geohash', 'count', 'photo_id'))
+
+        clusters = cluster_values()
+        clustering.rebuild_clusters()
+        self.assertEqual(clusters, cluster_values())
+
+
+class JourneyTrackTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        start = datetime(2018, 10, 1, tzinfo=pytz.utc)
+        for i in range(5):
+            JourneyMapPointVisit.objects.create(journey=journey, latitude=35 + i / 10, longitude=139 + i % 2 / 10,
+                                                timestamp=start + timedelta(minutes=i))
+
+    def test_track(self):
+        response = self.client.get('/journeys/japan/track/', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['count'], 5)
+
+    def test_track_is_hidden_without_gps(self):
+        config.EXPOSE_GPS = False
+        self.addCleanup(setattr, config, 'EXPOSE_GPS', True)
+
+        self.assertEqual(self.client.get('/journeys/japan/track/', HTTP_ACCEPT='application/json').json(),
+                         {'zoom': 16, 'count': 0, 'points': []})
+        self.assertEqual(self.client.get('/journeys/japan/track/', {'format': 'polyline'}).json(),
+                         {'count': 0, 'precision': 5, 'polyline': '', 'startTime': 0, 'timeDeltas': []})
+        self.assertEqual(self.client.get('/journeys/japan/track/', {'format': 'bin'}).content,
+                         TRACK_BINARY_HEADER.pack(TRACK_BINARY_MAGIC, TRACK_BINARY_VERSION, 0, 0, 0))
+
+    def test_polyline_encoding(self):
+        self.assertEqual(encode_polyline([38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]),
+                         '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        # Points without coordinates stay where the previous one was
+        self.assertEqual(encode_polyline([38.5, float('nan'), 40.7], [-120.2, float('nan'), -120.95]),
+                         '_p~iF~ps|U??_ulLnnqC')
+
+    def test_polyline_track(self):
+        response = self.client.get('/journeys/japan/track/', HTTP_ACCEPT=PolylineRenderer.media_type)
+
+        self.assertEqual(response['Content-Type'], PolylineRenderer.media_type)
+        self.assertEqual(response.json(), {
+            'count': 5,
+            'precision': 5,
+            'polyline': encode_polyline([35, 35.1, 35.2, 35.3, 35.4], [139, 139.1, 139, 139.1, 139]),
+            'startTime': int(datetime(2018, 10, 1, tzinfo=pytz.utc).timestamp()),
+            'timeDeltas': [0, 60, 60, 60, 60],
+        })
+
+    def test_binary_track(self):
+        content = self.client.get('/journeys/japan/track/', HTTP_ACCEPT=TrackBinaryRenderer.media_type).content
+
+        magic, version, flags, count, start = TRACK_BINARY_HEADER.unpack_from(content)
+        self.assertEqual((magic, version, flags, count, start), (
+            TRACK_BINARY_MAGIC, TRACK_BINARY_VERSION, 0, 5, int(datetime(2018, 10, 1, tzinfo=pytz.utc).timestamp())))
+
+        columns = content[TRACK_BINARY_HEADER.size:]
+        self.assertEqual(len(columns), 3 * 4 * count)
+        self.assertEqual(np.frombuffer(columns, '<f4', count).tolist(),
+                         np.array([35, 35.1, 35.2, 35.3, 35.4], dtype='<f4').tolist())
+        self.assertEqual(np.frombuffer(columns, '<f4', count, 4 * count).tolist(),
+                         np.array([139, 139.1, 139, 139.1, 139], dtype='<f4').tolist())
+        self.assertEqual(np.frombuffer(columns, '<i4', count, 8 * count).tolist(), [0, 60, 120, 180, 240])
+
+
+class TrackImportTests(TestCase):
+    KML = b'''<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">
+  <Document>
+    <Placemark>
+      <gx:Track>
+        <when>2018-10-01T00:00:00Z</when>
+        <when>2018-10-01T00:01:00Z</when>
+        <when>2018-10-01T00:02:00Z</when>
+        <gx:coord>139.7 35.6 0</gx:coord>
+        <gx:coord>139.8</gx:coord>
+        <gx:coord>139.9 35.8 0</gx:coord>
+      </gx:Track>
+    </Placemark>
+    <Placemark>
+      <TimeStamp><when>2018-10-01T00:03:00Z</when></TimeStamp>
+      <Point><coordinates>140.0</coordinates></Point>
+    </Placemark>
+  </Document>
+</kml>'''
+
+    def test_import(self):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+
+        for _ in range(2):
+            result = import_track(journey, io.BytesIO(self.KML), 'kml', replace=True)
+
+            self.assertEqual((result.imported, result.skipped, len(result.errors)), (2, 2, 2))
+            self.assertEqual(list(JourneyMapPointVisit.objects.filter(journey=journey)
+                                  .values_list('latitude', 'longitude', 'geohash')),
+                             [(Decimal('35.6'), Decimal('139.7'), geohash_encode(35.6, 139.7)),
+                              (Decimal('35.8'), Decimal('139.9'), geohash_encode(35.8, 139.9))])
+
+    def test_gpx_waypoints_are_not_imported(self):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        waypoint = '<wpt lat="34.0" lon="135.0"><time>2018-10-01T00:30:00Z</time></wpt>'
+        route = '<rte><rtept lat="36.0" lon="140.0"><time>2018-10-01T00:10:00Z</time></rtept></rte>'
+        track = '<trk><trkseg><trkpt lat="35.6" lon="139.7"><time>2018-10-01T00:00:00Z</time></trkpt></trkseg></trk>'
+
+        for parts, latitudes in (((waypoint, route, track), [Decimal('35.6')]),
+                                 ((waypoint, route), [Decimal('36.0')])):
+            gpx = '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1">{}</gpx>'.format(''.join(parts))
+            import_track(journey, io.BytesIO(gpx.encode()), 'gpx', replace=True)
+
+            self.assertEqual(list(JourneyMapPointVisit.objects.filter(journey=journey)
+                                  .values_list('latitude', flat=True)), latitudes)
+
+
+class LocationImportTests(TransactionTestCase):
+    def cluster_values(self):
+        return set(MapCluster.objects.values_list('kind', 'journey_id', 'precision', 'geohash', 'count', 'location_id'))
+
+    def test_import_updates_clusters(self):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        tokyo = Location.objects.create(name='Tokyo', latitude=35.68, longitude=139.69)
+        Location.objects.create(name='Osaka', latitude=34.69, longitude=135.50)
+        JourneyLocationVisit.objects.create(journey=journey, location=tokyo,
+                                            timestamp=datetime(2018, 10, 1, tzinfo=pytz.utc))
+
+        dataset = tablib.Dataset(headers=('id', 'name', 'type', 'latitude', 'longitude', 'color'))
+        dataset.append((tokyo.id, 'Tokyo', tokyo.type, '35.010000', '135.770000', ''))
+        dataset.append(('', 'Sapporo', tokyo.type, '43.060000', '141.350000', ''))
+
+        result = LocationResource().import_data(dataset)
+        self.assertFalse(result.has_errors())
+
+        imported = self.cluster_values()
+        clustering.rebuild_clusters()
+        self.assertEqual(imported, self.cluster_values())
+
+    def test_only_unchanged_rows_are_skipped(self):
+        tokyo = Location.objects.create(name='Tokyo', latitude=35.68, longitude=139.69)
+        osaka = Location.objects.create(name='Osaka', latitude=34.69, longitude=135.50)
+
+        dataset = tablib.Dataset(headers=('id', 'name', 'type', 'latitude', 'longitude', 'color'))
+        dataset.append((tokyo.id, 'Tokyo', tokyo.type, '35.680000', '139.690000', ''))
+        dataset.append((osaka.id, 'Ōsaka', osaka.type, '34.690000', '135.500000', ''))
+
+        result = LocationResource().import_data(dataset)
+
+        self.assertEqual([row.import_type for row in result.rows], [RowResult.IMPORT_TYPE_SKIP,
+                                                                     RowResult.IMPORT_TYPE_UPDATE])
+        self.assertEqual(list(Location.objects.order_by('id').values_list('name', flat=True)), ['Tokyo', 'Ōsaka'])
+
+    def test_imports_are_written_in_batches(self):
+        class BatchedLocationResource(LocationResource):
+            class Meta(LocationResource.Meta):
+                batch_size = 2
+
+        dataset = tablib.Dataset(headers=('id', 'name', 'type', 'latitude', 'longitude', 'color'))
+        for i in range(5):
+            dataset.append(('', 'Location {}'.format(i), Location.PLACE, '35.000000', '139.000000', ''))
+
+        with CaptureQueriesContext(connection) as queries:
+            result = BatchedLocationResource().import_data(dataset, raise_errors=True)
+
+        self.assertFalse(result.has_errors())
+        self.assertEqual(Location.objects.count(), 5)
+        inserts = [query for query in queries if re.match(r'INSERT INTO \W?journeylog_location\W', query['sql'])]
+        self.assertEqual(len(inserts), 3)
+
+
+class TimelineTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+
+        for i, hour in enumerate((10, 14, 23)):
+            Photo.objects.create(journey=journey, name='Photo {}'.format(i), timezone='Asia/Tokyo',
+                                 timestamp=datetime(2018, 10, 1, hour, 30, tzinfo=pytz.utc),
+                                 filename='IMG_{:04d}.jpg'.format(i), filesize=1024, width=400, height=300,
+                                 hash='{:040d}'.format(i))
+
+        JourneyLocationVisit.objects.create(journey=journey, timestamp=datetime(2018, 10, 1, 23, tzinfo=pytz.utc))
+
+    def test_local_days(self):
+        response = self.client.get('/journeys/japan/timeline/', {'bucket': 'day'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['photos'], [
+            {'start': '2018-10-01T00:00:00', 'count': 2},
+            {'start': '2018-10-02T00:00:00', 'count': 1},
+        ])
+        self.assertEqual(response.json()['locationVisits'], [{'start': '2018-10-01T00:00:00', 'count': 1}])
+
+    def test_home_hours(self):
+        response = self.client.get('/journeys/japan/timeline/', {'bucket': 'hour', 'timezone': 'home'})
+
+        self.assertEqual([bucket['start'] for bucket in response.json()['photos']], [
+            '2018-10-01T10:00:00', '2018-10-01T14:00:00', '2018-10-01T23:00:00',
+        ])
+
+    def test_invalid_bucket(self):
+        self.assertEqual(self.client.get('/journeys/japan/timeline/', {'bucket': 'week'}).status_code, 400)
+
+
+class JourneyCounterTests(TestCase):
+    def counter_values(self, journey):
+        journey.refresh_from_db()
+        return [getattr(journey, name) for name in Journey.DERIVED_FIELDS if name != 'map_points_version']
+
+    def test_incremental_counters_match_recount(self):
+        start = datetime(2018, 10, 1, tzinfo=pytz.utc)
+        japan = Journey.objects.create(slug='japan', name='Japan')
+        korea = Journey.objects.create(slug='korea', name='Korea')
+
+        photos = [
+            Photo.objects.create(journey=japan, name='Photo {}'.format(i), timezone='UTC',
+                                 timestamp=start + timedelta(days=i), filename='IMG_{:04d}.jpg'.format(i),
+                                 filesize=1024 * (i + 1), width=400, height=300, hash='{:040d}'.format(i))
+            for i in range(4)
+        ]
+        locations = [Location.objects.create(name='Location {}'.format(i), latitude=35, longitude=139)
+                     for i in range(2)]
+        visits = [JourneyLocationVisit.objects.create(journey=japan, location=location, timestamp=start)
+                  for location in locations + locations]
+        page = JournalPage.objects.create(journey=korea, slug='korea-day-1')
+
+        photos[0].delete()
+        photos[3].journey = korea
+        photos[3].save()
+        visits[0].delete()
+        visits[1].location = locations[0]
+        visits[1].save()
+        page.journey = japan
+        page.save()
+        japan.save()
+
+        expected = [self.counter_values(japan), self.counter_values(korea)]
+        self.assertEqual(expected[0], [1, 2, 1024 * 5, start + timedelta(days=1), start + timedelta(days=2), 2])
+
+        Journey.objects.update(photos_count=0, visited_locations_count=0, photos_date_start=None)
+        counters.recount_journeys()
+        self.assertEqual([self.counter_values(japan), self.counter_values(korea)], expected)
+
+    def test_stale_journeys_keep_the_stored_counters(self):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        JournalPage.objects.create(journey=journey, slug='japan-day-1')
+
+        journey.name = 'Nippon'
+        journey.save()
+        journey.refresh_from_db()
+        self.assertEqual((journey.name, journey.journal_pages_count), ('Nippon', 1))
+
+    def test_journeys_without_a_row_are_inserted(self):
+        Journey(id=100, slug='japan', name='Japan').save()
+        journey = Journey.objects.create(slug='korea', name='Korea')
+        Journey.objects.filter(id=journey.id).delete()
+        journey.save()
+        self.assertEqual(set(Journey.objects.values_list('id', flat=True)), {100, journey.id})
+
+    def test_deleted_journeys_skip_counter_updates(self):
+        start = datetime(2018, 10, 1, tzinfo=pytz.utc)
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        location = Location.objects.create(name='Tokyo', latitude=35, longitude=139)
+        for i in range(3):
+            JournalPage.objects.create(journey=journey, slug='japan-day-{}'.format(i))
+            JourneyLocationVisit.objects.create(journey=journey, location=location, timestamp=start)
+            JourneyMapPointVisit.objects.create(journey=journey, latitude=35, longitude=139, timestamp=start)
+
+        with CaptureQueriesContext(connection) as queries:
+            journey.delete()
+        self.assertFalse([query['sql'] for query in queries if query['sql'].startswith('UPDATE "journeylog_journey"')])
+        self.assertFalse(JournalPage.objects.exists())
+
+
+class MarkdownRenderingTests(TestCase):
+    def setUp(self):
+        self.journey = Journey.objects.create(slug='japan', name='Japan', description='*Ten days* in Japan')
+        self.page = JournalPage.objects.create(journey=self.journey, slug='day-1', text='*Hello*')
+
+    def stored_html(self):
+        return JournalPage.objects.values_list('text_html', flat=True).get(id=self.page.id)
+
+    def test_rendered_html_follows_the_source(self):
+        self.assertEqual(self.stored_html(), '<p><em>Hello</em></p>')
+
+        self.page.text = '**Bye**'
+        self.page.save()
+        self.assertEqual(self.stored_html(), '<p><strong>Bye</strong></p>')
+
+    def test_unchanged_sources_are_not_rendered_again(self):
+        JournalPage.objects.filter(id=self.page.id).update(text_html='<p>Stale</p>')
+        self.page.refresh_from_db()
+
+        self.page.name = 'Day 1'
+        self.page.save()
+        call_command('rerender_markdown', stdout=io.StringIO())
+        self.assertEqual(self.stored_html(), '<p>Stale</p>')
+
+        with override_settings(JOURNEYLOG=dict(settings.JOURNEYLOG, MARKDOWN_EXTENSIONS=['extra'])):
+            call_command('rerender_markdown', stdout=io.StringIO())
+        self.assertEqual(self.stored_html(), '<p><em>Hello</em></p>')
+
+    def test_html_markup_replaces_the_markdown_fields(self):
+        page = self.client.get('/journeys/japan/journal-pages/day-1/').json()
+        self.assertEqual(page['text'], '*Hello*')
+        self.assertNotIn('textHtml', page)
+
+        page = self.client.get('/journeys/japan/journal-pages/day-1/', {'markup': 'html'}).json()
+        self.assertEqual(page['textHtml'], '<p><em>Hello</em></p>')
+        self.assertNotIn('text', page)
+
+        journey = self.client.get('/journeys/japan/', {'markup': 'html'}).json()
+        self.assertEqual(journey['descriptionHtml'], '<p><em>Ten days</em> in Japan</p>')
+        self.assertNotIn('description', journey)
+
+
+class ConstanceCacheTests(TestCase):
+    def test_values_are_served_from_memory(self):
+        config._backend.invalidate()
+        # Missing values are written back with their defaults on first access
+        config.HOME_TIMEZONE
+        config.EXPOSE_GPS
+
+        with self.assertNumQueries(0):
+            config.HOME_TIMEZONE
+            config.EXPOSE_GPS
+
+    def test_changes_invalidate_the_cache(self):
+        config.HOME_TIMEZONE = 'Asia/Tokyo'
+        self.assertEqual(config.HOME_TIMEZONE, 'Asia/Tokyo')
+
+        config.HOME_TIMEZONE = 'Etc/UTC'
+        self.assertEqual(config.HOME_TIMEZONE, 'Etc/UTC')
+
+
+@override_settings(JOURNEYLOG=dict(settings.JOURNEYLOG, PUBLIC_READ_MODE=True))
+class PublicReadModeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.journey = Journey.objects.create(slug='japan', name='Japan')
+        cls.photo = Photo.objects.create(journey=cls.journey, name='Photo', timezone='UTC',
+                                         timestamp=datetime(2018, 10, 1, tzinfo=pytz.utc), filename='IMG_0001.jpg',
+                                         filesize=1024, width=400, height=300, hash='0' * 40)
+
+    def test_anonymous_responses_are_public(self):
+        response = self.client.get('/journeys/japan/photos/')
+
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('s-maxage', response['Cache-Control'])
+        self.assertEqual(set(response['Surrogate-Key'].split()), {
+            'journeylog', 'photos', 'photo-{}'.format(self.photo.id), 'journey-{}'.format(self.journey.id)})
+
+    def test_authenticated_responses_are_private(self):
+        self.client.force_login(User.objects.create_user('user'))
+        response = self.client.get('/journeys/japan/photos/')
+
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotIn('Surrogate-Key', response)
+
+    def test_changes_are_logged(self):
+        CachePurge.objects.all().delete()
+        self.photo.save()
+
+        self.assertEqual(set(CachePurge.objects.values_list('key', flat=True)), {
+            'photos', 'photo-{}'.format(self.photo.id), 'journey-{}'.format(self.journey.id)})
+
+    def test_search_results_are_tagged_with_everything_that_can_match(self):
+        response = self.client.get('/search/', {'q': 'photo'})
+
+        self.assertIn('public', response['Cache-Control'])
+        self.assertEqual(set(response['Surrogate-Key'].split()),
+                         {'journeylog', 'photos', 'journalpages', 'journey-{}'.format(self.journey.id)})
+
+    def test_bundles_are_purged_with_their_location_names(self):
+        location = Location.objects.create(name='Tokyo', latitude=35.68, longitude=139.69)
+        name = LocationName.objects.create(location=location, lang='ja', name='東京', sort_key='とうきょう')
+        JourneyLocationVisit.objects.create(journey=self.journey, location=location,
+                                            timestamp=datetime(2018, 10, 1, tzinfo=pytz.utc))
+
+        keys = set(self.client.get('/journeys/japan/bundle/')['Surrogate-Key'].split())
+        CachePurge.objects.all().delete()
+        name.save()
+
+        self.assertTrue(keys & set(CachePurge.objects.values_list('key', flat=True)))
+
+
+class StaticExportTests(TestCase):
+    def test_export(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        output_dir = os.path.join(directory.name, 'export')
+
+        with override_settings(BASE_DIR=directory.name):
+            generate_fixtures(journeys=1, photos=12, pages=2, locations=3)
+            journey = Journey.objects.get()
+            call_command('export_static', journey.slug, output_dir, '--base-url', 'https://testserver',
+                         stdout=io.StringIO())
+
+        def read_document(*path):
+            with open(os.path.join(output_dir, *path), 'rb') as f:
+                content = f.read()
+            with gzip.open(os.path.join(output_dir, *path) + '.gz') as f:
+                self.assertEqual(f.read(), content)
+            return json.loads(content.decode('utf-8'))
+
+        self.assertEqual(read_document('journeys', journey.slug, 'index.json')['slug'], journey.slug)
+        photos = read_document('journeys', journey.slug, 'photos', 'page-1.json')
+        self.assertEqual(photos, read_document('journeys', journey.slug, 'photos', 'index.json'))
+        self.assertEqual(photos['count'], 12)
+        self.assertTrue(photos['results'][0]['url'].startswith('https://testserver/'))
+
+        visited = set(JourneyLocationVisit.objects.filter(journey=journey).values_list('location_id', flat=True))
+        locations = read_document('locations', 'journey-{}.json'.format(journey.slug))
+        self.assertEqual({location['id'] for location in locations}, visited)
+        for location_id in visited:
+            self.assertEqual(read_document('locations', str(location_id), 'index.json')['id'], location_id)
+
+        for photo in Photo.objects.filter(journey=journey):
+            photo_path = os.path.join(output_dir, 'image', 'public', 'photo', str(journey.id), photo.filename)
+            thumb_path = os.path.join(output_dir, 'image', 'public', 'thumb', str(journey.id),
+                                      photo.filename + THUMBNAIL_EXTENSION)
+            self.assertEqual(os.path.exists(photo_path), photo.confidentiality == 0)
+            self.assertEqual(os.path.exists(thumb_path), photo.confidentiality == 0)
+            if photo.confidentiality == 0:
+                with Image.open(thumb_path) as im:
+                    self.assertLessEqual(max(im.size), max(photo.width, photo.height))
+
+
+class JourneyBundleTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        start = datetime(2018, 10, 1, tzinfo=pytz.utc)
+        cls.journey = Journey.objects.create(slug='japan', name='Japan')
+
+        cls.photos = [
+            Photo.objects.create(journey=cls.journey, name='Photo {}'.format(i), timezone='UTC',
+                                 timestamp=start + timedelta(hours=12 * i), filename='IMG_{:04d}.jpg'.format(i),
+                                 filesize=1024, width=400, height=300, hash='{:040d}'.format(i))
+            for i in range(4)
+        ]
+        JournalPage.objects.create(journey=cls.journey, slug='day-1', order_no=1, date_start=start)
+        JournalPage.objects.create(journey=cls.journey, slug='overview', order_no=0)
+
+        cls.locations = [Location.objects.create(name='Location {}'.format(i), latitude=35, longitude=139)
+                         for i in range(2)]
+        for location in cls.locations:
+            LocationName.objects.create(location=location, lang='en', name=location.name)
+        for location in cls.locations + cls.locations:
+            JourneyLocationVisit.objects.create(journey=cls.journey, location=location, timestamp=start)
+
+    def test_bundle(self):
+        config.EXPOSE_GPS
+        with self.assertNumQueries(6):
+            data = self.client.get('/journeys/japan/bundle/').json()
+
+        self.assertEqual(data['journey']['slug'], 'japan')
+        self.assertEqual(len(data['photos']), 4)
+        self.assertEqual(len(data['locationVisits']), 4)
+        self.assertEqual(sorted(location['id'] for location in data['locations']),
+                         sorted(location.id for location in self.locations))
+        self.assertEqual([(page['slug'], page['photos']) for page in data['journalPages']], [
+            ('overview', [photo.id for photo in self.photos]),
+            ('day-1', [photo.id for photo in self.photos[:2]]),
+        ])
+        self.assertEqual(data['journalPages'][1]['photosCount'], 2)
+
+    def test_unknown_journey(self):
+        self.assertEqual(self.client.get('/journeys/korea/bundle/').status_code, 404)
+
+
+class PhotoBatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        cls.photos = [
+            Photo.objects.create(journey=journey, name='Photo {}'.format(i), timezone='UTC',
+                                 timestamp=datetime(2018, 10, 1, i, tzinfo=pytz.utc),
+                                 filename='IMG_{:04d}.jpg'.format(i), filesize=1024, width=400, height=300,
+                                 hash='{:040d}'.format(i))
+            for i in range(3)
+        ]
+
+    def test_batch(self):
+        config.EXPOSE_GPS
+        with self.assertNumQueries(1):
+            response = self.client.get('/photos/batch/', {
+                'id': '{},{},0'.format(self.photos[2].id, self.photos[0].id),
+                'file': ['japan/IMG_0001.jpg', 'japan/IMG_0000.jpg', 'korea/IMG_0000.jpg'],
+            })
+
+        self.assertEqual([photo['filename'] for photo in response.json()['results']],
+                         ['IMG_0002.jpg', 'IMG_0000.jpg', 'IMG_0001.jpg'])
+        self.assertEqual(response.json()['missing'], {'ids': [0], 'files': ['korea/IMG_0000.jpg']})
+
+    def test_journey_batch(self):
+        response = self.client.get('/journeys/korea/photos/batch/', {'id': self.photos[0].id})
+        self.assertEqual(response.json()['results'], [])
+
+    def test_limits(self):
+        self.assertEqual(self.client.get('/photos/batch/', {'id': ','.join(['1'] * 501)}).status_code, 400)
+        self.assertEqual(self.client.get('/photos/batch/', {'file': 'IMG_0000.jpg'}).status_code, 400)
+
+
+class SignedImageUrlTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        cls.photo = Photo.objects.create(journey=journey, name='Photo', timezone='UTC',
+                                         timestamp=datetime(2018, 10, 1, tzinfo=pytz.utc), filename='IMG_0001.jpg',
+                                         filesize=1024, width=400, height=300, hash='0' * 40, confidentiality=1)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = override_settings(BASE_DIR=directory.name)
+        storage.enable()
+        self.addCleanup(storage.disable)
+
+        path = self.photo.get_storage_file_path('photo')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'photo')
+
+    def test_signed_url_needs_no_queries(self):
+        url = self.photo.access_url(User(username='user'))
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'photo')
+
+    def test_tampered_urls_are_rejected(self):
+        url = self.photo.access_url(User(username='user'))
+
+        self.assertEqual(self.client.get(url.replace('IMG_0001', 'IMG_0002')).status_code, 404)
+        self.assertEqual(self.client.get(url.replace('expires=', 'expires=1')).status_code, 404)
+        self.assertEqual(self.client.get(url.split('?')[0]).status_code, 404)
+
+    def test_expired_urls_are_rejected(self):
+        with override_settings(JOURNEYLOG=dict(settings.JOURNEYLOG, SIGNED_IMAGE_URL_TTL=-7200)):
+            url = self.photo.access_url(User(username='user'))
+
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_anonymous_users_get_no_url(self):
+        self.assertIsNone(self.photo.access_url(AnonymousUser()))
+
+
+class StorageVerificationTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = override_settings(BASE_DIR=directory.name)
+        storage.enable()
+        self.addCleanup(storage.disable)
+
+        image = io.BytesIO()
+        Image.new('RGB', (40, 30)).save(image, 'jpeg')
+        content = image.getvalue()
+
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        self.photos = [
+            Photo.objects.create(journey=journey, name='Photo {}'.format(i), timezone='UTC',
+                                 timestamp=datetime(2018, 10, 1, tzinfo=pytz.utc), filename='IMG_{:04d}.jpg'.format(i),
+                                 filesize=len(content), width=40, height=30, hash=hashlib.sha1(content).hexdigest())
+            for i in range(3)
+        ]
+
+        for filename in ('IMG_0000.jpg', 'IMG_0001.jpg', 'IMG_0009.jpg'):
+            path = os.path.join(directory.name, 'storage', 'public', 'photo', str(journey.id), filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+
+        Photo.objects.filter(id=self.photos[1].id).update(width=400)
+
+    def test_verification(self):
+        verifier = StorageVerifier(jobs=1)
+        problems = sorted((problem['type'], problem['photo'], problem.get('field'), os.path.basename(problem['path']))
+                          for problem in verifier.run())
+
+        self.assertEqual(problems, [
+            ('mismatch', self.photos[1].id, 'dimensions', 'IMG_0001.jpg'),
+            ('missing', self.photos[2].id, None, 'IMG_0002.jpg'),
+            ('orphan', None, None, 'IMG_0009.jpg'),
+        ])
+        self.assertEqual(verifier.checked, 3)
+
+        verifier = StorageVerifier(jobs=1)
+        self.assertEqual(len(list(verifier.run())), 3)
+        self.assertEqual((verifier.checked, verifier.skipped), (2, 1))
+
+
+@override_settings(JOURNEYLOG=dict(settings.JOURNEYLOG, CONTENT_ADDRESSED_STORAGE=True))
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = override_settings(BASE_DIR=directory.name)
+        storage.enable()
+        self.addCleanup(storage.disable)
+
+        image = io.BytesIO()
+        Image.new('RGB', (400, 300)).save(image, 'jpeg')
+
+        self.photos = []
+        for slug in ('japan', 'korea'):
+            journey = Journey.objects.create(slug=slug, name=slug)
+            photo = Photo.objects.create(journey=journey, name='Photo', timezone='UTC',
+                                         timestamp=datetime(2018, 10, 1, tzinfo=pytz.utc), filename='IMG_0001.jpg',
+                                         filesize=len(image.getvalue()), width=400, height=300, hash='ab' * 20)
+            os.makedirs(os.path.dirname(photo.get_storage_file_path('photo')))
+            with open(photo.get_storage_file_path('photo'), 'wb') as f:
+                f.write(image.getvalue())
+            self.photos.append(photo)
+
+    def test_duplicates_share_files(self):
+        self.assertEqual([photo.store_content_addressed()['photo'] for photo in self.photos],
+                         ['adopted', 'deduplicated'])
+        self.assertEqual(self.photos[0].store_content_addressed()['photo'], 'linked')
+
+        for photo in self.photos:
+            photo.ensure_thumb()
+
+        for kind in ('photo', 'thumb'):
+            self.assertTrue(os.path.samefile(self.photos[0].get_storage_file_path(kind),
+                                             self.photos[1].get_storage_file_path(kind)))
+            self.assertEqual(os.stat(self.photos[0].get_shared_file_path(kind)).st_nlink, 3)
+
+    def test_outdated_shared_thumbnails_are_rendered_again(self):
+        for photo in self.photos:
+            photo.store_content_addressed()
+            photo.ensure_thumb()
+
+        shared_path = self.photos[0].get_shared_file_path('thumb')
+        os.utime(shared_path, (0, 0))
+        self.assertEqual(self.photos[1].ensure_thumb_file(), self.photos[1].get_storage_file_path('thumb'))
+
+        self.assertGreaterEqual(os.stat(shared_path).st_mtime, self.photos[1].modified_at.timestamp())
+        self.assertTrue(os.path.samefile(self.photos[1].get_storage_file_path('thumb'), shared_path))
+        self.assertEqual(self.photos[1].ensure_thumb_file(), True)
+
+
+class DuplicateDetectionTests(TestCase):
+    def test_bk_tree_matches_brute_force(self):
+        generator = random.Random(1)
+        keys = [generator.getrandbits(64) for _ in range(500)]
+        keys += [key ^ (1 << generator.randrange(64)) for key in keys[:50]]
+
+        tree = BKTree()
+        for i, key in enumerate(keys):
+            tree.add(key, i)
+
+        for key in keys[:20]:
+            self.assertEqual(sorted(tree.search(key, 8)),
+                             [i for i, other in enumerate(keys) if hamming_distance(key, other) <= 8])
+
+    def test_similar_photos_are_grouped(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = override_settings(BASE_DIR=directory.name)
+        storage.enable()
+        self.addCleanup(storage.disable)
+
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        gradient = Image.linear_gradient('L').transpose(Image.ROTATE_90).resize((400, 300))
+        images = [gradient, gradient.point(lambda value: min(value + 10, 255)), gradient.rotate(180)]
+
+        photos = []
+        for i, image in enumerate(images):
+            photo = Photo.objects.create(journey=journey, name='Photo {}'.format(i), timezone='UTC',
+                                         timestamp=datetime(2018, 10, 1, i, tzinfo=pytz.utc),
+                                         filename='IMG_{:04d}.jpg'.format(i), filesize=1024, width=400, height=300,
+                                         hash='{:040d}'.format(i))
+            os.makedirs(os.path.dirname(photo.get_storage_file_path('photo')), exist_ok=True)
+            image.convert('RGB').save(photo.get_storage_file_path('photo'), 'jpeg')
+            photo.ensure_thumb()
+            photos.append(photo)
+
+        self.assertEqual(len(Photo.objects.get(id=photos[0].id).perceptual_hash), 16)
+        self.assertEqual(journey_duplicate_groups(journey.id), [photos[:2]])
+
+
+class BenchmarkTests(TestCase):
+    def test_query_budgets(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        with override_settings(BASE_DIR=directory.name):
+            generate_fixtures(journeys=1, photos=20, pages=3, locations=5)
+            results = BenchmarkRunner(repeat=1).run(Journey.objects.get())
+
+        self.assertEqual([result['name'] for result in results if not result['within_budget']], [])
+
+
+class JournalPagePhotosTests(TestCase):
+    def test_listings_select_the_same_photos(self):
+        start = datetime(2018, 10, 1, tzinfo=pytz.utc)
+        journey = Journey.objects.create(slug='japan', name='Japan')
+        for i in range(10):
+            Photo.objects.create(journey=journey, name='Photo {}'.format(i), timezone='UTC',
+                                 timestamp=start + timedelta(hours=10 * i), filename='IMG_{:04d}.jpg'.format(i),
+                                 filesize=1024, width=400, height=300, hash='{:040d}'.format(i))
+
+        for slug, date_start, date_end, page_type in (
+                ('range', start + timedelta(hours=10), start + timedelta(hours=30), JournalPage.REGULAR),
+                ('day', start + timedelta(hours=5), None, JournalPage.REGULAR),
+                ('until', None, start + timedelta(hours=20), JournalPage.REGULAR),
+                ('undated', None, None, JournalPage.REGULAR),
+                ('special', None, None, JournalPage.SPECIAL)):
+            JournalPage.objects.create(journey=journey, slug=slug, date_start=date_start, date_end=date_end,
+                                       type=page_type)
+        expected = {page.slug: [photo.id for photo in page.photo_queryset()] for page in JournalPage.objects.all()}
+
+        counted = {page.slug: page.photos_count() for page in JournalPage.objects.with_photos_count()}
+        pages = list(JournalPage.objects.all())
+        with self.assertNumQueries(1):
+            prefetch_page_photos(pages)
+
+        self.assertEqual(counted, {slug: len(ids) for slug, ids in expected.items()})
+        self.assertEqual({page.slug: [photo.id for photo in page.photos()] for page in pages}, expected)
+        self.assertEqual(sorted(map(len, expected.values())), [0, 2, 3, 3, 10])
+
+
+@override_settings(JOURNEYLOG=dict(settings.JOURNEYLOG, REQUEST_INSTRUMENTATION=True,
+                                   REQUEST_BUDGETS={'*': (50, None), 'journey-list': (0, None)}))
+class RequestInstrumentationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Journey.objects.create(slug='japan', name='Japan')
+
+    def test_server_timing(self):
+        with self.assertLogs('journeylog.instrumentation', 'INFO') as logs:
+            response = self.client.get('/journeys/japan/')
+
+        self.assertRegex(response['Server-Timing'], r'db;dur=[0-9.]+, render;dur=[0-9.]+, total;dur=[0-9.]+, '
+                                                    r'queries;desc="2"')
+        self.assertEqual(logs.records[0].levelname, 'INFO')
+        self.assertEqual(json.loads(logs.records[0].getMessage())['route'], 'journey-detail')
+
+    def test_over_budget(self):
+        with self.assertLogs('journeylog.instrumentation', 'WARNING') as logs:
+            self.client.get('/journeys/')
+
+        self.assertEqual(json.loads(logs.records[0].getMessage())['over_budget'], ['queries'])
+
+    def test_request_lines_have_a_handler(self):
+        # assertLogs() brings its own handler, so the logging configuration is checked separately
+        logger = logging.getLogger('journeylog.instrumentation')
+
+        self.assertTrue(logger.isEnabledFor(logging.INFO))
+        self.assertTrue(logger.hasHandlers())
+
+
+class RequestProfilerTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        profiling = override_settings(JOURNEYLOG=dict(settings.JOURNEYLOG, PROFILE_DIR=directory.name, PROFILE_KEEP=1))
+        profiling.enable()
+        self.addCleanup(profiling.disable)
+
+    def test_staff_requests_are_profiled(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True, is_superuser=True))
+
+        self.client.get('/journeys/', HTTP_X_PROFILE='1')
+        response = self.client.get('/journeys/', {'profile': '1'})
+
+        profile = RequestProfile.objects.get()
+        self.assertEqual(response['X-Profile-Id'], str(profile.id))
+        self.assertEqual(profile.path, '/journeys/?profile=1')
+        self.assertTrue(os.path.exists(profile.get_file_path('prof')))
+        self.assertEqual(len(os.listdir(settings.JOURNEYLOG['PROFILE_DIR'])), 2)
+
+        self.assertContains(self.client.get('/admin/journeylog/requestprofile/'), 'Collapsed stacks')
+        response = self.client.get('/admin/journeylog/requestprofile/{}/download/prof/'.format(profile.id))
+        self.assertEqual(response.status_code, 200)
+
+    def test_other_requests_are_not_profiled(self):
+        self.client.force_login(User.objects.create_user('user'))
+
+        self.assertNotIn('X-Profile-Id', self.client.get('/journeys/', {'profile': '1'}))
+        self.assertFalse(RequestProfile.objects.exists())
+
+
+class MetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Journey.objects.create(slug='japan', name='Japan')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        enabled = override_settings(JOURNEYLOG=dict(settings.JOURNEYLOG, METRICS_DIR=directory.name))
+        enabled.enable()
+        self.addCleanup(enabled.disable)
+
+    def test_exposition(self):
+        self.client.get('/journeys/')
+        self.client.get('/journeys/')
+
+        # Another process that handled one more request
+        with open(os.path.join(settings.JOURNEYLOG['METRICS_DIR'], '1.json'), 'w') as f:
+            json.dump({'counters': [], 'histograms': [
+                ['journeylog_request_duration_seconds', [['method', 'GET'], ['route', 'journey-list']],
+                 [1] + [0] * 11 + [0.001]],
+            ]}, f)
+
+        content = self.client.get('/metrics').content.decode()
+
+        self.assertIn('# TYPE journeylog_request_duration_seconds histogram', content)
+        self.assertIn('journeylog_request_duration_seconds_count{method="GET",route="journey-list"} 3', content)
+        self.assertIn('journeylog_request_duration_seconds_bucket{method="GET",route="journey-list",le="+Inf"} 3',
+                      content)
+        self.assertRegex(content, r'journeylog_db_queries_total\{route="journey-list"\} [1-9]')
+
+    def test_concurrent_flushes(self):
+        metrics = ProcessMetrics()
+        metrics.increment('journeylog_image_bytes_served_total', (), 1)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: metrics.flush(force=True), range(400)))
+
+        self.assertEqual(os.listdir(settings.JOURNEYLOG['METRICS_DIR']), ['{}.json'.format(os.getpid())])
+
+    def test_files_of_finished_processes_are_archived(self):
+        directory = settings.JOURNEYLOG['METRICS_DIR']
+        finished = subprocess.Popen(['true'])
+        finished.wait()
+
+        for pid in (finished.pid, os.getpid()):
+            with open(os.path.join(directory, '{}.json'.format(pid)), 'w') as f:
+                json.dump({'counters': [['journeylog_image_bytes_served_total', [], 100]], 'histograms': []}, f)
+
+        # The second file was left by an earlier process with the same pid as this one
+        metrics = process_metrics()
+        metrics.flush(force=True)
+        served = metrics.counters['journeylog_image_bytes_served_total', ()]
+
+        for _ in range(2):
+            counters, histograms = collect()
+            self.assertEqual(counters['journeylog_image_bytes_served_total', ()], 200 + served)
+
+        self.assertNotIn('{}.json'.format(finished.pid), os.listdir(directory))
+        self.assertIn('archived.json', os.listdir(directory))
+
+    def test_failed_flushes_are_logged(self):
+        with open(os.path.join(settings.JOURNEYLOG['METRICS_DIR'], 'blocked'), 'w'):
+            pass
+
+        with override_settings(JOURNEYLOG=dict(settings.JOURNEYLOG, METRICS_FLUSH_INTERVAL=0,
+                                               METRICS_DIR=os.path.join(settings.JOURNEYLOG['METRICS_DIR'],
+                                                                        'blocked'))), \
+                self.assertLogs('journeylog.metrics', 'WARNING'):
+            increment('journeylog_image_bytes_served_total', 10)
+
+    def test_values_are_flushed_at_exit(self):
+        directory = settings.JOURNEYLOG['METRICS_DIR']
+        script = ('import django; django.setup(); from journeylog import metrics; '
+                  '[metrics.increment("journeylog_image_bytes_served_total", 10) for _ in range(3)]')
+        environment = dict(os.environ, DJANGO_SETTINGS_MODULE='journeylog.settings', METRICS_DIR=directory)
+        subprocess.run([sys.executable, '-c', script], env=environment, cwd=settings.BASE_DIR, check=True)
+
+        counters, histograms = collect()
+        served = process_metrics().counters['journeylog_image_bytes_served_total', ()]
+        self.assertEqual(counters['journeylog_image_bytes_served_total', ()], 30 + served)
+
+    def test_processes_without_file_locks_report_their_own_values(self):
+        self.addCleanup(setattr, metrics, 'fcntl', metrics.fcntl)
+        metrics.fcntl = None
+
+        with override_settings(JOURNEYLOG=dict(settings.JOURNEYLOG, METRICS_FLUSH_INTERVAL=0)):
+            increment('journeylog_image_bytes_served_total', 10)
+            counters, histograms = collect()
+
+        self.assertEqual(os.listdir(settings.JOURNEYLOG['METRICS_DIR']), [])
+        self.assertEqual(counters['journeylog_image_bytes_served_total', ()],
+                         process_metrics().counters['journeylog_image_bytes_served_total', ()])
+
+    def test_remote_clients_are_refused(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='192.0.2.1').status_code, 404)
+
+
+class ReplayLogTests(TestCase):
+    LOG = '\n'.join([
+        '192.0.2.1 - - [10/Oct/2018:13:55:36 +0900] "GET /journeys/?page=1 HTTP/1.1" 200 512 "-" "Mozilla/5.0"',
+        '192.0.2.1 - - [10/Oct/2018:13:55:38 +0900] "GET /image/public/thumb/1/IMG_0001.jpg HTTP/1.1" 200 9000 '
+        '"-" "Mozilla/5.0"',
+        '192.0.2.2 - - [10/Oct/2018:13:55:40 +0900] "POST /journeys/ HTTP/1.1" 201 64 "-" "curl/7.58.0"',
+        '192.0.2.2 - - [10/Oct/2018:13:55:41 +0900] "GET /admin/journeylog/photo/ HTTP/1.1" 200 2048 "-" "-"',
+        '192.0.2.2 - - [10/Oct/2018:13:55:42 +0900] "GET /nowhere HTTP/1.1" 404 0 "-" "-"',
+        'not a log line',
+        '192.0.2.3 - - [10/Oct/2018:13:55:46 +0900] "HEAD /journeys/ HTTP/1.1" 200 0 "-" "-"',
+        '192.0.2.3 - - [10/Oct/2018:13:55:47 +0900] "GET /image/public/photo/1/%E6%9D%B1%E4%BA%AC.jpg HTTP/1.1" '
+        '200 9000 "-" "-"',
+    ])
+
+    def test_parse(self):
+        requests = parse_access_log(self.LOG.splitlines())
+
+        self.assertEqual([(request.method, request.path, request.query, request.offset) for request in requests], [
+            ('GET', '/journeys/', 'page=1', 0),
+            ('GET', '/image/public/thumb/1/IMG_0001.jpg', '', 2),
+            ('HEAD', '/journeys/', '', 10),
+            ('GET', '/image/public/photo/1/\xe6\x9d\xb1\xe4\xba\xac.jpg', '', 11),
+        ])
+        self.assertEqual(requests[0].route, 'journey-list')
+
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'access.log'), 'w') as f:
+                f.write(self.LOG)
+
+            call_command('replay_log', os.path.join(directory, 'access.log'), '--threads', '2', '--host', 'testserver',
+                         '--output', os.path.join(directory, 'results.json'), stdout=io.StringIO())
+
+            with open(os.path.join(directory, 'results.json')) as f:
+                routes = json.load(f)['routes']
+
+        self.assertEqual(routes['journey-list']['requests'], 2)
+        self.assertEqual(routes['journey-list']['errors'], 0)
+        self.assertLessEqual(routes['journey-list']['p50_ms'], routes['journey-list']['p99_ms'])
+        self.assertEqual(routes['journeylog.views.photo_file_view']['requests'], 2)
+        self.assertEqual(routes['journeylog.views.photo_file_view']['errors'], 0)
@@ -0,0 +1,35 @@
+import pytz
+from django.db.models import Count
+from django.db.models.functions import TruncDay, TruncHour
+
+from .models import Photo, JourneyLocationVisit
+
+TIMELINE_BUCKETS = {
+    'day': TruncDay,
+    'hour': TruncHour,
+}
+
+
+def histogram(queryset, field, bucket, zone):
+    # Grouped in the database; bucket starts come back as wall clock times in the given timezone
+    trunc = TIMELINE_BUCKETS[bucket](field, tzinfo=zone)
+    rows = (queryset.order_by().exclude(**{field: None}).annotate(bucket=trunc).values('bucket')
+            .annotate(count=Count('id')).order_by('bucket').values_list('bucket', 'count'))
+
+    return [{'start': start.replace(tzinfo=None), 'count': count} for start, count in rows]
+
+
+def journey_timeline(journey_id, bucket, home_zone, local=True):
+    if local:
+        # local_timestamp already holds the wall clock time of every photo in its own timezone
+        photos = histogram(Photo.objects.filter(journey_id=journey_id), 'local_timestamp', bucket, pytz.utc)
+    else:
+        photos = histogram(Photo.objects.filter(journey_id=journey_id), 'timestamp', bucket, home_zone)
+
+    # Location visits have no timezone of their own, so they are always bucketed in the home timezone
+    visits = histogram(JourneyLocationVisit.objects.filter(journey_id=journey_id), 'timestamp', bucket, home_zone)
+
+    return {
+        'photos': photos,
+        'location_visits': visits,
+    }
@@ -0,0 +1,136 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+from .models import JourneyMapPointVisit
+
+TrackColumns = namedtuple('TrackColumns', ('latitudes', 'longitudes', 'timestamps', 'location_ids'))
+
+TRACK_TILE_SIZE = 256
+TRACK_MAX_ZOOM = 16
+
+
+def zoom_tolerance(zoom):
+    # One pixel at the given web map zoom level, in degrees of latitude
+    return 360.0 / (TRACK_TILE_SIZE * 2 ** min(max(zoom, 0), TRACK_MAX_ZOOM))
+
+
+def load_track(journey_id):
+    rows = (JourneyMapPointVisit.objects.filter(journey_id=journey_id).order_by('timestamp', 'id')
+            .values_list('latitude', 'longitude', 'timestamp'))
+
+    latitudes = []
+    longitudes = []
+    timestamps = []
+
+    for latitude, longitude, timestamp in rows.iterator(chunk_size=5000):
+        latitudes.append(float(latitude))
+        longitudes.append(float(longitude))
+        timestamps.append(int(timestamp.timestamp()))
+
+    return (np.array(latitudes, dtype=np.float64), np.array(longitudes, dtype=np.float64),
+            np.array(timestamps, dtype=np.int64))
+
+
+def point_importance(latitudes, longitudes):
+    # Runs Douglas-Peucker once down to the finest tolerance and records, for every point, the largest tolerance at
+    # which it would still be kept. Simplifying for any zoom level is then a single comparison over the array.
+    count = len(latitudes)
+    importance = np.zeros(count, dtype=np.float64)
+
+    if count == 0:
+        return importance
+
+    importance[0] = importance[-1] = np.inf
+
+    y = latitudes
+    x = longitudes * math.cos(math.radians(float(np.mean(latitudes))))
+    floor = zoom_tolerance(TRACK_MAX_ZOOM)
+
+    stack = [(0, count - 1, np.inf)]
+
+    while stack:
+        first, last, parent = stack.pop()
+
+        if last - first < 2:
+            continue
+
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        xs = x[first + 1:last] - x[first]
+        ys = y[first + 1:last] - y[first]
+
+        length = math.hypot(dx, dy)
+        if length > 0:
+            distances = np.abs(dx * ys - dy * xs) / length
+        else:
+            distances = np.hypot(xs, ys)
+
+        index = int(np.argmax(distances))
+        value = min(float(distances[index]), parent)
+
+        if value < floor:
+            # Nothing in this segment survives even at the maximum zoom level
+            importance[first + 1:last] = distances
+            continue
+
+        index = first + 1 + index
+        importance[index] = value
+        stack.append((first, index, value))
+        stack.append((index, last, value))
+
+    return importance
+
+
+def get_track(journey):
+    timeout = settings.JOURNEYLOG['TRACK_CACHE_TIMEOUT']
+    key = 'journeylog:track:{}:{}'.format(journey.id, journey.map_points_version)
+
+    track = cache.get(key)
+    metrics.increment('journeylog_cache_requests_total', cache='track', result='miss' if track is None else 'hit')
+    if track is None:
+        latitudes, longitudes, timestamps = load_track(journey.id)
+        track = {
+            'latitudes': latitudes,
+            'longitudes': longitudes,
+            'timestamps': timestamps,
+            'importance': point_importance(latitudes, longitudes),
+        }
+        cache.set(key, track, timeout)
+
+    return track
+
+
+def simplified_track(journey, zoom):
+    track = get_track(journey)
+    mask = track['importance'] >= zoom_tolerance(zoom)
+
+    return TrackColumns(track['latitudes'][mask], track['longitudes'][mask], track['timestamps'][mask], None)
+
+
+def empty_track():
+    return TrackColumns(np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64),
+                        None)
+
+
+def visit_track(visits):
+    rows = visits.order_by('timestamp', 'id').values_list('location__latitude', 'location__longitude', 'timestamp',
+                                                          'location_id')
+
+    latitudes = []
+    longitudes = []
+    timestamps = []
+    location_ids = []
+
+    for latitude, longitude, timestamp, location_id in rows:
+        latitudes.append(float('nan') if latitude is None else float(latitude))
+        longitudes.append(float('nan') if longitude is None else float(longitude))
+        timestamps.append(int(timestamp.timestamp()))
+        location_ids.append(-1 if location_id is None else location_id)
+
+    return TrackColumns(np.array(latitudes, dtype=np.float64), np.array(longitudes, dtype=np.float64),
+                        np.array(timestamps, dtype=np.int64), np.array(location_ids, dtype=np.int64))
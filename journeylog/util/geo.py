@@ -0,0 +1,154 @@
+import math
+
+import numpy as np
+
+from django.db.models import Q, F, Value, FloatField
+from django.db.models.functions import ASin, Cos, Least, Power, Radians, Sin, Sqrt
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 12
+GEOHASH_MAX_QUERY_PRECISION = 9
+GEOHASH_MAX_QUERY_CELLS = 32
+
+EARTH_RADIUS_METERS = 6371008.8
+
+
+def geohash_encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    if latitude is None or longitude is None:
+        return ''
+
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    latitude = float(latitude)
+    longitude = float(longitude)
+
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(chars) < precision:
+        value, value_range = (longitude, lon_range) if even else (latitude, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(chars)
+
+
+def geohash_encode_many(latitudes, longitudes, precision=GEOHASH_PRECISION):
+    # Same as geohash_encode, but for whole arrays at once: quantize both coordinates, interleave their bits and map
+    # them to characters five bits at a time.
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = math.floor(precision * 5 / 2)
+
+    lon_cells = np.asarray(longitudes, dtype=np.float64)
+    lon_cells = np.clip(((lon_cells + 180) / 360 * (1 << lon_bits)).astype(np.int64), 0, (1 << lon_bits) - 1)
+    lat_cells = np.asarray(latitudes, dtype=np.float64)
+    lat_cells = np.clip(((lat_cells + 90) / 180 * (1 << lat_bits)).astype(np.int64), 0, (1 << lat_bits) - 1)
+
+    code = np.zeros(len(lon_cells), dtype=np.int64)
+    for bit in range(precision * 5):
+        # Bits alternate between longitude and latitude, starting with the most significant longitude bit
+        if bit % 2 == 0:
+            value = (lon_cells >> (lon_bits - 1 - bit // 2)) & 1
+        else:
+            value = (lat_cells >> (lat_bits - 1 - bit // 2)) & 1
+        code = (code << 1) | value
+
+    alphabet = np.frombuffer(GEOHASH_ALPHABET.encode('ascii'), dtype='S1')
+    shifts = np.arange(precision - 1, -1, -1, dtype=np.int64) * 5
+    chars = alphabet[(code[:, np.newaxis] >> shifts) & 31]
+
+    return np.ascontiguousarray(chars).view('S{}'.format(precision)).ravel().astype(str).tolist()
+
+
+def geohash_cell_size(precision):
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = math.floor(precision * 5 / 2)
+
+    return 360.0 / (1 << lon_bits), 180.0 / (1 << lat_bits)
+
+
+def geohash_cells(south, west, north, east, max_cells=GEOHASH_MAX_QUERY_CELLS):
+    for precision in range(GEOHASH_MAX_QUERY_PRECISION, 0, -1):
+        width, height = geohash_cell_size(precision)
+
+        rows = range(int((south + 90) // height), int((min(north, 90 - 1e-9) + 90) // height) + 1)
+        columns = range(int((west + 180) // width), int((min(east, 180 - 1e-9) + 180) // width) + 1)
+
+        if len(rows) * len(columns) <= max_cells:
+            return sorted({
+                geohash_encode(-90 + (row + 0.5) * height, -180 + (column + 0.5) * width, precision)
+                for row in rows for column in columns
+            })
+
+    return []
+
+
+def split_bbox(south, west, north, east):
+    if west <= east:
+        return [(south, west, north, east)]
+
+    # The box crosses the antimeridian
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def radius_bbox(latitude, longitude, radius):
+    lat_delta = math.degrees(radius / EARTH_RADIUS_METERS)
+    south = max(-90.0, latitude - lat_delta)
+    north = min(90.0, latitude + lat_delta)
+
+    cos_lat = math.cos(math.radians(max(abs(south), abs(north))))
+    if cos_lat < 1e-9 or lat_delta / cos_lat >= 180:
+        return south, -180.0, north, 180.0
+
+    lon_delta = lat_delta / cos_lat
+    west = (longitude - lon_delta + 180) % 360 - 180
+    east = (longitude + lon_delta + 180) % 360 - 180
+
+    return south, west, north, east
+
+
+def bbox_q(south, west, north, east, prefix='', max_precision=GEOHASH_PRECISION):
+    q = Q()
+
+    for box_south, box_west, box_north, box_east in split_bbox(south, west, north, east):
+        cells = Q()
+        for cell in sorted({cell[:max_precision] for cell in geohash_cells(box_south, box_west, box_north, box_east)}):
+            # Prefix match as a range, so that every database can use a plain B-tree index for it
+            cells |= Q(**{prefix + 'geohash__gte': cell, prefix + 'geohash__lt': cell + '~'})
+
+        q |= cells & Q(**{
+            prefix + 'latitude__gte': box_south,
+            prefix + 'latitude__lte': box_north,
+            prefix + 'longitude__gte': box_west,
+            prefix + 'longitude__lte': box_east,
+        })
+
+    return q
+
+
+def haversine_expression(latitude, longitude, prefix=''):
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+
+    a = (Power(Sin((Radians(F(prefix + 'latitude')) - Value(lat)) / 2), 2) +
+         Value(math.cos(lat)) * Cos(Radians(F(prefix + 'latitude'))) *
+         Power(Sin((Radians(F(prefix + 'longitude')) - Value(lon)) / 2), 2))
+
+    # Rounding can push a just above 1 for nearly antipodal points, where ASin would fail or return NULL
+    return ASin(Sqrt(Least(a, Value(1.0))), output_field=FloatField()) * Value(2 * EARTH_RADIUS_METERS)
@@ -1,4 +1,4 @@
-from PIL import ExifTags
+from PIL import ExifTags, Image
 
 
 def exif_rotate(image):
@@ -31,3 +31,16 @@ def exif_rotate(image):
         return image
     except KeyError:
         return image
+
+
+def difference_hash(image, size=8):
+    # dHash: one bit per pixel of a small grayscale version, set when the pixel is brighter than its right neighbour
+    pixels = list(image.convert('L').resize((size + 1, size), Image.LANCZOS).getdata())
+    value = 0
+
+    for row in range(size):
+        for column in range(size):
+            offset = row * (size + 1) + column
+            value = value << 1 | (pixels[offset] > pixels[offset + 1])
+
+    return '{:0{}x}'.format(value, size * size // 4)
@@ -0,0 +1,29 @@
+import hashlib
+
+import markdown
+from django.conf import settings
+
+
+def markdown_hash(text):
+    # The extensions are part of the hash, so that changing them marks every stored rendering as stale
+    extensions = ','.join(settings.JOURNEYLOG['MARKDOWN_EXTENSIONS'])
+    return hashlib.sha1('{}\0{}'.format(extensions, text or '').encode('utf-8')).hexdigest()
+
+
+def render_markdown(text):
+    if not text:
+        return ''
+
+    return markdown.markdown(text, extensions=settings.JOURNEYLOG['MARKDOWN_EXTENSIONS'])
+
+
+def refresh_rendered_markdown(instance, source_field, html_field, hash_field, force=False):
+    text = getattr(instance, source_field)
+    text_hash = markdown_hash(text)
+
+    if not force and getattr(instance, hash_field) == text_hash:
+        return False
+
+    setattr(instance, html_field, render_markdown(text))
+    setattr(instance, hash_field, text_hash)
+    return True
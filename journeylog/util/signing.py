@@ -0,0 +1,34 @@
+import math
+import time
+
+from django.conf import settings
+from django.utils.crypto import salted_hmac, constant_time_compare
+
+IMAGE_URL_SALT = 'journeylog.image-url'
+
+
+def image_url_signature(path, expires, refresh):
+    return salted_hmac(IMAGE_URL_SALT, '{}:{}:{}'.format(path, expires, refresh)).hexdigest()
+
+
+def image_url_expiry(now=None):
+    # Rounded up to a whole step, so that the URLs stay the same for a while and can be cached by browsers
+    ttl = settings.JOURNEYLOG['SIGNED_IMAGE_URL_TTL']
+    step = settings.JOURNEYLOG['SIGNED_IMAGE_URL_STEP']
+
+    return int(math.ceil(((time.time() if now is None else now) + ttl) / step) * step)
+
+
+def sign_image_path(path, refresh):
+    expires = image_url_expiry()
+    return 'expires={}&refresh={}&signature={}'.format(expires, refresh, image_url_signature(path, expires, refresh))
+
+
+def verify_image_path(path, expires, refresh, signature):
+    try:
+        if int(expires) < time.time():
+            return False
+    except (TypeError, ValueError):
+        return False
+
+    return constant_time_compare(signature or '', image_url_signature(path, expires, refresh))
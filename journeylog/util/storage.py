@@ -0,0 +1,51 @@
+import os
+
+from django.conf import settings
+
+ADOPTED = 'adopted'
+LINKED = 'linked'
+DEDUPLICATED = 'deduplicated'
+CONFLICT = 'conflict'
+MISSING = 'missing'
+
+
+def content_addressed_enabled():
+    return settings.JOURNEYLOG['CONTENT_ADDRESSED_STORAGE']
+
+
+def shared_file_path(name):
+    # Sharded by the first two byte pairs, so that no directory grows too large
+    return os.path.join(settings.BASE_DIR, 'storage', 'objects', name[:2], name[2:4], name)
+
+
+def link_file(source, target):
+    # Replaces the target atomically, so that the web server never sees it missing
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    temporary_path = '{}.{}.tmp'.format(target, os.getpid())
+    os.link(source, temporary_path)
+    os.replace(temporary_path, target)
+
+
+def store_shared_file(path, shared_path):
+    # Turns the file into a hard link to the shared copy of its content, or makes it the shared copy if there is
+    # none yet. Files that only share the hash but not the size are left alone.
+    if not os.path.exists(path):
+        return MISSING
+
+    if not os.path.exists(shared_path):
+        os.makedirs(os.path.dirname(shared_path), exist_ok=True)
+        try:
+            os.link(path, shared_path)
+            return ADOPTED
+        except FileExistsError:
+            pass
+
+    if os.path.samefile(path, shared_path):
+        return LINKED
+
+    if os.path.getsize(path) != os.path.getsize(shared_path):
+        return CONFLICT
+
+    link_file(shared_path, path)
+    return DEDUPLICATED
@@ -0,0 +1,14 @@
+import pytz
+
+
+def wall_clock_time(timestamp, timezone_name):
+    # The local time in the given timezone, but with a UTC offset, so that the database can group by it as is
+    if timestamp is None:
+        return None
+
+    try:
+        zone = pytz.timezone(timezone_name)
+    except pytz.UnknownTimeZoneError:
+        zone = pytz.utc
+
+    return timestamp.astimezone(zone).replace(tzinfo=pytz.utc)
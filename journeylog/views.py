@@ -1,29 +1,85 @@
+import os
+from collections import defaultdict
+from datetime import datetime
+
+import pytz
 import rest_framework
 from django.conf import settings
 from django.contrib.auth.models import User
 from constance import config
 
 # Create your views here.
-from django.db.models import Count, Subquery, OuterRef
-from django.http import FileResponse, HttpResponseNotFound, HttpResponseForbidden, JsonResponse
+from django.http import FileResponse, HttpResponse, HttpResponseNotFound, HttpResponseForbidden, JsonResponse
+from django.db.models import Q, Prefetch
+from django.utils.cache import patch_cache_control
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import mixins
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import get_object_or_404
+from rest_framework.filters import OrderingFilter
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.viewsets import GenericViewSet, ViewSet
 
-from .filters import PhotoFilter, LocationFilter
-from .models import Journey, Photo, Location, JournalPage, JourneyLocationVisit
+from . import search, clustering, tracks, timeline, caching, bundles, metrics
+from .filters import PhotoFilter, LocationFilter, IndexedSearchFilter
+from .models import Journey, Photo, Location, JournalPage, JourneyLocationVisit, SearchDocument, MapCluster, \
+    photo_storage_path
+from .renderers import TRACK_RENDERERS, TRACK_FORMATS
 from .serializers import UserSerializer, JourneySerializer, PhotoSerializer, LocationSerializer, JournalPageSerializer, \
-    LocationVisitSerializer
+    LocationVisitSerializer, MapClusterSerializer
+from .util.signing import verify_image_path
+
+
+class PublicCacheMixin:
+    # In public read mode, anonymous GET requests skip authentication altogether and their responses are tagged for
+    # shared caches with the surrogate keys of everything that went into them.
+    def initialize_request(self, request, *args, **kwargs):
+        self.public_read = caching.is_public_request(request)
+        self.surrogate_keys = set()
+
+        return super().initialize_request(request, *args, **kwargs)
+
+    def get_authenticators(self):
+        if self.public_read:
+            return []
+
+        return super().get_authenticators()
+
+    def get_serializer(self, *args, **kwargs):
+        if self.public_read:
+            serializer_class = self.get_serializer_class()
+            model = getattr(getattr(serializer_class, 'Meta', None), 'model', None)
+            if model is not None:
+                self.surrogate_keys.add(model._meta.model_name + 's')
+
+            if args:
+                for instance in (args[0] if kwargs.get('many') else [args[0]]):
+                    self.surrogate_keys |= caching.object_keys(instance)
+
+        return super().get_serializer(*args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        if self.public_read and response.status_code == 200:
+            caching.patch_public_response(response, self.surrogate_keys)
+        elif caching.public_read_enabled():
+            patch_cache_control(response, private=True)
+
+        return response
 
 
-class ReadOnlyViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin, GenericViewSet):
+class ReadOnlyViewSet(PublicCacheMixin, mixins.RetrieveModelMixin, mixins.ListModelMixin, GenericViewSet):
     pass
 
 
+PHOTO_BATCH_MAX_SIZE = 500
+
+
 class PhotoPagination(PageNumberPagination):
     page_size = 50
     page_size_query_param = None
@@ -41,23 +97,18 @@ class PhotoPagination(PageNumberPagination):
         })
 
 
+class SearchPagination(PhotoPagination):
+    page_size = 20
+
+
 class UserViewSet(ReadOnlyViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
 
 
 class JourneyViewSet(ReadOnlyViewSet):
-    sq_base = Journey.objects.filter(id=OuterRef('pk')).order_by()
-    pages_sq = sq_base.annotate(c=Count('journal_pages')).values('c')
-    photos_sq = sq_base.annotate(c=Count('photos')).values('c')
-    locations_sq = sq_base.annotate(c=Count('location_visits__location', distinct=True)).values('c')
-
-    queryset = (
-        Journey.objects.prefetch_related('journal_pages', 'photos', 'location_visits').annotate(
-            journal_pages_count=Subquery(pages_sq),
-            photos_count=Subquery(photos_sq),
-            visited_locations_count=Subquery(locations_sq),
-        ))
+    queryset = Journey.objects.prefetch_related(Prefetch('journal_pages',
+                                                         queryset=JournalPage.objects.with_photos_count()))
     serializer_class = JourneySerializer
     lookup_field = 'slug'
 
@@ -67,8 +118,9 @@ class PhotoViewSet(ReadOnlyViewSet):
     serializer_class = PhotoSerializer
     pagination_class = PhotoPagination
     filterset_class = PhotoFilter
-    filter_backends = (DjangoFilterBackend, SearchFilter, OrderingFilter)
-    search_fields = ('filename', 'name', 'description')
+    filter_backends = (DjangoFilterBackend, IndexedSearchFilter, OrderingFilter)
+    search_document_kind = SearchDocument.PHOTO
+    search_fields = ('filename',)
     ordering_fields = ('timestamp', 'filesize', 'filename', 'name')
 
     def get_serializer_context(self):
@@ -78,9 +130,52 @@ class PhotoViewSet(ReadOnlyViewSet):
         })
         return context
 
+    @action(detail=False)
+    def batch(self, request, *args, **kwargs):
+        # ?id=1,2,3 and/or ?file=<journey-slug>/<filename>, both repeatable; answered with a single query
+        try:
+            ids = [int(value) for values in request.query_params.getlist('id') for value in values.split(',')
+                   if value]
+        except ValueError:
+            raise ValidationError({'id': 'Expected comma-separated integers.'})
+
+        files = []
+        for value in request.query_params.getlist('file'):
+            journey_slug, _, filename = value.partition('/')
+            if not journey_slug or not filename:
+                raise ValidationError({'file': 'Expected <journey-slug>/<filename>.'})
+            files.append((journey_slug, filename))
+
+        if len(ids) + len(files) > PHOTO_BATCH_MAX_SIZE:
+            raise ValidationError('At most {} photos can be requested at once.'.format(PHOTO_BATCH_MAX_SIZE))
+
+        filenames = defaultdict(set)
+        for journey_slug, filename in files:
+            filenames[journey_slug].add(filename)
+
+        condition = Q(id__in=ids) if ids else Q()
+        for journey_slug, names in filenames.items():
+            condition |= Q(journey__slug=journey_slug, filename__in=names)
+
+        photos = list(self.get_queryset().filter(condition)) if ids or files else []
+        by_id = {photo.id: photo for photo in photos}
+        by_file = {(photo.journey.slug, photo.filename): photo for photo in photos}
+
+        # Results follow the order of the request, with duplicates dropped
+        requested = [by_id.get(photo_id) for photo_id in ids] + [by_file.get(file) for file in files]
+        results = list({photo.id: photo for photo in requested if photo is not None}.values())
+
+        return Response({
+            'results': self.get_serializer(results, many=True).data,
+            'missing': {
+                'ids': [photo_id for photo_id in ids if photo_id not in by_id],
+                'files': ['/'.join(file) for file in files if file not in by_file],
+            },
+        })
+
 
 class JournalPageViewSet(ReadOnlyViewSet):
-    queryset = JournalPage.objects.all()
+    queryset = JournalPage.objects.with_photos_count()
     serializer_class = JournalPageSerializer
 
 
@@ -101,16 +196,168 @@ class JourneyPhotoViewSet(PhotoViewSet):
 
 class JourneyLocationVisitViewSet(ReadOnlyViewSet):
     serializer_class = LocationVisitSerializer
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + list(TRACK_RENDERERS)
 
     def get_queryset(self):
         return JourneyLocationVisit.objects.select_related('journey').filter(journey__slug=self.kwargs['journey_slug'])
 
+    def list(self, request, *args, **kwargs):
+        if request.accepted_renderer.format in TRACK_FORMATS:
+            return Response(tracks.visit_track(self.filter_queryset(self.get_queryset())))
+
+        return super().list(request, *args, **kwargs)
+
 
 class JourneyJournalPageViewSet(JournalPageViewSet):
     lookup_field = 'slug'
 
     def get_queryset(self):
-        return JournalPage.objects.select_related('journey').filter(journey__slug=self.kwargs['journey_slug'])
+        return (JournalPage.objects.with_photos_count().select_related('journey')
+                .filter(journey__slug=self.kwargs['journey_slug']))
+
+
+class SearchViewSet(PublicCacheMixin, GenericViewSet):
+    permission_classes = [AllowAny]
+    pagination_class = SearchPagination
+
+    def list(self, request, format=None):
+        terms = search.query_terms(request.query_params.get('q', ''))
+
+        kinds = [kind for kind in request.query_params.get('kind', '').upper().split(',')
+                 if kind in dict(SearchDocument.DocumentKinds)]
+
+        documents = search.search_documents(terms, kinds=kinds, journey_slug=request.query_params.get('journey'),
+                                            prefix=True)
+        page = self.paginate_queryset(documents)
+
+        if self.public_read:
+            # Any new or changed photo or page may match, and results carry the slug of their journey
+            self.surrogate_keys |= {'photos', 'journalpages'}
+            self.surrogate_keys |= {'journey-{}'.format(document.journey_id) for document in page
+                                    if document.journey_id is not None}
+
+        return self.get_paginated_response(search.resolve_results(page, terms, request.user, prefix=True))
+
+
+class MapClusterViewSet(PublicCacheMixin, GenericViewSet):
+    permission_classes = [AllowAny]
+    serializer_class = MapClusterSerializer
+
+    def get_journey_id(self):
+        return None
+
+    def list(self, request, *args, **kwargs):
+        kind = request.query_params.get('kind', MapCluster.PHOTO).upper()
+        if kind not in dict(MapCluster.ClusterKinds):
+            raise ValidationError({'kind': 'Unknown cluster kind.'})
+
+        try:
+            zoom = int(request.query_params['zoom'])
+            bbox = request.query_params.get('bbox')
+            bbox = [float(v) for v in bbox.split(',')] if bbox else None
+        except KeyError:
+            raise ValidationError({'zoom': 'This parameter is required.'})
+        except ValueError:
+            raise ValidationError('Malformed zoom or bbox.')
+
+        if bbox is not None and len(bbox) != 4:
+            raise ValidationError({'bbox': 'Expected four comma-separated values: south,west,north,east.'})
+
+        if kind == MapCluster.PHOTO and not config.EXPOSE_GPS:
+            return Response([])
+
+        journey_id = self.get_journey_id()
+        self.surrogate_keys.add('photos' if kind == MapCluster.PHOTO else 'locations')
+        if journey_id is not None:
+            self.surrogate_keys.add('journey-{}'.format(journey_id))
+
+        clusters = clustering.clusters_for(kind, journey_id, zoom, bbox)
+        return Response(self.get_serializer(clusters, many=True).data)
+
+
+class JourneyMapClusterViewSet(MapClusterViewSet):
+    def get_journey_id(self):
+        return get_object_or_404(Journey.objects.only('id'), slug=self.kwargs['journey_slug']).id
+
+
+class JourneyTrackViewSet(PublicCacheMixin, GenericViewSet):
+    permission_classes = [AllowAny]
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + list(TRACK_RENDERERS)
+
+    def list(self, request, *args, **kwargs):
+        journey = get_object_or_404(Journey.objects.only('id', 'map_points_version'),
+                                    slug=self.kwargs['journey_slug'])
+        self.surrogate_keys.add('journey-{}'.format(journey.id))
+
+        try:
+            zoom = int(request.query_params.get('zoom', tracks.TRACK_MAX_ZOOM))
+        except ValueError:
+            raise ValidationError({'zoom': 'Expected an integer.'})
+
+        # The track is where the photos were taken, so it is withheld along with their coordinates
+        track = tracks.simplified_track(journey, zoom) if config.EXPOSE_GPS else tracks.empty_track()
+
+        if request.accepted_renderer.format in TRACK_FORMATS:
+            return Response(track)
+
+        return Response({
+            'zoom': zoom,
+            'count': len(track.timestamps),
+            'points': [{
+                'latitude': latitude,
+                'longitude': longitude,
+                'timestamp': datetime.fromtimestamp(timestamp, pytz.utc)
+            } for latitude, longitude, timestamp in zip(track.latitudes.tolist(), track.longitudes.tolist(),
+                                                        track.timestamps.tolist())]
+        })
+
+
+class JourneyTimelineViewSet(PublicCacheMixin, GenericViewSet):
+    permission_classes = [AllowAny]
+
+    def list(self, request, *args, **kwargs):
+        journey = get_object_or_404(Journey.objects.only('id'), slug=self.kwargs['journey_slug'])
+        self.surrogate_keys.add('journey-{}'.format(journey.id))
+
+        bucket = request.query_params.get('bucket', 'day')
+        if bucket not in timeline.TIMELINE_BUCKETS:
+            raise ValidationError({'bucket': 'Expected one of: {}.'.format(', '.join(timeline.TIMELINE_BUCKETS))})
+
+        zone = request.query_params.get('timezone', 'local')
+        if zone not in ('local', 'home'):
+            raise ValidationError({'timezone': 'Expected local or home.'})
+
+        try:
+            home_zone = pytz.timezone(config.HOME_TIMEZONE)
+        except pytz.UnknownTimeZoneError:
+            home_zone = pytz.utc
+
+        data = timeline.journey_timeline(journey.id, bucket, home_zone, local=zone == 'local')
+        data.update({
+            'bucket': bucket,
+            'timezone': zone,
+        })
+
+        return Response(data)
+
+
+class JourneyBundleViewSet(PublicCacheMixin, GenericViewSet):
+    permission_classes = [AllowAny]
+
+    def list(self, request, *args, **kwargs):
+        journey = get_object_or_404(Journey, slug=self.kwargs['journey_slug'])
+        self.surrogate_keys |= {'journey-{}'.format(journey.id), 'locations'}
+
+        context = self.get_serializer_context()
+        context.update({
+            'EXPOSE_GPS': config.EXPOSE_GPS
+        })
+
+        data = bundles.journey_bundle(journey, context)
+        # Changes to location names are only purged under the key of their location
+        self.surrogate_keys |= {'location-{}'.format(location['id']) for location in data['locations']}
+
+        return Response(data)
 
 
 class ServerInformationViewSet(ViewSet):
@@ -127,27 +374,66 @@ class ServerInformationViewSet(ViewSet):
         })
 
 
-def photo_file_view(request, visibility, kind, journey_id, file):
-    if visibility == 'private' and not request.user.is_authenticated:
+def photo_file_response(file_path, visibility, kind):
+    try:
+        f = open(file_path, 'rb')
+    except IOError:
         return HttpResponseNotFound()
 
-    photo = Photo.objects.filter(journey_id=journey_id, filename=file).first()
+    metrics.increment('journeylog_image_bytes_served_total', os.fstat(f.fileno()).st_size, kind=kind,
+                      visibility=visibility)
+    return FileResponse(f)
+
+
+def signed_photo_file_response(request, visibility, kind, journey_id, file):
+    path = '{}/{}/{}/{}'.format(visibility, kind, journey_id, file)
+    refresh = request.GET.get('refresh')
+    if not verify_image_path(path, request.GET.get('expires'), refresh, request.GET.get('signature')):
+        return HttpResponseNotFound()
+
+    file_path = photo_storage_path(visibility, kind, journey_id, file)
+
+    if kind == 'thumb':
+        # Only missing or outdated thumbnails need the photo itself
+        try:
+            # A shared thumbnail is a link to the same file, so this is its age as well
+            outdated = os.stat(file_path).st_mtime < int(refresh)
+        except OSError:
+            outdated = True
 
-    if photo is None:
+        if outdated:
+            photo = Photo.objects.filter(journey_id=journey_id, filename=file).first()
+            if photo is not None:
+                photo.ensure_thumb()
+
+    return photo_file_response(file_path, visibility, kind)
+
+
+def photo_file_view(request, visibility, kind, journey_id, file):
+    if 'signature' in request.GET:
+        return signed_photo_file_response(request, visibility, kind, journey_id, file)
+
+    if visibility == 'private':
         return HttpResponseNotFound()
 
-    if (photo.confidentiality > 0 or visibility == 'private') and not photo.hash == request.GET['hash']:
+    photo = Photo.objects.filter(journey_id=journey_id, filename=file).first()
+
+    if photo is None or photo.confidentiality > 0:
         return HttpResponseNotFound()
 
     if kind == 'thumb':
         photo.ensure_thumb()
 
-    try:
-        file_path = photo.get_storage_file_path(kind)
-        return FileResponse(open(file_path, 'rb'))
-    except IOError:
+    return photo_file_response(photo.get_storage_file_path(kind), visibility, kind)
+
+
+def metrics_view(request):
+    allowed = request.META.get('REMOTE_ADDR') in settings.JOURNEYLOG['METRICS_ALLOWED_IPS']
+    if not metrics.metrics_enabled() or not allowed:
         return HttpResponseNotFound()
 
+    return HttpResponse(metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 def generate_missing_thumbs_view(request):
     if request.user.is_staff: